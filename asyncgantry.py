@@ -0,0 +1,244 @@
+'''
+
+asyncgantry.py
+
+asyncio counterparts of gantrycontrol and pgcamera, so a user interface
+or monitoring loop keeps running while the gantry moves and the cameras
+take photos.
+
+asyncgantry and asynccamera run the blocking gantrycontrol and pgcamera
+calls on executors of their own, one thread each, so calls to the
+controller and to the cameras are made one at a time and in order, as
+they would be from a script.  Moves, photos, status polling and file
+writing can then interleave in one event loop.
+
+Cancelling a call (task.cancel(), asyncio.wait_for timeout):
+  - a call not started yet is dropped.
+  - a gantry motion (move, move_rel, homing, trajectory, scan program,
+    wait_settled ...) is stopped with ST (HX;ST for the scan program),
+    sent to the controller from a second thread.  The cancellation comes
+    through once the call has returned and the position has been read
+    again.  A homing stopped half way fails and turns the motors off, see
+    gantrycontrol.recover.
+  - a camera call can not be interrupted: it runs to its end first.
+    wait_for_image waits in slices of EVENT_SLICE seconds, so it stops
+    within one slice.
+
+The status is read on the second thread as well, so it can be polled
+while a move is waiting for the motion to complete.  This needs a
+controller connection that takes calls from two threads (gclib does,
+so does galilsim); with the status stream on (start_status_stream) the
+status costs no round trip at all.
+
+Usage:
+
+  > import asyncio, gantrycontrol, pgcamera, asyncgantry
+  > gantry = asyncgantry.asyncgantry( gantrycontrol.gantrycontrol( exit_on_error=False ) )
+  > cam = asyncgantry.asynccamera( pgcamera.pgcamera() )
+  > async def main():
+  >     await gantry.move_rel( 1000 )                     # any gantrycontrol method, awaited
+  >     move = asyncio.create_task( gantry.move( 10, 20 ) )
+  >     async for status in gantry.watch( 0.1 ):          # status while it moves
+  >         print( status.ref )
+  >         if move.done(): break
+  >     await gantry.wait_settled()
+  >     imgname = await cam.capture( '.', 'z0_y0_x0' )    # capture_image
+  >     file_path = await cam.trigger()                    # trigger_image
+  >     data, settings = await cam.fetch( file_path, 0 )  # fetch_image
+  >     await cam.save( data, 'z0_y0_x0.jpg' )            # written on a thread of its own
+  >     await asyncio.wait_for( gantry.move_rel( 50000 ), 2. )  # stopped (ST) after 2 s
+  > asyncio.run( main() )
+  > gantry.close(); cam.close()
+'''
+
+import asyncio
+import concurrent.futures
+import functools
+import time
+
+# gantrycontrol methods that move the gantry : command stopping them when cancelled
+MOTION_CALLS = { 'move' : 'ST', 'move_rel' : 'ST', 'move_rel_mm' : 'ST', 'move_trajectory' : 'ST',
+                 'move_trajectory_mm' : 'ST', 'stream_pvt' : 'ST', 'locate_home' : 'ST', 'locate_home_xyz' : 'ST',
+                 'motion_complete' : 'ST', 'wait_settled' : 'ST', 'run_scan_program' : 'HX;ST',
+                 'wait_scan_program' : 'HX;ST' }
+STATUS_CALLS = ( 'read_status', 'scan_progress' ) # run on the second thread, next to a motion
+EVENT_SLICE = 0.5 # seconds wait_for_image waits per camera call
+
+
+async def _finish( future ):
+    '''
+    Wait for the shielded call future to end after a cancellation, whatever
+    its outcome.
+    '''
+    try:
+        await future
+    except BaseException:
+        pass
+
+
+class asyncgantry:
+    '''
+    gantrycontrol with awaitable methods: await gantry.name(...) runs
+    gantrycontrol.name(...) on the gantry thread.
+    '''
+
+    def __init__( self, gantry, executor=None ):
+        '''
+        gantry   : gantrycontrol object
+        executor : executor the gantry calls run on, one thread of its own
+                   by default
+        '''
+        self.gantry = gantry
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor( 1, thread_name_prefix='gantry' )
+        self.monitor = concurrent.futures.ThreadPoolExecutor( 1, thread_name_prefix='gantry monitor' )
+
+    async def call( self, name, *args, **kwargs ):
+        '''
+        await gantrycontrol method name, see the cancellation rules above
+        '''
+        function = functools.partial( getattr( self.gantry, name ), *args, **kwargs )
+        loop = asyncio.get_running_loop()
+        if name in STATUS_CALLS:
+            return await loop.run_in_executor( self.monitor, function )
+        future = self.executor.submit( function )
+        running = asyncio.wrap_future( future )
+        try:
+            return await asyncio.shield( running )
+        except asyncio.CancelledError:
+            if future.cancel():
+                raise # not started
+            if name not in MOTION_CALLS:
+                await _finish( running )
+                raise
+            await loop.run_in_executor( self.monitor, self.gantry.g.GCommand, MOTION_CALLS[name] )
+            await _finish( running )
+            await loop.run_in_executor( self.executor, self.gantry.get_cur_pos ) # the move did not get to its end
+            raise
+
+    def __getattr__( self, name ):
+        if name.startswith( '_' ) or not callable( getattr( self.__dict__.get( 'gantry' ), name, None ) ):
+            raise AttributeError( name )
+        return functools.partial( self.call, name )
+
+    async def stop( self, command='ST' ):
+        '''
+        Send command (ST: stop the motion) now, not after the call running.
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor( self.monitor, self.gantry.g.GCommand, command )
+
+    async def watch( self, interval=0.1 ):
+        '''
+        async iterator of the gantry status (galilstatus.gantrystatus, in
+        x,y,z,theta,phi order) every interval seconds
+        '''
+        while True:
+            t0 = time.time()
+            yield await self.call( 'read_status' )
+            await asyncio.sleep( max( interval - ( time.time() - t0 ), 0. ) )
+
+    def close( self ):
+        '''
+        Shut the threads down once the calls queued are done.
+        '''
+        self.executor.shutdown()
+        self.monitor.shutdown()
+
+
+class asynccamera:
+    '''
+    pgcamera with awaitable photo and download calls, run on the camera
+    thread.  Files are written on a thread of their own.
+    '''
+
+    def __init__( self, camera, executor=None ):
+        '''
+        camera   : pgcamera object
+        executor : executor the camera calls run on, one thread of its own
+                   by default
+        '''
+        self.camera = camera
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor( 1, thread_name_prefix='camera' )
+        self.writer = concurrent.futures.ThreadPoolExecutor( 1, thread_name_prefix='camera files' )
+
+    async def _run( self, executor, function, *args ):
+        future = executor.submit( function, *args )
+        running = asyncio.wrap_future( future )
+        try:
+            return await asyncio.shield( running )
+        except asyncio.CancelledError:
+            if not future.cancel():
+                await _finish( running ) # leave the camera between calls
+            raise
+
+    async def call( self, name, *args ):
+        '''
+        await pgcamera method name on the camera thread
+        '''
+        return await self._run( self.executor, getattr( self.camera, name ), *args )
+
+    async def capture( self, dir='', label='img', append_date=True ):
+        '''
+        capture_image: photo with the selected camera, saved to dir, returns the image name
+        '''
+        return await self.call( 'capture_image', dir, label, append_date )
+
+    async def capture_all( self, dir='', label='img', append_date=True ):
+        return await self.call( 'capture_all', dir, label, append_date )
+
+    async def trigger( self, camera_no=None ):
+        '''
+        trigger_image: photo left in the camera, returns its file path
+        '''
+        return await self.call( 'trigger_image', camera_no )
+
+    async def download( self, file_path, camno, dir='', label='img', append_date=True ):
+        '''
+        download_image: the photo of file_path saved to dir, returns the image name
+        '''
+        return await self.call( 'download_image', file_path, camno, dir, label, append_date )
+
+    async def fetch( self, file_path, camno ):
+        '''
+        fetch_image: (image data, camera settings text) of the photo of file_path
+        '''
+        return await self.call( 'fetch_image', file_path, camno )
+
+    async def capture_data( self, camera_no=None ):
+        '''
+        capture_data: (image data, camera settings text) of a new photo, in memory
+        '''
+        return await self.call( 'capture_data', camera_no )
+
+    async def wait_for_image( self, camera_no=None, timeout=10. ):
+        '''
+        wait_for_image: file path of the next photo triggered outside the host
+        '''
+        import pgcamera # needs gphoto2, for its error codes
+        gp = pgcamera.gp
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            try:
+                return await self.call( 'wait_for_image', camera_no, max( min( EVENT_SLICE, remaining ), 0. ) )
+            except gp.GPhoto2Error as ex:
+                if ex.code != gp.GP_ERROR_TIMEOUT or remaining <= EVENT_SLICE:
+                    raise
+
+    async def save( self, data, fname ):
+        '''
+        Write data (bytes) to file fname on the file thread.
+        '''
+        def write():
+            with open( fname, 'wb' ) as f:
+                f.write( data )
+        return await self._run( self.writer, write )
+
+    def close( self ):
+        '''
+        Shut the threads down once the calls queued are done and close the
+        camera sessions.
+        '''
+        self.writer.shutdown()
+        self.executor.submit( self.camera.close_sessions )
+        self.executor.shutdown()
@@ -0,0 +1,223 @@
+'''
+
+bench.py
+
+Benchmarks of the gantry and camera code on simulated hardware (galilsim
+and gphotosim on the virtual clock of dryrun.py), so a change to move,
+move_rel, locate_home_xyz, capture_image or the scan code can be checked
+for speed before it goes on the gantry.  Times are gantry seconds, not
+the time the benchmark takes to run, and come out the same on every
+machine, except for the scans: their download thread makes them vary by
+about 0.1% from run to run, well within the compare tolerance.
+
+Benchmarks and their results:
+
+  homing   homing_s, homing_round_trips              locate_home_xyz from DEFAULT_START
+  move     move_s, move_overhead_s, move_round_trips  1000 count move_rel of x, overhead is
+           move3_overhead_s, move3_round_trips        the time beyond the motion profile;
+                                                      move3 moves x, y and z
+  capture  capture_s, capture_overhead_s              capture_image, overhead is the time
+                                                      beyond shutter and transfer
+  scan1    scan1_points_per_hour, scan1_s,            20x20 yz serpentine of scan1.py and
+  scan2    scan2_points_per_hour, scan2_s, ...        20x20 diagonal of scan2.py with
+                                                      scanengine, after homing
+
+Results go to a JSON file; compare with a previous one to catch
+regressions (exit code 1 if a result got worse by more than the
+tolerance).
+
+Usage:
+
+  python bench.py                                   # all benchmarks, print results
+  python bench.py --json bench.json                 # and write them
+  python bench.py --compare bench.json              # fail on regressions against bench.json
+  python bench.py --only move,capture --points 5    # some benchmarks, 5x5 scans
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import time
+import numpy as np
+import dryrun
+import scanplan
+
+# result : ( unit, 'lower' or 'higher' is better )
+RESULTS = { 'homing_s' : ( 's', 'lower' ), 'homing_round_trips' : ( 'round trips', 'lower' ),
+            'move_s' : ( 's', 'lower' ), 'move_overhead_s' : ( 's', 'lower' ), 'move_round_trips' : ( 'round trips', 'lower' ),
+            'move3_overhead_s' : ( 's', 'lower' ), 'move3_round_trips' : ( 'round trips', 'lower' ),
+            'capture_s' : ( 's', 'lower' ), 'capture_overhead_s' : ( 's', 'lower' ) }
+for _scan in ( 'scan1', 'scan2' ):
+    RESULTS.update( { _scan+'_points_per_hour' : ( 'points/h', 'higher' ), _scan+'_s' : ( 's', 'lower' ),
+                      _scan+'_round_trips_per_point' : ( 'round trips', 'lower' ) } )
+TOLERANCE = 0.02  # relative change accepted by compare
+
+
+def scan_points( name, n=20 ):
+    '''
+    points of the scan1.py or scan2.py pattern, n x n
+    '''
+    if name == 'scan1':
+        # yz plane at x = xfix, back and forth in y
+        ystep, zstep = int( 77000/n ), int( 67000/n )
+        return scanplan.serpentine( ('z','y'), (0,0), (zstep*(n-1),ystep*(n-1)), (n,n), base=(80000,0,0,0,0) ).tolist()
+    return scanplan.diagonal( (0,62000,0), (130000,40000,67000), n, n ).tolist()
+
+
+class bench:
+
+    def __init__( self, latency=0.002, nmoves=20, ncaptures=10, npoints=20 ):
+        '''
+        latency   : controller round trip (s)
+        nmoves    : moves averaged in the move benchmark
+        ncaptures : photos averaged in the capture benchmark
+        npoints   : scans have npoints x npoints points
+        '''
+        self.dryrun = dryrun.dryrun( latency=latency )
+        self.nmoves = nmoves
+        self.ncaptures = ncaptures
+        self.npoints = npoints
+
+    @contextlib.contextmanager
+    def _simulated( self ):
+        '''
+        simulated hardware, with the output of the gantry code hidden
+        '''
+        with self.dryrun.session() as ( clock, cameras ), contextlib.redirect_stdout( io.StringIO() ):
+            yield clock, cameras
+
+    def homing( self ):
+        import gantrycontrol
+        with self._simulated():
+            gantry = gantrycontrol.gantrycontrol()
+            t0 = time.time()
+            gantry.locate_home_xyz()
+            results = { 'homing_s' : time.time() - t0, 'homing_round_trips' : gantry.last_homing['round_trips'] }
+            del gantry
+        return results
+
+    def _moves( self, gantry, step ):
+        elapsed, overhead, round_trips = [], [], []
+        for i in range( self.nmoves ):
+            sign = 1 if i % 2 == 0 else -1
+            t0 = time.time()
+            predicted = gantry.move_rel( *[ sign*s for s in step ] )
+            elapsed.append( time.time() - t0 )
+            overhead.append( elapsed[-1] - predicted )
+            round_trips.append( gantry.last_round_trips )
+        return np.mean( elapsed ), np.mean( overhead ), np.mean( round_trips )
+
+    def move( self ):
+        import gantrycontrol
+        with self._simulated():
+            gantry = gantrycontrol.gantrycontrol()
+            seconds, overhead, round_trips = self._moves( gantry, (1000,0,0) )
+            results = { 'move_s' : seconds, 'move_overhead_s' : overhead, 'move_round_trips' : round_trips }
+            seconds, overhead, round_trips = self._moves( gantry, (1000,1000,1000) )
+            results.update( { 'move3_overhead_s' : overhead, 'move3_round_trips' : round_trips } )
+            del gantry
+        return results
+
+    def capture( self ):
+        with self._simulated() as ( clock, cameras ):
+            import pgcamera # gphoto2 is the simulated one only in the session
+            pgc = pgcamera.pgcamera()
+            pgc.capture_image( '.', 'first', False ) # connection and capture target, once per scan
+            elapsed = []
+            for i in range( self.ncaptures ):
+                t0 = time.time()
+                pgc.capture_image( '.', 'bench'+str(i), False )
+                elapsed.append( time.time() - t0 )
+            camera = cameras.times['capture'] + cameras.times['file_get'] + cameras.times['file_delete'] \
+                     + cameras.image_size/cameras.usb_rate
+            del pgc
+        return { 'capture_s' : np.mean( elapsed ), 'capture_overhead_s' : np.mean( elapsed ) - camera }
+
+    def scan( self, name ):
+        points = scan_points( name, self.npoints )
+        with self._simulated():
+            import gantrycontrol, pgcamera, scanengine
+            gantry = gantrycontrol.gantrycontrol()
+            pgc = pgcamera.pgcamera()
+            gantry.locate_home_xyz()
+            n0 = gantry.round_trips
+            t0 = time.time()
+            scanengine.scanengine( gantry, pgc, dir='.', append_date=False ).run( points )
+            seconds = time.time() - t0
+            round_trips = gantry.round_trips - n0
+            del pgc
+            del gantry
+        return { name+'_points_per_hour' : len(points)/seconds*3600., name+'_s' : seconds,
+                 name+'_round_trips_per_point' : round_trips/len(points) }
+
+    def run( self, names=( 'homing', 'move', 'capture', 'scan1', 'scan2' ) ):
+        '''
+        Run the benchmarks names, returns the report: results, units and the
+        wall clock seconds each benchmark took to run.
+        '''
+        results, wall = {}, {}
+        for name in names:
+            t0 = time.time()
+            if name in ( 'scan1', 'scan2' ):
+                results.update( self.scan( name ) )
+            else:
+                results.update( getattr( self, name )() )
+            wall[ name ] = time.time() - t0
+        results = dict( ( key, float(value) ) for key, value in results.items() )
+        return { 'results' : results, 'units' : dict( ( key, RESULTS[key][0] ) for key in results ),
+                 'wall_s' : wall, 'latency' : self.dryrun.latency, 'npoints' : self.npoints,
+                 'python' : platform.python_version(), 'date' : time.strftime('%Y-%m-%d %H:%M:%S') }
+
+
+def compare( report, baseline, tolerance=TOLERANCE ):
+    '''
+    Results of report worse than in baseline by more than tolerance (relative),
+    as a list of (name, baseline value, new value).
+    '''
+    worse = []
+    for name, value in report['results'].items():
+        if name not in baseline['results']:
+            continue
+        old = baseline['results'][name]
+        limit = abs(old)*tolerance + 1e-6
+        better = RESULTS[name][1]
+        if ( better == 'lower' and value > old + limit ) or ( better == 'higher' and value < old - limit ):
+            worse.append( ( name, old, value ) )
+    return worse
+
+
+def print_report( report, baseline=None ):
+    print( '%-32s %14s %14s  %s' % ( 'result', 'value', 'baseline', 'unit' ) )
+    for name, value in report['results'].items():
+        old = '' if baseline is None or name not in baseline['results'] else '%14.4f' % baseline['results'][name]
+        print( '%-32s %14.4f %14s  %s' % ( name, value, old, report['units'][name] ) )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description='benchmarks of the gantry code on simulated hardware' )
+    parser.add_argument( '--json', default=None, help='write the results to this file' )
+    parser.add_argument( '--compare', default=None, help='results file to compare with, exit code 1 on regressions' )
+    parser.add_argument( '--tolerance', type=float, default=TOLERANCE, help='relative change accepted by --compare' )
+    parser.add_argument( '--only', default=None, help='comma separated benchmarks: homing,move,capture,scan1,scan2' )
+    parser.add_argument( '--points', type=int, default=20, help='scans have points x points points' )
+    parser.add_argument( '--latency', type=float, default=0.002, help='controller round trip (s)' )
+    options = parser.parse_args()
+
+    b = bench( latency=options.latency, npoints=options.points )
+    report = b.run( options.only.split(',') ) if options.only else b.run()
+    baseline = None
+    if options.compare is not None:
+        with open( options.compare, 'r' ) as f:
+            baseline = json.load( f )
+    print_report( report, baseline )
+    if options.json is not None:
+        with open( options.json, 'w' ) as f:
+            json.dump( report, f, indent=1 )
+    if baseline is not None:
+        worse = compare( report, baseline, options.tolerance )
+        for name, old, value in worse:
+            print( 'REGRESSION', name, ':', old, '->', value, report['units'][name] )
+        sys.exit( 1 if len(worse) > 0 else 0 )
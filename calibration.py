@@ -0,0 +1,107 @@
+'''
+
+calibration.py
+
+calibration class: conversion between gantry positions in mm (degrees for
+theta and phi) and motor counts, for whole N x 5 trajectories at once.
+
+For each axis
+
+  position = offset + scale*counts + correction( offset + scale*counts )
+
+where the correction is an optional table of (nominal position, correction)
+pairs, interpolated linearly and held constant beyond its ends.  The
+inverse used for counts is exact as long as position + correction grows
+with position.
+
+Usage:
+
+  > import calibration
+  > cal = calibration.calibration()                 # scales used by gantrycontrol
+  > counts = cal.to_counts( [[10,20,30,0,0],[11,20,30,0,0]] )   # N x 5 int array
+  > mm = cal.to_mm( counts )                         # N x 5 float array
+  > cal = calibration.load( 'gantry_calibration.json' )
+  > cal.save( 'gantry_calibration.json' )
+
+The calibration file is JSON:
+
+  { "scale"  : [0.01113, 0.009382, 0.009355, 0.0226, 0.02259],
+    "offset" : [0, 0, 0, 0, 0],
+    "tables" : { "x" : { "position" : [0, 500, 1000], "correction" : [0, 0.2, 0.1] } } }
+
+The offsets measured earlier (x 0.195, y 0.375, z 0.126, theta 0.44,
+phi 0.5357) are not applied by default, as in gantrycontrol.convert.
+'''
+
+import json
+import numpy as np
+
+AXIS_NAMES = ( 'x', 'y', 'z', 'theta', 'phi' )
+SCALE = ( 0.01113, 0.009382, 0.009355, 0.0226, 0.02259 ) # mm (degrees) per count
+
+
+class calibration:
+
+    def __init__( self, scale=SCALE, offset=(0,0,0,0,0), tables=None ):
+        '''
+        scale  : mm (degrees) per count of each axis
+        offset : position in mm (degrees) at count 0 of each axis
+        tables : dictionary axis name : (positions, corrections) in mm
+        '''
+        self.scale  = np.asarray( scale, dtype=float )
+        self.offset = np.asarray( offset, dtype=float )
+        self.tables = [ None ]*len(AXIS_NAMES)
+        for name, (position, correction) in ( tables or {} ).items():
+            position   = np.asarray( position, dtype=float )
+            correction = np.asarray( correction, dtype=float )
+            if position.shape != correction.shape or np.any( np.diff(position) <= 0 ):
+                raise ValueError('correction table of axis '+name+' needs increasing positions, one correction each')
+            if np.any( np.diff( position + correction ) <= 0 ):
+                raise ValueError('correction table of axis '+name+' can not be inverted')
+            self.tables[ AXIS_NAMES.index(name) ] = ( position, correction )
+
+    def to_counts( self, positions ):
+        '''
+        positions: N x 5 (or one row of 5) in mm and degrees.
+        Returns an N x 5 int64 array of counts, rounded like round().
+        '''
+        positions = np.atleast_2d( np.asarray( positions, dtype=float ) )
+        nominal = positions.copy()
+        for i, table in enumerate( self.tables ):
+            if table is not None:
+                position, correction = table
+                nominal[:,i] -= np.interp( positions[:,i], position + correction, correction )
+        return np.rint( ( nominal - self.offset )/self.scale ).astype( np.int64 )
+
+    def to_mm( self, counts ):
+        '''
+        counts: N x 5 (or one row of 5).
+        Returns an N x 5 float array in mm and degrees.
+        '''
+        counts = np.atleast_2d( np.asarray( counts, dtype=float ) )
+        positions = self.offset + self.scale*counts
+        for i, table in enumerate( self.tables ):
+            if table is not None:
+                position, correction = table
+                positions[:,i] += np.interp( positions[:,i], position, correction )
+        return positions
+
+    def save( self, fname ):
+        tables = {}
+        for name, table in zip( AXIS_NAMES, self.tables ):
+            if table is not None:
+                tables[ name ] = { 'position' : table[0].tolist(), 'correction' : table[1].tolist() }
+        with open( fname, 'w' ) as f:
+            json.dump( { 'scale' : self.scale.tolist(), 'offset' : self.offset.tolist(), 'tables' : tables }, f, indent=2 )
+
+
+def load( fname ):
+    '''
+    Reads a calibration file, missing entries take the defaults.
+    '''
+    with open( fname, 'r' ) as f:
+        data = json.load( f )
+    tables = {}
+    for name, table in data.get( 'tables', {} ).items():
+        tables[ name ] = ( table['position'], table['correction'] )
+    return calibration( data.get( 'scale', SCALE ), data.get( 'offset', (0,0,0,0,0) ), tables )
@@ -0,0 +1,149 @@
+'''
+
+camsettings.py
+
+Camera settings of a scan stored once instead of once per photo.
+
+The settings text of a camera (see pgcamera.settings_text) is parsed once
+per distinct get_summary text and identified by its sha256.  A settings
+log is a JSON lines file with one line each time the settings of a
+camera differ from the last line of that camera:
+
+  {"camno": 1, "ref": "c1_z0_y0_x0.jpg", "sha256": ..., "baseline": "full text"}
+  {"camno": 1, "ref": "c1_z0_y0_x9.jpg", "sha256": ..., "diff": [[21, 22, ["ISO Speed, value: 400\n"]]]}
+
+The first line of a camera holds the full text, later ones only the
+lines that changed: [first, end, lines] replaces lines first to end
+(0 based, end excluded) of the previous text of that camera, in the
+order of that text.  The text rebuilt from a diff is the same text,
+checked against its sha256 when written; if it is not, a full baseline
+is written instead.  ref is the first image taken with those settings;
+every image has the settings of the last line of its camera before it.
+
+Usage:
+
+  > import camsettings
+  > text = camsettings.parse_summary( camera.get_summary().text )
+  > log = camsettings.settingslog( 'scan/settings.jsonl' )
+  > sha = log.record( 1, text, 'c1_z0_y0_x0.jpg' )   # writes a line only if the settings changed
+  > log.text( sha )                                   # full settings text
+  > log.close()
+'''
+
+import difflib
+import functools
+import hashlib
+import json
+import os
+import threading
+
+HEADER_LINES = 5   # summary lines kept as they are
+FIRST_SETTING = 17 # summary line of the first setting
+
+
+@functools.lru_cache( maxsize=64 )
+def parse_summary( summary ):
+    '''
+    Settings text from the get_summary text of a camera: the first few lines
+    as they are, then 'name, value: value' per setting.  Ignore generic
+    unamed properties.  Cached per summary text.
+    '''
+    settings_list = summary.split( '\n' )
+    lines = settings_list[:HEADER_LINES]
+    for settings in settings_list[FIRST_SETTING:]:
+        setlist = settings.split('(')
+        setname = setlist[0].strip(': ()')
+        setlist = settings.split(' ')
+        setvalue = setlist[-1].strip(' ()')
+        # skip generic unamed properties
+        if setname.split(' ')[0] != 'Property' and setname != '':
+            lines.append( setname+', value: '+setvalue )
+    return ''.join( line+'\n' for line in lines )
+
+
+@functools.lru_cache( maxsize=64 )
+def settings_hash( text ):
+    return hashlib.sha256( text.encode() ).hexdigest()
+
+
+def settings_diff( old, new ):
+    '''
+    [first, end, lines] blocks replacing lines first to end of settings
+    text old to make text new
+    '''
+    a, b = old.splitlines( True ), new.splitlines( True )
+    return [ [ i1, i2, b[j1:j2] ] for tag, i1, i2, j1, j2 in
+             difflib.SequenceMatcher( None, a, b, autojunk=False ).get_opcodes() if tag != 'equal' ]
+
+
+def apply_diff( text, diff ):
+    '''
+    settings text with the blocks of diff (see settings_diff) replaced
+    '''
+    lines = text.splitlines( True )
+    for first, end, new in reversed( diff ):
+        lines[ first:end ] = new
+    return ''.join( lines )
+
+
+class settingslog:
+
+    def __init__( self, fname, readonly=False ):
+        '''
+        fname    : settings log, created or appended to
+        readonly : only read the log, record is not allowed
+        '''
+        self.fname = fname
+        self.texts = {}   # sha256 : text
+        self.last = {}    # camno : sha256 of its last line
+        self.lock = threading.Lock()
+        if os.path.exists( fname ):
+            with open( fname, 'r' ) as f:
+                for line in f:
+                    try:
+                        entry = json.loads( line )
+                    except ValueError:
+                        continue # incomplete last line
+                    if 'baseline' in entry:
+                        text = entry['baseline']
+                    else:
+                        text = apply_diff( self.texts[ self.last[ entry['camno'] ] ], entry['diff'] )
+                    self.texts[ entry['sha256'] ] = text
+                    self.last[ entry['camno'] ] = entry['sha256']
+        self.f = None if readonly else open( fname, 'a' )
+
+    def record( self, camno, text, ref ):
+        '''
+        Settings text of camera camno for image ref.  A line is written only
+        if they differ from the last settings of that camera.  Returns the
+        sha256 of text.
+        '''
+        sha = settings_hash( text )
+        with self.lock:
+            if self.last.get( camno ) == sha:
+                return sha
+            entry = { 'camno' : camno, 'ref' : ref, 'sha256' : sha }
+            if camno in self.last:
+                diff = settings_diff( self.texts[ self.last[camno] ], text )
+                if settings_hash( apply_diff( self.texts[ self.last[camno] ], diff ) ) == sha:
+                    entry['diff'] = diff
+            if 'diff' not in entry:
+                entry['baseline'] = text
+            self.f.write( json.dumps( entry ) + '\n' )
+            self.f.flush()
+            self.texts[ sha ] = text
+            self.last[ camno ] = sha
+        return sha
+
+    def text( self, sha ):
+        '''
+        full settings text with hash sha
+        '''
+        return self.texts[ sha ]
+
+    def close( self ):
+        if self.f is not None:
+            self.f.flush()
+            os.fsync( self.f.fileno() )
+            self.f.close()
+            self.f = None
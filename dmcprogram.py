@@ -0,0 +1,128 @@
+'''
+
+dmcprogram.py
+
+Builds the DMC program that runs a whole scan on the Galil controller,
+see gantrycontrol.start_scan_program.
+
+The scan points go to the controller as arrays, one per axis, together
+with the per axis speed and acceleration of the move to each point
+(synchronized as in gantrycontrol.move, see trajectory.axis_settings).
+The program then runs the scan loop by itself: for each point
+
+  SP/AC/DC and PA from the arrays, BG, AM   move and wait for the profile
+  WT settle                                  let the axes settle
+  SB output, WT pulse, CB output             pulse the camera trigger output
+  ipt=ipt+1                                  one more photo triggered
+  WT exposure - pulse                        leave the camera time to expose
+
+so no host round trip is needed per point.  The host follows the scan
+through the variables ipt (photos triggered so far) and scandone (1 at
+the end), see PROGRESS_QUERY.
+
+The trigger output must be wired to the remote release of the cameras.
+
+Usage:
+
+  > import dmcprogram
+  > dmcprogram.check_points( len(points) )     # ValueError beyond max_points()
+  > arrays, seconds = dmcprogram.scan_arrays( (0,0,0,0,0), points, speed, accel )   # name : values
+  > program = dmcprogram.scan_program( settle=0.1, exposure=1. )
+'''
+
+import trajectory
+
+AXES = 'ABCDE'
+LABEL = 'SCAN'            # program entry, XQ #SCAN
+POINTS = 'npts'           # variable: number of points
+INDEX = 'ipt'             # variable: photos triggered so far
+DONE = 'scandone'         # variable: 1 once the scan is over
+POSITION = 'pos'          # array name prefix of the positions, e.g. posa
+SPEED = 'spd'             # array name prefix of the speeds
+ACCEL = 'acc'             # array name prefix of the accelerations
+ARRAY_SPACE = 24000       # array elements the controller holds (DMC-40x0)
+PROGRESS_QUERY = 'MG %s,%s,_XQ0' % ( INDEX, DONE )
+
+
+def array_names():
+    '''
+    names of the position, speed and acceleration arrays, per axis
+    '''
+    return ( [ POSITION+ax.lower() for ax in AXES ], [ SPEED+ax.lower() for ax in AXES ],
+             [ ACCEL+ax.lower() for ax in AXES ] )
+
+
+def max_points( space=ARRAY_SPACE ):
+    '''
+    most points a scan program holds: each point takes one element of the
+    position, speed and acceleration arrays of every axis
+    '''
+    return space // sum( len(names) for names in array_names() )
+
+
+def check_points( npoints, space=ARRAY_SPACE ):
+    '''
+    ValueError if a scan of npoints points does not fit the array space
+    '''
+    if npoints > max_points( space ):
+        raise ValueError('scan of %d points does not fit the controller array space (%d elements), '
+                         'split it into scan programs of at most %d points' % ( npoints, space, max_points( space ) ))
+
+
+def scan_arrays( start, points, speed, accel ):
+    '''
+    start  : position (x,y,z,theta,phi) in counts the scan starts from
+    points : list of absolute positions (x,y,z,theta,phi) in counts
+    speed, accel : per axis limits in counts/s and counts/s^2
+
+    Returns (arrays, seconds): a dictionary array name : list of values
+    and the predicted time of all the moves.
+    '''
+    positions, speeds, accels = array_names()
+    arrays = dict( ( name, [] ) for name in positions + speeds + accels )
+    cur = [ int(round(p)) for p in start ]
+    seconds = 0.
+    for point in points:
+        target = [ int(round(p)) for p in point ]
+        dist = [ target[i] - cur[i] for i in range( len(AXES) ) ]
+        sp, ac, t = trajectory.axis_settings( dist, speed, accel )
+        seconds += t
+        for i in range( len(AXES) ):
+            arrays[ positions[i] ].append( target[i] )
+            # axes that don't move keep a valid setting
+            arrays[ speeds[i] ].append( sp[i] if sp[i] is not None else speed[i] )
+            arrays[ accels[i] ].append( ac[i] if ac[i] is not None else int( accel[i]/1024 )*1024 )
+        cur = target
+    return arrays, seconds
+
+
+def scan_program( settle=0.1, exposure=1., pulse=0.05, output=1, axes=AXES ):
+    '''
+    Text of the scan program.  settle, exposure and pulse are in seconds:
+    the wait after each move, the time left to the camera from the start of
+    the trigger pulse, and the length of the pulse on output bit output.
+    axes are the controller axes of x,y,z,theta,phi (see gantrycontrol).
+    '''
+    positions, speeds, accels = array_names()
+    def axes_line( code, names ):
+        # one argument per controller axis, the array of the gantry axis it drives
+        return code+' '+','.join( names[ axes.index(ax) ]+'['+INDEX+']' for ax in AXES )
+    lines = [ '#'+LABEL,
+              INDEX+'=0;'+DONE+'=0',
+              '#SCANPT',
+              axes_line( 'SP', speeds ),
+              axes_line( 'AC', accels ),
+              axes_line( 'DC', accels ),
+              axes_line( 'PA', positions ),
+              'BG'+axes,
+              'AM'+axes,
+              'WT %d' % int(round( settle*1000 )),
+              'SB %d' % output,
+              'WT %d' % int(round( pulse*1000 )),
+              'CB %d' % output,
+              INDEX+'='+INDEX+'+1',
+              'WT %d' % int(round( max( exposure - pulse, 0. )*1000 )),
+              'JP #SCANPT,'+INDEX+'<'+POINTS,
+              DONE+'=1',
+              'EN' ]
+    return '\r'.join( lines ) + '\r'
@@ -0,0 +1,344 @@
+'''
+
+dryrun.py
+
+Runs a scan script, unmodified, against the galilsim controller and the
+gphotosim cameras on a virtual clock, to know how long it will take on
+the gantry and which phase dominates, in seconds instead of hours.
+
+While the script runs, gclib and gphoto2 are stand-ins backed by the
+simulators, and time.time, time.sleep, time.monotonic and
+time.perf_counter are those of a virtual clock: sleeps, controller round
+trips, motion and camera latencies advance the clock without waiting.
+Computation in the script takes no virtual time.
+
+Each thread has its own virtual time.  A thread starts at the time of
+its parent, a threading.Lock (and so a queue.Queue) hands the time of
+the thread releasing it to the thread acquiring it, and join hands the
+end time of the thread.  So the download thread of scanengine overlaps
+the moves as it does on the gantry.
+
+The time slept is booked to the phase the thread is in: homing, move,
+settle, capture, download, metadata, ... (PHASES, and the spans of
+scanengine), the innermost one unless an outer one is in OWNING_PHASES,
+'script' outside of them, and 'wait' for time a thread spent waiting for
+another.  The phases of the main thread add up to the total.
+
+The script runs in a scratch directory (images, journal, checkpoint end
+up there), its output goes to output.log in that directory.
+
+Usage:
+
+  python dryrun.py scan2.py                     # total and per phase breakdown
+  python dryrun.py --cameras 2 --latency 0.005 scan1.py
+  python dryrun.py --json report.json --verbose scan2.py
+
+  > import dryrun
+  > report = dryrun.dryrun( latency=0.002 ).run( 'scan2.py' )
+  > report['total'], report['main_thread'], report['phases']
+  > with dryrun.dryrun().session() as ( clock, cameras ):   # simulated hardware for your own code
+  >     gantry = gantrycontrol.gantrycontrol()
+'''
+
+import _thread
+import argparse
+import contextlib
+import json
+import os
+import runpy
+import sys
+import tempfile
+import threading
+import time
+import types
+import galilsim
+import gphotosim
+
+# phase of the gantrycontrol and pgcamera methods, by class
+PHASES = { 'gantrycontrol' : { '__init__' : 'setup', 'locate_home' : 'homing', 'move' : 'move', 'move_rel' : 'move',
+                               'move_rel_mm' : 'move', 'move_trajectory' : 'move', 'stream_pvt' : 'move',
+                               'motion_complete' : 'move', 'wait_settled' : 'settle', 'run_scan_program' : 'scan program' },
+           'pgcamera' : { '__init__' : 'camera setup', 'trigger_image' : 'capture', 'wait_for_image' : 'capture',
+                          'download_image' : 'download', 'fetch_image' : 'download', 'settings_text' : 'metadata',
+                          'print_abilities' : 'metadata', 'capture_abilities' : 'metadata' } }
+# phases that keep the time of the calls made in them, e.g. the moves of the homing
+OWNING_PHASES = ( 'setup', 'homing', 'camera setup', 'scan program' )
+
+
+class virtualclock:
+    '''
+    Per thread virtual time, see the module description.
+    '''
+
+    def __init__( self, start=0. ):
+        self.start = start
+        self.local = threading.local()
+        self.mutex = _thread.allocate_lock()
+        self.ends = {}         # thread : virtual time it finished at
+        self.phases = {}       # phase : seconds, all threads
+        self.main_phases = {}  # phase : seconds, main thread
+        self.nsleeps = 0
+
+    def time( self ):
+        # no threading.current_thread() here, threading itself takes
+        # locks before a new thread is registered
+        t = getattr( self.local, 't', None )
+        if t is None:
+            t = self.local.t = self.start
+        return t
+
+    def begin_thread( self, t ):
+        '''
+        A thread started at time t by its parent.
+        '''
+        self.local.t = max( t, self.time() )
+
+    def _book( self, phase, seconds ):
+        with self.mutex:
+            self.phases[ phase ] = self.phases.get( phase, 0. ) + seconds
+            if threading.get_ident() == threading.main_thread().ident:
+                self.main_phases[ phase ] = self.main_phases.get( phase, 0. ) + seconds
+
+    def sleep( self, seconds ):
+        seconds = max( seconds, 0. )
+        self.local.t = self.time() + seconds
+        stack = getattr( self.local, 'phases', None )
+        self._book( stack[-1] if stack else 'script', seconds )
+        self.nsleeps += 1
+
+    def wait_until( self, t ):
+        '''
+        The thread waited for another one until time t.
+        '''
+        if t is not None and t > self.time():
+            self._book( 'wait', t - self.time() )
+            self.local.t = t
+
+    @contextlib.contextmanager
+    def phase( self, name ):
+        if not hasattr( self.local, 'phases' ):
+            self.local.phases = []
+        stack = self.local.phases
+        stack.append( stack[-1] if len(stack) > 0 and stack[-1] in OWNING_PHASES else name )
+        try:
+            yield
+        finally:
+            self.local.phases.pop()
+
+    def phased( self, function, name ):
+        def wrapper( *args, **kwargs ):
+            with self.phase( name ):
+                return function( *args, **kwargs )
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+
+    def Lock( self ):
+        '''
+        threading.Lock that hands the time of its last release to the next acquire
+        '''
+        clock = self
+        class lock:
+            def __init__( self ):
+                self.lock = _thread.allocate_lock()
+                self.released = None
+            def acquire( self, blocking=True, timeout=-1 ):
+                acquired = self.lock.acquire( blocking, timeout )
+                if acquired:
+                    clock.wait_until( self.released )
+                return acquired
+            def release( self ):
+                self.released = clock.time()
+                self.lock.release()
+            def locked( self ):
+                return self.lock.locked()
+            def __enter__( self ):
+                return self.acquire()
+            def __exit__( self, *exc ):
+                self.release()
+        return lock()
+
+    def elapsed( self ):
+        '''
+        seconds from the start to the end of the last thread
+        '''
+        return max( [ self.time() ] + list( self.ends.values() ) ) - self.start
+
+
+class dryrun:
+
+    def __init__( self, latency=0.002, ncameras=1, camera_times=None, image_size=gphotosim.IMAGE_SIZE,
+                  usb_rate=gphotosim.USB_RATE, start=galilsim.DEFAULT_START, verbose=False ):
+        '''
+        latency      : controller round trip time (s), see galilsim
+        ncameras     : number of simulated cameras
+        camera_times : seconds per camera call, see gphotosim.DEFAULT_TIMES
+        image_size, usb_rate : photo size (bytes) and camera to host rate (bytes/s)
+        start        : physical position of the gantry when the controller is opened (counts)
+        verbose      : show the output of the script instead of logging it
+        '''
+        self.latency = latency
+        self.ncameras = ncameras
+        self.camera_times = camera_times
+        self.image_size = image_size
+        self.usb_rate = usb_rate
+        self.start = start
+        self.verbose = verbose
+        self.galils = []   # galilsim objects the script made
+
+    @contextlib.contextmanager
+    def _patched( self, clock, cameras ):
+        '''
+        stand-in modules, virtual time and phases while the script runs
+        '''
+        saved = []
+        def patch( obj, name, value ):
+            saved.append( ( obj, name, getattr( obj, name, None ) ) )
+            setattr( obj, name, value )
+
+        run = self
+        gclib = types.ModuleType( 'gclib' )
+        def py():
+            galil = galilsim.galilsim( start=run.start, latency=run.latency, clock=clock )
+            cameras.connect_trigger( galil )
+            run.galils.append( galil )
+            return galil
+        gclib.py = py
+        gp = cameras.module()
+        saved_modules = dict( ( name, sys.modules.get( name ) ) for name in ( 'gclib', 'gphoto2' ) )
+        sys.modules['gclib'] = gclib
+        sys.modules['gphoto2'] = gp
+        import gantrycontrol, pgcamera, scantrace
+        patch( gantrycontrol, 'gclib', gclib )
+        patch( pgcamera, 'gp', gp )
+
+        for module, cls in ( ( gantrycontrol, gantrycontrol.gantrycontrol ), ( pgcamera, pgcamera.pgcamera ) ):
+            for name, phase in PHASES[ cls.__name__ ].items():
+                patch( cls, name, clock.phased( getattr( cls, name ), phase ) )
+        span = scantrace.span
+        def phase_span( tracer, name, category='scan', **args ):
+            stack = contextlib.ExitStack()
+            stack.enter_context( clock.phase( name ) )
+            stack.enter_context( span( tracer, name, category, **args ) )
+            return stack
+        patch( scantrace, 'span', phase_span )
+
+        for name in ( 'time', 'monotonic', 'perf_counter' ):
+            patch( time, name, clock.time )
+        patch( time, 'sleep', clock.sleep )
+        patch( threading, 'Lock', clock.Lock )
+        start, join = threading.Thread.start, threading.Thread.join
+        def virtual_start( thread ):
+            begin = clock.time()
+            target = thread.run
+            def virtual_run():
+                clock.begin_thread( begin )
+                try:
+                    target()
+                finally:
+                    clock.ends[ thread ] = clock.time()
+            thread.run = virtual_run
+            start( thread )
+        def virtual_join( thread, timeout=None ):
+            join( thread, timeout )
+            if not thread.is_alive():
+                clock.wait_until( clock.ends.get( thread ) )
+        patch( threading.Thread, 'start', virtual_start )
+        patch( threading.Thread, 'join', virtual_join )
+        try:
+            yield
+        finally:
+            for obj, name, value in reversed( saved ):
+                setattr( obj, name, value )
+            for name, module in saved_modules.items():
+                if module is None:
+                    sys.modules.pop( name, None )
+                else:
+                    sys.modules[ name ] = module
+
+    @contextlib.contextmanager
+    def session( self, workdir=None ):
+        '''
+        Simulated controller and cameras on a virtual clock for the code in
+        the with block, run in workdir (a new scratch directory by default):
+        gantrycontrol and pgcamera objects made in it use galilsim and
+        gphotosim.  Yields the virtualclock and the gphotosim.
+        '''
+        if workdir is None:
+            workdir = tempfile.mkdtemp( prefix='dryrun_' )
+        os.makedirs( workdir, exist_ok=True )
+        clock = virtualclock( start=time.time() )
+        cameras = gphotosim.gphotosim( self.ncameras, times=self.camera_times, image_size=self.image_size,
+                                       usb_rate=self.usb_rate, clock=clock )
+        cameras.write_camera_file( os.path.join( workdir, 'pgcamera_cameras.txt' ) )
+        self.galils = []
+        cwd = os.getcwd()
+        os.chdir( workdir )
+        try:
+            with self._patched( clock, cameras ):
+                yield clock, cameras
+        finally:
+            os.chdir( cwd )
+
+    def run( self, script, args=(), workdir=None ):
+        '''
+        Run scan script script (with command line args) in workdir, a new
+        scratch directory by default.  Returns the report: total seconds,
+        seconds per phase of the main thread and of all threads, and more
+        (see print_report).
+        '''
+        script = os.path.abspath( script )
+        argv, path = sys.argv, list( sys.path )
+        status = 'completed'
+        wall = time.time()
+        with self.session( workdir ) as ( clock, cameras ):
+            workdir = os.getcwd()
+            log = None if self.verbose else open( 'output.log', 'w' )
+            try:
+                sys.argv = [ script ] + list( args )
+                sys.path.insert( 0, os.path.dirname( script ) )
+                with contextlib.redirect_stdout( log or sys.stdout ):
+                    try:
+                        runpy.run_path( script, run_name='__main__' )
+                    except SystemExit as ex:
+                        status = 'exit '+str( ex.code )
+                total = clock.elapsed()
+            finally:
+                sys.argv = argv
+                sys.path[:] = path
+                if log is not None:
+                    log.close()
+        return { 'script' : script, 'status' : status, 'workdir' : workdir, 'total' : total,
+                 'main_thread' : clock.main_phases, 'phases' : clock.phases,
+                 'round_trips' : sum( g.nround_trips for g in self.galils ),
+                 'photos' : cameras.ncaptures, 'sleeps' : clock.nsleeps, 'wall' : time.time() - wall }
+
+
+def print_report( report ):
+    total = report['total']
+    print( 'dry run of', report['script'], '(' + report['status'] + ')' )
+    print( 'total %.1f s (%d:%02d:%02d), %d photos, %d controller round trips, %.1f s to simulate' % (
+        total, total//3600, total%3600//60, total%60, report['photos'], report['round_trips'], report['wall'] ) )
+    print( '%-16s %12s %7s %16s' % ( 'phase', 'main s', 'main %', 'all threads s' ) )
+    for phase, seconds in sorted( report['phases'].items(), key=lambda item : -item[1] ):
+        main = report['main_thread'].get( phase, 0. )
+        print( '%-16s %12.2f %7.1f %16.2f' % ( phase, main, 100.*main/total if total > 0 else 0., seconds ) )
+    print( 'output and files in', report['workdir'] )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description='time a scan script on simulated hardware with a virtual clock' )
+    parser.add_argument( 'script', help='scan script, e.g. scan2.py' )
+    parser.add_argument( 'args', nargs='*', help='arguments of the script' )
+    parser.add_argument( '--latency', type=float, default=0.002, help='controller round trip (s)' )
+    parser.add_argument( '--cameras', type=int, default=1, help='number of simulated cameras' )
+    parser.add_argument( '--workdir', default=None, help='directory the script runs in, a new one by default' )
+    parser.add_argument( '--json', default=None, help='also write the report to this file' )
+    parser.add_argument( '--verbose', action='store_true', help='show the output of the script' )
+    options = parser.parse_args()
+
+    report = dryrun( options.latency, options.cameras, verbose=options.verbose ).run( options.script, options.args, options.workdir )
+    print_report( report )
+    if options.json is not None:
+        with open( options.json, 'w' ) as f:
+            json.dump( report, f, indent=1 )
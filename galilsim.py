@@ -0,0 +1,969 @@
+'''
+
+galilsim.py
+
+galilsim class: a simulated Galil motion controller that can be handed to
+gantrycontrol in place of gclib.py(), so that gantry code and scan scripts
+can be run and timed on a machine without the 0RC39 gantry.
+
+Usage:
+
+  > import galilsim
+  > import gantrycontrol as gc
+  > sim = galilsim.galilsim()                  # simulated controller
+  > gantry = gc.gantrycontrol( galil=sim )     # use it instead of gclib.py()
+  > gantry.move_rel( 1000 )
+  > print( sim.nround_trips )                  # number of GCommand calls so far
+
+Only the commands that gantrycontrol sends are understood:
+PA, PR, SP, AC, DC, JG, KS, DP, BG, ST, MO, SH, TE, TP, TV, TC, the
+PVT commands PV and BT, the data record rate DR, and MG of the _LR, _LF,
+_BG, _TP, _RP, _TV, _TE, _SP, _AC, _DC and _PV operands.  GRecord('QR')
+returns one binary data record and GRecord('DR') waits for the next
+one of the 'DR n' stream (see galilstatus.py).
+Anything else raises GclibError, like a '?' from the real controller.
+
+Programs: GProgramDownload checks a DMC program the way the controller
+would (line length, number of lines, labels, jump targets, expressions)
+and also rejects the commands galilsim can not run, so a program that
+downloads here only uses the subset below.  XQ runs it, HX halts it.
+In programs: labels, variable and array assignments, PA, PR, SP, AC, DC,
+JG, KS, DP, BG, ST, SH, MO, AM, WT, SB, CB, JP, EN and ' comments, with
+expressions evaluated left to right as on the controller.  From the host:
+DM and DA for arrays, GArrayDownload, assignments, and MG of variables,
+arrays, expressions and _XQ0.  Output bits set by SB and CB are logged in
+output_log as (time, bit, value).
+
+Timing model:
+  - every GCommand call costs one network round trip (latency seconds)
+    plus cmd_time seconds per ';' separated command in it.
+  - moves follow a trapezoidal velocity profile using the SP, AC and DC
+    of each axis.  KS smoothing is stored but does not change the profile.
+  - PVT segments are cubic in time, as on the controller, and run
+    back to back from a 255 segment buffer per axis.  They are not
+    checked against the limit switches.
+  - each axis has a reverse limit switch at physical position 0 and a
+    forward limit switch at travel counts.  An axis running into a switch
+    decelerates with its DC, as the controller does.
+  - after a move the motor overshoots the end point by settle_overshoot
+    counts and settles back with time constant settle_time.  While moving
+    it lags the reference by velocity*following_lag counts.  TE, TP and TV
+    report the motor, PA ? and _RP the reference position.
+  - time is read and slept through 'clock' (default: the time module), so
+    any object with time() and sleep() can replace the wall clock.
+  - a running program is caught up with the clock whenever the host talks
+    to the controller; each program command takes PROGRAM_CMD_TIME.
+'''
+
+import math
+import re
+import time
+import galilstatus
+
+AXES = 'ABCDE'
+
+# physical travel between reverse and forward limit switch, in counts
+DEFAULT_TRAVEL = ( 140000, 80000, 75000, 16000, 16000 )
+# physical position the gantry is left at when the simulator starts
+DEFAULT_START = ( 5000, 5000, 5000, 2000, 2000 )
+PVT_BUFFER = 255       # PVT segments each axis can hold
+SAMPLE_RATE = 1024.    # servo samples per second (TM 1000)
+MAX_PROGRAM_LINES = 2000    # program lines the controller holds
+MAX_LINE = 80               # characters per program line
+ARRAY_SPACE = 24000         # array elements the controller holds
+PROGRAM_CMD_TIME = 0.00004  # time the controller takes per program command (s)
+MOTION_POLL = 0.05          # GMotionComplete checks for a stop (ST from another thread) this often (s)
+SET_COMMANDS = ( 'PA', 'PR', 'SP', 'AC', 'DC', 'JG', 'KS', 'DP' )
+BINARY = ( '+', '-', '*', '/', '<', '>', '=', '<=', '>=', '<>', '&', '|' )
+TOKEN = re.compile( r'\s*(?:(\d+\.?\d*|\.\d+)|(_[A-Za-z0-9]+)|([A-Za-z][A-Za-z0-9]*)|(<=|>=|<>|[-+*/<>=&|()\[\]]))' )
+ASSIGNMENT = re.compile( r'^([A-Za-z][A-Za-z0-9]*)\s*(?:\[(.*)\])?\s*=(.*)$' )
+LABEL = re.compile( r'^#[A-Za-z][A-Za-z0-9]{0,6}$' )
+
+
+class GclibError(Exception):
+    '''
+    Raised for commands the controller would reject, mirrors gclib.GclibError.
+    '''
+    pass
+
+
+class simaxis:
+    '''
+    State of one simulated axis.
+
+    Motion is kept as a list of segments (t_start, p_start, v_start, accel,
+    jerk) in physical counts.  The jerk is only non-zero for PVT segments.
+    The reference is at rest at p_rest from t_end on, the motor then settles
+    onto it.  Reported positions are physical + offset, where the offset is
+    changed by DP.
+    '''
+
+    def __init__( self, name, travel, pos, accel, overshoot=20., tau=0.05, lag=0.001 ):
+        self.name   = name
+        self.travel = float(travel)
+        self.offset = 0.
+        self.sp = 25000.
+        self.ac = float(accel)
+        self.dc = float(accel)
+        self.jg = 0.
+        self.ks = 2.
+        self.mode = 'PR'     # what the next BG does: 'PR', 'PA' or 'JG'
+        self.pvt = []        # PV segments (dp, v, n) waiting for BT
+        self.pvt_open = False  # running PVT motion not yet ended by a t=0 segment
+        self.pr = 0.
+        self.pa = 0.
+        self.servo = False
+        self.segs = []
+        self.t_end = 0.
+        self.p_rest = float(pos)
+        self.last_dir = 0.          # direction of the last move, for the settling model
+        self.overshoot = overshoot  # counts the motor runs past the end of a move
+        self.tau = tau              # settling time constant (s)
+        self.lag = lag              # following error per count/s of velocity (s)
+
+    def _segment( self, t ):
+        for seg in reversed( self.segs ):
+            if t >= seg[0]:
+                return seg
+        return self.segs[0]
+
+    def position( self, t ):
+        '''
+        physical position at time t
+        '''
+        if t >= self.t_end or len(self.segs) == 0:
+            return self.p_rest
+        t0, p0, v0, a, j = self._segment( t )
+        dt = max( t - t0, 0. )
+        return p0 + v0*dt + 0.5*a*dt*dt + j*dt*dt*dt/6.
+
+    def velocity( self, t ):
+        if t >= self.t_end or len(self.segs) == 0:
+            return 0.
+        t0, p0, v0, a, j = self._segment( t )
+        dt = max( t - t0, 0. )
+        return v0 + a*dt + 0.5*j*dt*dt
+
+    def moving( self, t ):
+        return t < self.t_end or self.pvt_open
+
+    def error( self, t ):
+        '''
+        position error, reference - motor
+        '''
+        if self.moving( t ):
+            return self.velocity( t )*self.lag
+        if not self.servo or self.last_dir == 0.:
+            return 0.
+        return -self.last_dir*self.overshoot*math.exp( -( t - self.t_end )/self.tau )
+
+    def motor_position( self, t ):
+        return self.position( t ) - self.error( t )
+
+    def motor_velocity( self, t ):
+        if self.moving( t ):
+            return self.velocity( t )
+        return self.error( t )/self.tau
+
+    def reverse_limit( self, t ):
+        '''
+        1 if the reverse limit switch is not activated, 0 if it is (like _LR)
+        '''
+        return 0 if self.position( t ) <= 0. else 1
+
+    def forward_limit( self, t ):
+        return 0 if self.position( t ) >= self.travel else 1
+
+    def _stop_segments( self, t, p, v ):
+        '''
+        decelerate with DC from position p and velocity v at time t
+        '''
+        if v == 0.:
+            self.segs, self.t_end, self.p_rest = [], t, p
+            return
+        dt = abs(v)/self.dc
+        self.segs.append( (t, p, v, -self.dc if v > 0 else self.dc, 0.) )
+        self.t_end  = t + dt
+        self.p_rest = p + 0.5*v*dt
+
+    def _truncate( self, t ):
+        '''
+        drop the part of the motion after time t, returns (p, v) at t
+        '''
+        p, v = self.position( t ), self.velocity( t )
+        self.segs = [ seg for seg in self.segs if seg[0] < t ]
+        return p, v
+
+    def start( self, t, dist=None, speed=None ):
+        '''
+        Start a trapezoidal move of dist counts, or a jog at speed
+        counts/s when dist is None.  The axis must be at rest.
+        '''
+        p0 = self.p_rest
+        if dist is not None:
+            if dist == 0. or self.sp == 0.:
+                return
+            direction = 1. if dist > 0 else -1.
+            self.last_dir = direction
+            vmax = abs( self.sp )
+            dacc = vmax*vmax/(2*self.ac)
+            ddec = vmax*vmax/(2*self.dc)
+            if dacc + ddec > abs(dist):
+                # triangular profile, never reaches vmax
+                vmax = ( 2*abs(dist)*self.ac*self.dc/(self.ac + self.dc) )**0.5
+                dacc = vmax*vmax/(2*self.ac)
+                ddec = vmax*vmax/(2*self.dc)
+            tacc = vmax/self.ac
+            tcru = ( abs(dist) - dacc - ddec )/vmax if vmax > 0 else 0.
+            tdec = vmax/self.dc
+            self.segs = [ (t, p0, 0., direction*self.ac, 0.),
+                          (t+tacc, p0 + direction*dacc, direction*vmax, 0., 0.),
+                          (t+tacc+tcru, p0 + dist - direction*ddec, direction*vmax, -direction*self.dc, 0.) ]
+            self.t_end  = t + tacc + tcru + tdec
+            self.p_rest = p0 + dist
+        else:
+            if speed == 0.:
+                return
+            direction = 1. if speed > 0 else -1.
+            self.last_dir = direction
+            tacc = abs(speed)/self.ac
+            self.segs = [ (t, p0, 0., direction*self.ac, 0.),
+                          (t+tacc, p0 + speed*tacc/2, speed, 0., 0.) ]
+            self.t_end  = float('inf')
+            self.p_rest = float('inf')*direction
+        self._apply_limits( direction )
+
+    def _apply_limits( self, direction ):
+        '''
+        Cut the motion where it first reaches the limit switch it is heading
+        to, and decelerate from there.
+        '''
+        limit = self.travel if direction > 0 else 0.
+        p0 = self.segs[0][1]
+        if ( direction > 0 and p0 >= limit ) or ( direction < 0 and p0 <= limit ):
+            # switch already active, the controller will not move this way
+            self.segs, self.t_end, self.p_rest = [], self.segs[0][0], p0
+            return
+        for i, (t0, p0, v0, a, j) in enumerate( self.segs ):
+            t1 = self.segs[i+1][0] if i+1 < len(self.segs) else self.t_end
+            dt = _crossing( p0 - limit, v0, a )
+            if dt is not None and t0 + dt <= t1:
+                tc = t0 + dt
+                self.segs = self.segs[:i+1]
+                self._stop_segments( tc, limit, v0 + a*dt )
+                return
+
+    def _end_velocity( self ):
+        if len(self.segs) == 0:
+            return 0.
+        t0, p0, v0, a, j = self.segs[-1]
+        dt = self.t_end - t0
+        return v0 + a*dt + 0.5*j*dt*dt
+
+    def add_pvt( self, t, dp, v1, n ):
+        '''
+        Append a PVT segment to the running motion: dp counts in n samples,
+        ending with velocity v1, cubic in time.  If the motion already ran
+        out of segments the new one starts at t.
+        '''
+        t0 = max( self.t_end, t )
+        p0 = self.p_rest
+        v0 = self._end_velocity() if self.t_end > t else 0.
+        T = n/SAMPLE_RATE
+        c2 = ( 3*dp - ( 2*v0 + v1 )*T )/( T*T )
+        c3 = ( ( v0 + v1 )*T - 2*dp )/( T*T*T )
+        self.segs.append( (t0, p0, v0, 2*c2, 6*c3) )
+        if dp != 0:
+            self.last_dir = 1. if dp > 0 else -1.
+        self.t_end  = t0 + T
+        self.p_rest = p0 + dp
+
+    def begin_pvt( self, t ):
+        '''
+        BT: start the buffered PVT segments
+        '''
+        self.segs, self.t_end = [], t
+        self.pvt_open = True
+        pending, self.pvt = self.pvt, []
+        for seg in pending:
+            self.queue_pvt( t, *seg )
+
+    def queue_pvt( self, t, dp, v, n ):
+        '''
+        PV command: n == 0 ends the PVT motion
+        '''
+        if not self.pvt_open:
+            if n != 0:
+                self.pvt.append( (dp, v, n) )
+            return
+        if n == 0:
+            self.pvt_open = False
+        else:
+            self.add_pvt( t, dp, v, n )
+
+    def pvt_free( self, t ):
+        '''
+        free places in the PVT buffer (like _PV)
+        '''
+        queued = len( self.pvt ) + len( [ seg for seg in self.segs if seg[0] > t ] )
+        return PVT_BUFFER - queued
+
+    def stop( self, t ):
+        self.pvt_open = False
+        if not self.moving( t ):
+            return
+        p, v = self._truncate( t )
+        self._stop_segments( t, p, v )
+
+    def motor_off( self, t ):
+        self.pvt_open = False
+        p = self.position( t )
+        self.segs, self.t_end, self.p_rest = [], t, p
+        self.servo = False
+
+
+def _crossing( dp, v, a ):
+    '''
+    smallest dt >= 0 with dp + v*dt + a*dt^2/2 == 0, or None
+    '''
+    if a == 0.:
+        if v == 0.:
+            return None
+        dt = -dp/v
+        return dt if dt >= 0. else None
+    disc = v*v - 2*a*dp
+    if disc < 0.:
+        return None
+    roots = sorted( [ (-v - disc**0.5)/a, (-v + disc**0.5)/a ] )
+    for dt in roots:
+        if dt >= 0.:
+            return dt
+    return None
+
+
+def _check_name( name ):
+    if len(name) > 8:
+        raise GclibError('question mark returned by controller: variable name longer than 8 characters: '+name)
+
+
+def _tokenize( text ):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = TOKEN.match( text, pos )
+        if m is None:
+            raise GclibError('question mark returned by controller: bad expression '+text)
+        number, operand, name, symbol = m.groups()
+        if number is not None:
+            tokens.append( ('number', number) )
+        elif operand is not None:
+            tokens.append( ('operand', operand.upper()) )
+        elif name is not None:
+            tokens.append( ('name', name) )
+        else:
+            tokens.append( ('symbol', symbol) )
+        pos = m.end()
+    return tokens
+
+
+def _parse_value( tokens, pos, text ):
+    if pos >= len(tokens):
+        raise GclibError('question mark returned by controller: incomplete expression '+text)
+    kind, tok = tokens[pos]
+    if tok == '(':
+        tree, pos = _parse_binary( tokens, pos+1, text )
+        if pos >= len(tokens) or tokens[pos][1] != ')':
+            raise GclibError('question mark returned by controller: missing ) in '+text)
+        return tree, pos+1
+    if tok == '-':
+        tree, pos = _parse_value( tokens, pos+1, text )
+        return ('neg', tree), pos
+    if kind == 'number':
+        return ('number', float(tok)), pos+1
+    if kind == 'operand':
+        return ('operand', tok), pos+1
+    if kind == 'name':
+        _check_name( tok )
+        if pos+1 < len(tokens) and tokens[pos+1][1] == '[':
+            index, pos = _parse_binary( tokens, pos+2, text )
+            if pos >= len(tokens) or tokens[pos][1] != ']':
+                raise GclibError('question mark returned by controller: missing ] in '+text)
+            return ('array', tok, index), pos+1
+        return ('variable', tok), pos+1
+    raise GclibError('question mark returned by controller: bad expression '+text)
+
+
+def _parse_binary( tokens, pos, text ):
+    '''
+    operators are applied left to right, without precedence, as on the controller
+    '''
+    tree, pos = _parse_value( tokens, pos, text )
+    while pos < len(tokens) and tokens[pos][1] in BINARY:
+        op = tokens[pos][1]
+        rhs, pos = _parse_value( tokens, pos+1, text )
+        tree = ('binary', op, tree, rhs)
+    return tree, pos
+
+
+def parse_expression( text ):
+    '''
+    Parse a DMC expression into a tree for galilsim._evaluate
+    '''
+    tokens = _tokenize( text )
+    tree, pos = _parse_binary( tokens, 0, text )
+    if pos != len(tokens):
+        raise GclibError('question mark returned by controller: bad expression '+text)
+    return tree
+
+
+def _parse_axes( rest ):
+    rest = rest.strip().upper()
+    if any( ax not in AXES for ax in rest ):
+        raise GclibError('question mark returned by controller: bad axis mask '+rest)
+    return rest if rest != '' else AXES
+
+
+def parse_command( cmd ):
+    '''
+    Parse one program command into a tuple (kind, ...), raising GclibError
+    for commands the controller, or galilsim, can not run.
+    '''
+    if cmd.startswith("'") or cmd.startswith('REM') or cmd.startswith('NO'):
+        return ('comment',)
+    code = cmd[:2]
+    rest = cmd[2:].strip()
+    m = ASSIGNMENT.match( cmd )
+    if m is not None and code != 'PV':
+        name, index, value = m.groups()
+        _check_name( name )
+        index = parse_expression( index ) if index is not None else None
+        return ('assign', name, index, parse_expression( value ))
+    if code == 'EN':
+        return ('end',)
+    if code == 'JP':
+        label, sep, condition = rest.partition(',')
+        label = label.strip()
+        if not LABEL.match( label ):
+            raise GclibError('question mark returned by controller: bad label in '+cmd)
+        return ('jump', label[1:], parse_expression( condition ) if sep else None)
+    if code == 'WT':
+        return ('wait', parse_expression( rest ))
+    if code == 'AM':
+        return ('after', _parse_axes( rest ))
+    if code in ('SB', 'CB'):
+        return ('bit', code, parse_expression( rest ))
+    if code in SET_COMMANDS:
+        args = [ arg.strip() for arg in rest.split(',') ] if rest != '' else []
+        if len(args) > len(AXES):
+            raise GclibError('question mark returned by controller: too many arguments in '+cmd)
+        return ('set', code, [ parse_expression( arg ) if arg != '' else None for arg in args ])
+    if code in ('BG', 'ST', 'SH', 'MO'):
+        return ('execute', code + _parse_axes( rest ))
+    raise GclibError('question mark returned by controller: command not supported by galilsim: '+cmd)
+
+
+class galilsim:
+    '''
+    Simulated controller with the same calling interface as gclib.py().
+    '''
+
+    def __init__( self, travel=DEFAULT_TRAVEL, start=DEFAULT_START, accel=256000,
+                  latency=0.002, cmd_time=0.0002, settle_overshoot=20., settle_time=0.05,
+                  following_lag=0.001, clock=time ):
+        '''
+        travel   : physical distance between the limit switches of each axis (counts)
+        start    : physical position of each axis when the simulator starts (counts)
+        accel    : default AC and DC of every axis (counts/s^2)
+        latency  : round trip time of one GCommand call (s)
+        cmd_time : extra controller time per ';' separated command (s)
+        settle_overshoot : counts the motor overshoots the end of a move
+        settle_time      : time constant of the settling after a move (s)
+        following_lag    : following error per count/s of velocity (s)
+        clock    : object with time() and sleep(), the time module by default
+        '''
+        self.axes = [ simaxis( AXES[i], travel[i], start[i], accel, settle_overshoot, settle_time, following_lag )
+                      for i in range( len(AXES) ) ]
+        self.latency = latency
+        self.cmd_time = cmd_time
+        self.clock = clock
+        self.address = ''
+        self.nround_trips = 0
+        self.last_error = ''
+        self.dr_interval = 0     # data record period in samples, 0 is off
+        self.dr_last = 0.
+        self.program = []        # downloaded program, parsed commands of each line
+        self.labels = {}         # label : line
+        self.variables = {}
+        self.arrays = {}
+        self.prog_pc = None      # (line, command) the program runs next, None when it is not running
+        self.prog_time = 0.      # time the program runs its next command at
+        self.outputs = 0         # output bits, bit 1 is 1
+        self.output_log = []     # (time, bit, value) of every SB and CB
+
+    def _now( self ):
+        return self.clock.time()
+
+    def GVersion( self ):
+        return 'galilsim'
+
+    def GOpen( self, address ):
+        self.address = address
+
+    def GInfo( self ):
+        return self.address.split(' ')[0] + ', galilsim simulated DMC, 5 axes'
+
+    def GClose( self ):
+        pass
+
+    def GCommand( self, command ):
+        '''
+        Execute one or more ';' separated commands, returns the responses of
+        the queries in it separated by '\\r\\n'.
+        '''
+        self.nround_trips += 1
+        commands = [ cmd.strip() for cmd in command.split(';') if cmd.strip() != '' ]
+        self.clock.sleep( self.latency + self.cmd_time*len(commands) )
+        self._advance( self._now() )
+        responses = []
+        for cmd in commands:
+            res = self._execute( cmd )
+            if res is not None:
+                responses.append( res )
+        return '\r\n'.join( responses )
+
+    def status( self, t ):
+        '''
+        galilstatus.gantrystatus of the simulated controller at time t
+        '''
+        self._advance( t )
+        return galilstatus.gantrystatus(
+            sample   = int( t*SAMPLE_RATE ),
+            ref      = [ round( axis.position( t ) + axis.offset ) for axis in self.axes ],
+            pos      = [ round( axis.motor_position( t ) + axis.offset ) for axis in self.axes ],
+            err      = [ round( axis.error( t ) ) for axis in self.axes ],
+            vel      = [ round( axis.motor_velocity( t ) ) for axis in self.axes ],
+            lf       = [ axis.forward_limit( t ) for axis in self.axes ],
+            lr       = [ axis.reverse_limit( t ) for axis in self.axes ],
+            moving   = [ axis.moving( t ) for axis in self.axes ],
+            received = t )
+
+    def GRecord( self, method='QR' ):
+        '''
+        Binary data record: 'QR' asks for one (a round trip), 'DR' waits
+        for the next record of the stream started with 'DR n'.
+        '''
+        if method == 'QR':
+            self.nround_trips += 1
+            self.clock.sleep( self.latency )
+        elif method == 'DR':
+            if self.dr_interval <= 0:
+                raise GclibError('GRecord: no data record stream, send DR n first')
+            period = self.dr_interval/SAMPLE_RATE
+            wait = self.dr_last + period - self._now()
+            if wait > 0:
+                self.clock.sleep( wait )
+            self.dr_last = self._now()
+        else:
+            raise GclibError('GRecord: unknown method '+str(method))
+        return galilstatus.encode_record( self.status( self._now() ) )
+
+    def GMotionComplete( self, axes ):
+        '''
+        Block until all axes in the axes string have stopped.
+        '''
+        axes = [ self.axes[ AXES.index(ax) ] for ax in axes.upper() ]
+        while True:
+            # a running program may start new moves while we wait
+            self._advance( self._now() )
+            t_end = max( axis.t_end for axis in axes )
+            if t_end == float('inf') or any( axis.pvt_open for axis in axes ):
+                raise GclibError('GMotionComplete: an axis would never stop')
+            wait = t_end - self._now()
+            if wait <= 0:
+                break
+            self.clock.sleep( min( wait, MOTION_POLL ) )
+        self.clock.sleep( self.latency )
+
+    def GProgramDownload( self, program, preprocessor='' ):
+        '''
+        Check a DMC program and store it.  Raises GclibError for what the
+        controller would reject, and for commands galilsim can't run.
+        '''
+        self.nround_trips += 1
+        self.clock.sleep( self.latency )
+        lines = program.replace('\r\n','\n').replace('\r','\n').split('\n')
+        while len(lines) > 0 and lines[-1].strip() == '':
+            lines.pop()
+        if len(lines) > MAX_PROGRAM_LINES:
+            self._error('program of %d lines, the controller holds %d' % (len(lines), MAX_PROGRAM_LINES))
+        parsed = []
+        labels = {}
+        for number, line in enumerate( lines ):
+            if len(line) > MAX_LINE:
+                self._error('program line %d longer than %d characters' % (number, MAX_LINE))
+            commands = []
+            for k, cmd in enumerate( [ cmd.strip() for cmd in line.split(';') ] ):
+                if cmd == '':
+                    continue
+                if cmd.startswith('#'):
+                    if k != 0 or not LABEL.match( cmd ):
+                        self._error('program line %d: bad label %s' % (number, cmd))
+                    if cmd[1:] in labels:
+                        self._error('program line %d: label %s defined twice' % (number, cmd))
+                    labels[ cmd[1:] ] = number
+                    continue
+                try:
+                    commands.append( parse_command( cmd ) )
+                except GclibError as ex:
+                    self._error('program line %d: %s' % (number, str(ex).split(': ',1)[-1]))
+            parsed.append( commands )
+        for number, commands in enumerate( parsed ):
+            for command in commands:
+                if command[0] == 'jump' and command[1] not in labels:
+                    self._error('program line %d: jump to undefined label #%s' % (number, command[1]))
+        self.program, self.labels = parsed, labels
+        self.prog_pc = None
+
+    def GArrayDownload( self, name, first, last, data ):
+        '''
+        Fill elements first to last of a DM array with data, a string of
+        comma separated values (or a list of numbers).
+        '''
+        self.nround_trips += 1
+        self.clock.sleep( self.latency )
+        if name not in self.arrays:
+            self._error('array '+name+' not dimensioned')
+        if isinstance( data, str ):
+            data = data.split(',')
+        values = [ float(v) for v in data ]
+        array = self.arrays[ name ]
+        if first < 0 or last >= len(array) or last - first + 1 != len(values):
+            self._error('array download out of range for '+name)
+        array[ first:last+1 ] = values
+
+    def _advance( self, t ):
+        '''
+        run the program up to time t
+        '''
+        while self.prog_pc is not None and self.prog_time <= t:
+            line, k = self.prog_pc
+            if line >= len(self.program):
+                self.prog_pc = None   # ran past the last line
+                return
+            if k >= len(self.program[line]):
+                self.prog_pc = ( line+1, 0 )
+                continue
+            self.prog_pc = ( line, k+1 )
+            tc = self.prog_time
+            self.prog_time += PROGRAM_CMD_TIME
+            try:
+                self._run_command( self.program[line][k], tc )
+            except GclibError as ex:
+                self.last_error = 'program line %d: %s' % (line, str(ex).split(': ',1)[-1])
+                self.prog_pc = None
+
+    def _run_command( self, command, t ):
+        '''
+        run one parsed program command at time t
+        '''
+        kind = command[0]
+        if kind == 'assign':
+            self._assign( command[1], command[2], command[3], t )
+        elif kind == 'end':
+            self.prog_pc = None
+        elif kind == 'jump':
+            if command[2] is None or self._evaluate( command[2], t ) != 0:
+                self.prog_pc = ( self.labels[ command[1] ], 0 )
+        elif kind == 'wait':
+            self.prog_time = t + self._evaluate( command[1], t )/1000.
+        elif kind == 'after':
+            axes = [ self.axes[ AXES.index(ax) ] for ax in command[1] ]
+            if any( axis.pvt_open for axis in axes ):
+                self.prog_time = float('inf')
+            else:
+                self.prog_time = max( self.prog_time, max( axis.t_end for axis in axes ) )
+        elif kind == 'bit':
+            bit = int( self._evaluate( command[2], t ) )
+            value = 1 if command[1] == 'SB' else 0
+            self.outputs = ( self.outputs | (1 << (bit-1)) ) if value else ( self.outputs & ~(1 << (bit-1)) )
+            self.output_log.append( (t, bit, value) )
+        elif kind == 'set':
+            args = [ '' if arg is None else repr( self._evaluate( arg, t ) ) for arg in command[2] ]
+            self._set_values( command[1], ' '+','.join( args ), t )
+        elif kind == 'execute':
+            self._execute( command[1], t )
+
+    def _assign( self, name, index, value, t ):
+        value = self._evaluate( value, t )
+        if index is None:
+            self.variables[ name ] = value
+            return
+        i = int( self._evaluate( index, t ) )
+        if name not in self.arrays or not 0 <= i < len( self.arrays[name] ):
+            self._error('array index out of range: '+name+'['+str(i)+']')
+        self.arrays[ name ][ i ] = value
+
+    def _evaluate( self, tree, t ):
+        kind = tree[0]
+        if kind == 'number':
+            return tree[1]
+        if kind == 'operand':
+            return float( self._operand( tree[1], t ) )
+        if kind == 'variable':
+            if tree[1] not in self.variables:
+                self._error('undefined variable '+tree[1])
+            return self.variables[ tree[1] ]
+        if kind == 'array':
+            i = int( self._evaluate( tree[2], t ) )
+            if tree[1] not in self.arrays or not 0 <= i < len( self.arrays[tree[1]] ):
+                self._error('array index out of range: '+tree[1]+'['+str(i)+']')
+            return self.arrays[ tree[1] ][ i ]
+        if kind == 'neg':
+            return -self._evaluate( tree[1], t )
+        op, a, b = tree[1], self._evaluate( tree[2], t ), self._evaluate( tree[3], t )
+        if op == '+': return a + b
+        if op == '-': return a - b
+        if op == '*': return a * b
+        if op == '/':
+            if b == 0:
+                self._error('division by zero')
+            return a / b
+        if op == '<': return float( a < b )
+        if op == '>': return float( a > b )
+        if op == '=': return float( a == b )
+        if op == '<=': return float( a <= b )
+        if op == '>=': return float( a >= b )
+        if op == '<>': return float( a != b )
+        if op == '&': return float( a != 0 and b != 0 )
+        return float( a != 0 or b != 0 )
+
+    def _error( self, message ):
+        self.last_error = message
+        raise GclibError('question mark returned by controller: ' + message)
+
+    def _axis_mask( self, rest ):
+        rest = rest.strip().upper()
+        if rest == '':
+            return self.axes
+        if any( ax not in AXES for ax in rest ):
+            self._error('bad axis mask '+rest)
+        return [ self.axes[ AXES.index(ax) ] for ax in rest ]
+
+    def _execute( self, cmd, t=None ):
+        code = cmd[:2].upper()
+        rest = cmd[2:]
+        if t is None:
+            t = self._now()
+
+        m = ASSIGNMENT.match( cmd )
+        if m is not None and code != 'PV':
+            name, index, value = m.groups()
+            _check_name( name )
+            self._assign( name, parse_expression( index ) if index is not None else None, parse_expression( value ), t )
+            return None
+
+        if code == 'XQ':
+            label, sep, thread = rest.strip().partition(',')
+            if sep and int( float( thread ) ) != 0:
+                self._error('galilsim runs programs in thread 0 only')
+            label = label.strip()
+            if label != '' and label[1:] not in self.labels:
+                self._error('undefined label '+label)
+            self.prog_pc = ( self.labels[ label[1:] ] if label != '' else 0, 0 )
+            self.prog_time = t
+            return None
+
+        if code == 'HX':
+            self.prog_pc = None
+            return None
+
+        if code == 'DM':
+            for item in rest.split(','):
+                m = re.match( r'^\s*([A-Za-z][A-Za-z0-9]*)\[(\d+)\]\s*$', item )
+                if m is None:
+                    self._error('bad argument in '+cmd)
+                name, size = m.group(1), int( m.group(2) )
+                _check_name( name )
+                if name in self.arrays:
+                    self._error('array '+name+' already dimensioned')
+                if sum( len(a) for a in self.arrays.values() ) + size > ARRAY_SPACE:
+                    self._error('not enough array space for '+name)
+                self.arrays[ name ] = [ 0. ]*size
+            return None
+
+        if code == 'DA':
+            for item in rest.split(','):
+                name = item.strip().rstrip('[]')
+                if name == '*':
+                    self.arrays = {}
+                else:
+                    self.arrays.pop( name, None )
+            return None
+
+        if code in ('BG', 'BT', 'ST', 'MO', 'SH'):
+            axes = self._axis_mask( rest )
+            if code in ('BG', 'BT'):
+                for axis in axes:
+                    if axis.moving( t ):
+                        self._error('begin not valid while running, axis '+axis.name)
+                    if not axis.servo:
+                        self._error('begin not valid with motor off, axis '+axis.name)
+            if code == 'BT':
+                for axis in axes:
+                    axis.begin_pvt( t )
+            elif code == 'BG':
+                for axis in axes:
+                    if axis.mode == 'JG':
+                        axis.start( t, speed=axis.jg )
+                    elif axis.mode == 'PA':
+                        axis.start( t, dist=axis.pa - (axis.p_rest + axis.offset) )
+                    else:
+                        axis.start( t, dist=axis.pr )
+            elif code == 'ST':
+                for axis in axes:
+                    axis.stop( t )
+            elif code == 'MO':
+                for axis in axes:
+                    axis.motor_off( t )
+            else:
+                for axis in axes:
+                    axis.servo = True
+            return None
+
+        if code in ('PA', 'PR', 'SP', 'AC', 'DC', 'JG', 'KS', 'DP'):
+            return self._set_values( code, rest, t )
+
+        if code == 'PV':
+            # PVa=p,v,t
+            name, sep, args = rest.partition('=')
+            name = name.strip().upper()
+            try:
+                dp, v, n = [ float(arg) for arg in args.split(',') ]
+            except ValueError:
+                self._error('bad PV command '+cmd)
+            if len(name) != 1 or name not in AXES or sep == '':
+                self._error('bad PV command '+cmd)
+            if n != 0 and not 2 <= n <= 2048:
+                self._error('PV time out of range '+cmd)
+            axis = self.axes[ AXES.index(name) ]
+            if axis.pvt_free( t ) <= 0:
+                self._error('PVT buffer full, axis '+name)
+            axis.queue_pvt( t, dp, v, n )
+            return None
+
+        if code in ('TE', 'TP', 'TV'):
+            if code == 'TE':
+                values = [ round( axis.error( t ) ) for axis in self.axes ]
+            elif code == 'TP':
+                values = [ round( axis.motor_position( t ) + axis.offset ) for axis in self.axes ]
+            else:
+                values = [ round( axis.motor_velocity( t ) ) for axis in self.axes ]
+            return ', '.join( '%d' % v for v in values )
+
+        if code == 'TC':
+            return '1 ' + self.last_error
+
+        if code == 'DR':
+            try:
+                self.dr_interval = int( float( rest.split(',')[0] ) )
+            except ValueError:
+                self._error('bad argument in '+cmd)
+            if self.dr_interval != 0 and not 2 <= self.dr_interval <= 30000:
+                self._error('DR period out of range '+cmd)
+            self.dr_last = t
+            return None
+
+        if code == 'MG':
+            values = [ self._evaluate( parse_expression( op ), t ) for op in rest.split(',') ]
+            return ' '.join( '%.4f' % v for v in values )
+
+        self._error('unrecognized command '+cmd)
+
+    def _operand( self, op, t ):
+        '''
+        value of a _XXa operand for MG
+        '''
+        op = op.upper()
+        if op == '_XQ0':
+            # line the program is at, -1 when it isn't running
+            return self.prog_pc[0] if self.prog_pc is not None else -1
+        if len(op) != 4 or op[0] != '_' or op[3] not in AXES:
+            self._error('unknown operand '+op)
+        axis = self.axes[ AXES.index( op[3] ) ]
+        name = op[1:3]
+        if name == 'LR':
+            return axis.reverse_limit( t )
+        if name == 'LF':
+            return axis.forward_limit( t )
+        if name == 'BG':
+            return 1 if axis.moving( t ) else 0
+        if name == 'RP':
+            return round( axis.position( t ) + axis.offset )
+        if name == 'TP':
+            return round( axis.motor_position( t ) + axis.offset )
+        if name == 'TV':
+            return round( axis.motor_velocity( t ) )
+        if name == 'TE':
+            return round( axis.error( t ) )
+        if name == 'SP':
+            return axis.sp
+        if name == 'AC':
+            return axis.ac
+        if name == 'DC':
+            return axis.dc
+        if name == 'PV':
+            return axis.pvt_free( t )
+        self._error('unknown operand '+op)
+
+    def _set_values( self, code, rest, t ):
+        '''
+        Commands of the form 'XX a,b,c,d,e' where an empty field leaves that
+        axis alone and '?' asks for its current value.
+        '''
+        args = [ arg.strip() for arg in rest.split(',') ] if rest.strip() != '' else []
+        if len(args) > len(self.axes):
+            self._error('too many arguments in '+code+rest)
+        queries = []
+        for axis, arg in zip( self.axes, args ):
+            if arg == '':
+                continue
+            if arg == '?':
+                queries.append( self._get_value( code, axis, t ) )
+                continue
+            try:
+                value = float( arg )
+            except ValueError:
+                self._error('bad argument in '+code+rest)
+            if code == 'PA':
+                axis.pa, axis.mode = value, 'PA'
+            elif code == 'PR':
+                axis.pr, axis.mode = value, 'PR'
+            elif code == 'JG':
+                axis.jg, axis.mode = value, 'JG'
+            elif code == 'SP':
+                axis.sp = abs(value)
+            elif code == 'AC':
+                axis.ac = value
+            elif code == 'DC':
+                axis.dc = value
+            elif code == 'KS':
+                axis.ks = value
+            elif code == 'DP':
+                if axis.moving( t ):
+                    self._error('DP not valid while running, axis '+axis.name)
+                axis.offset = value - axis.p_rest
+        if len(queries) == 0:
+            return None
+        return ', '.join( '%d' % q if float(q).is_integer() else '%.4f' % q for q in queries )
+
+    def _get_value( self, code, axis, t ):
+        if code == 'PA':
+            return round( axis.position( t ) + axis.offset )
+        if code == 'PR':
+            return axis.pr
+        if code == 'JG':
+            return axis.jg
+        if code == 'DP':
+            return round( axis.position( t ) + axis.offset )
+        return { 'SP' : axis.sp, 'AC' : axis.ac, 'DC' : axis.dc, 'KS' : axis.ks }[ code ]
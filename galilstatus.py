@@ -0,0 +1,219 @@
+'''
+
+galilstatus.py
+
+Reading the state of all five gantry axes at once from the controller
+data record, instead of one 'PA ?' or 'MG _LRx' query per value.
+
+The data record is the binary block the controller returns for QR, or
+sends every few samples after 'DR n'.  decode_record turns it into a
+gantrystatus holding, per axis: reference and motor position, position
+error, velocity, limit switch states, move in progress flag and stop code.
+
+Connections that offer GRecord(method) (galilsim, or a gclib build that
+wraps the C GRecord call) are read in binary.  For a plain gclib.py()
+the same values are read with one 'MG' round trip, see MG_QUERY.
+
+statusstream keeps the latest 'DR' record in the background, so
+status can be read without any round trip at all.
+
+The record layout below follows the DMC-40x0 QR table for the fields
+used here; check it against the controller manual if the firmware changes.
+'''
+
+import struct
+import threading
+import time
+
+AXES = 'ABCDE'
+
+# data record layout, all little endian
+HEADER  = '<BBH'                  # 0x80|axes flags, axes present, record length
+GENERAL = '<H10s10sBBLLHHHlHHHlH' # sample number, inputs, outputs, error code, thread status,
+                                  # amp status, contour segments, contour buffer, S plane
+                                  # segments/status/distance/buffer, T plane ...
+AXIS    = '<HBBllllllHBBl'        # status, switches, stop code, reference position, motor position,
+                                  # position error, aux position, velocity, torque, analog in,
+                                  # hall, reserved, user variable
+MOVING  = 0x8000                  # axis status bit: move in progress
+FORWARD = 0x08                    # axis switches bit: forward limit switch inactive
+REVERSE = 0x04                    # axis switches bit: reverse limit switch inactive
+
+# same values for controllers read without GRecord, one MG line per quantity
+MG_OPERANDS = ( 'RP', 'TP', 'TE', 'TV', 'LF', 'LR', 'BG' )
+MG_QUERY = ';'.join( 'MG '+','.join( '_'+op+ax for ax in AXES ) for op in MG_OPERANDS )
+
+
+class gantrystatus:
+    '''
+    Snapshot of the controller state.  All lists have one entry per axis
+    in AXES order.  lf and lr follow _LF/_LR: 1 means the switch is not
+    activated.  received is the host time the snapshot was read.
+    '''
+
+    def __init__( self, sample=0, ref=None, pos=None, err=None, vel=None, lf=None, lr=None,
+                  moving=None, stopcode=None, received=0. ):
+        n = len(AXES)
+        self.sample   = sample
+        self.ref      = ref if ref is not None else [0]*n
+        self.pos      = pos if pos is not None else [0]*n
+        self.err      = err if err is not None else [0]*n
+        self.vel      = vel if vel is not None else [0]*n
+        self.lf       = lf if lf is not None else [1]*n
+        self.lr       = lr if lr is not None else [1]*n
+        self.moving   = moving if moving is not None else [False]*n
+        self.stopcode = stopcode if stopcode is not None else [0]*n
+        self.received = received
+
+    def __str__( self ):
+        return ( 'sample '+str(self.sample)+' ref '+str(self.ref)+' pos '+str(self.pos)+' err '+str(self.err)
+                 +' vel '+str(self.vel)+' lf '+str(self.lf)+' lr '+str(self.lr)+' moving '+str(self.moving) )
+
+
+def select( status, axes ):
+    '''
+    Copy of status with its lists in the order of the axes letters, e.g.
+    'BACDE' to have the values of axis B first.
+    '''
+    index = [ AXES.index(ax) for ax in axes ]
+    fields = {}
+    for name in ( 'ref', 'pos', 'err', 'vel', 'lf', 'lr', 'moving', 'stopcode' ):
+        values = getattr( status, name )
+        fields[ name ] = [ values[i] for i in index ]
+    return gantrystatus( sample=status.sample, received=status.received, **fields )
+
+
+def encode_record( status ):
+    '''
+    Builds the binary data record of a gantrystatus (used by galilsim).
+    '''
+    naxes = len( status.ref )
+    length = struct.calcsize(HEADER) + struct.calcsize(GENERAL) + naxes*struct.calcsize(AXIS)
+    data = struct.pack( HEADER, 0x80, (1 << naxes) - 1, length )
+    data += struct.pack( GENERAL, status.sample & 0xffff, bytes(10), bytes(10), 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0 )
+    for i in range( naxes ):
+        axis_status = MOVING if status.moving[i] else 0
+        switches = ( FORWARD if status.lf[i] else 0 ) | ( REVERSE if status.lr[i] else 0 )
+        data += struct.pack( AXIS, axis_status, switches, status.stopcode[i], int(status.ref[i]), int(status.pos[i]),
+                             int(status.err[i]), 0, int(status.vel[i]), 0, 0, 0, 0, 0 )
+    return data
+
+
+def decode_record( data, received=None ):
+    '''
+    Turns a binary data record into a gantrystatus.
+    '''
+    if received is None:
+        received = time.time()
+    flags, axes_present, length = struct.unpack_from( HEADER, data, 0 )
+    if len(data) < length:
+        raise ValueError('data record too short: %d of %d bytes' % (len(data), length))
+    offset = struct.calcsize(HEADER)
+    general = struct.unpack_from( GENERAL, data, offset )
+    offset += struct.calcsize(GENERAL)
+    status = gantrystatus( sample=general[0], received=received )
+    for i in range( len(AXES) ):
+        if not axes_present & (1 << i):
+            continue
+        fields = struct.unpack_from( AXIS, data, offset )
+        offset += struct.calcsize(AXIS)
+        status.moving[i]   = bool( fields[0] & MOVING )
+        status.lf[i]       = 1 if fields[1] & FORWARD else 0
+        status.lr[i]       = 1 if fields[1] & REVERSE else 0
+        status.stopcode[i] = fields[2]
+        status.ref[i]      = fields[3]
+        status.pos[i]      = fields[4]
+        status.err[i]      = fields[5]
+        status.vel[i]      = fields[7]
+    return status
+
+
+def from_mg( res, received=None ):
+    '''
+    Turns the response to MG_QUERY into a gantrystatus.
+    '''
+    if received is None:
+        received = time.time()
+    values = [ float(v) for v in res.replace(':',' ').split() ]
+    n = len(AXES)
+    if len(values) != n*len(MG_OPERANDS):
+        raise ValueError('unexpected status response: '+res)
+    rows = [ values[k*n:(k+1)*n] for k in range( len(MG_OPERANDS) ) ]
+    ref, pos, err, vel, lf, lr, bg = rows
+    return gantrystatus( ref=[ int(v) for v in ref ], pos=[ int(v) for v in pos ], err=[ int(v) for v in err ],
+                         vel=[ int(v) for v in vel ], lf=[ int(v) for v in lf ], lr=[ int(v) for v in lr ],
+                         moving=[ v != 0 for v in bg ], received=received )
+
+
+class statusstream:
+    '''
+    Background thread reading the data records the controller sends
+    after 'DR n', keeping the latest one.
+
+    Usage:
+
+      > stream = statusstream( g )        # g: connection with GRecord
+      > stream.latest()                   # newest gantrystatus
+      > stream.wait( lambda st : not any(st.moving) )   # wait for a condition
+      > stream.stop()
+    '''
+
+    def __init__( self, g ):
+        self.g = g
+        self.status = None
+        self.count = 0          # records received so far
+        self.error = None
+        self.running = True
+        self.cond = threading.Condition()
+        self.thread = threading.Thread( target=self._run, daemon=True )
+        self.thread.start()
+
+    def _run( self ):
+        while self.running:
+            try:
+                status = decode_record( self.g.GRecord('DR') )
+            except Exception as ex:
+                with self.cond:
+                    self.error = ex
+                    self.running = False
+                    self.cond.notify_all()
+                return
+            with self.cond:
+                self.status = status
+                self.count += 1
+                self.cond.notify_all()
+
+    def latest( self ):
+        '''
+        Newest record, waits for the first one if none arrived yet.
+        '''
+        with self.cond:
+            while self.status is None and self.running:
+                self.cond.wait()
+            if self.status is None:
+                raise RuntimeError('status stream stopped: '+str(self.error))
+            return self.status
+
+    def wait( self, condition, timeout=None ):
+        '''
+        Waits until condition( status ) is true for a record sent after
+        this call, so commands sent before it are already reflected.
+        Returns that status, or None on timeout.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            # the next record may have left the controller before our call
+            first = self.count + 2
+            while True:
+                if self.count >= first and condition( self.status ):
+                    return self.status
+                if not self.running:
+                    raise RuntimeError('status stream stopped: '+str(self.error))
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.cond.wait( remaining )
+
+    def stop( self ):
+        self.running = False
+        self.thread.join( 1. )
@@ -1,17 +1,40 @@
+import os
 import sys
 import string
-import gclib
 import time
+import posjournal
+import calibration
+import trajectory
+import galilstatus
+import scanplan
+import dmcprogram
+try:
+  import gclib
+except ImportError:
+  gclib = None # only needed for the real controller, see galilsim.py for a simulated one
 
 
 
 
 
+PVT_BUFFER = 255 # PVT segments the controller buffers per axis
+AXES = 'ABCDE'    # controller axes, in the order of the comma separated commands
+ADDRESS = '192.168.42.10 -s ALL' # GOpen address of the gantry controller
+CACHED_COMMANDS = ('SP','AC','DC','KS') # settings remembered to avoid sending them again
+
+class GantryError(Exception):
+  '''
+  Raised instead of exiting when a controller call fails and the
+  gantrycontrol was made with exit_on_error=False. The motors are off.
+  '''
+  pass
+
 class gantrycontrol:
   """
   gantrycontrol is a class to control the gantry motion in 0RC39.
 
-  It assumes the last saved position in 'fname' passed to the class is correct.
+  It assumes the last saved position in the position journal (see posjournal.py),
+  or in 'fname' passed to the class if there is no journal yet, is correct.
   If it isn't you can call
 
   Usage:
@@ -30,130 +53,459 @@ class gantrycontrol:
   > gantry.move( -1,-1,-1,1000 )      # move the gantry in theta by 1000 mm from the origin.
   > gantry.move( -1,-1,-1,-1,1000 )   # move the gantry in phi by 1000 mm from the origin.
   > gantry.move( 10,20,30,40,50,1,2,3,4,5 ) # move x axis 10 mm with speed 1 cts/s, y axis 20 mm with speed 2 cts/s...
+                                      # Without speeds every axis gets its own SP/AC/DC so that all arrive together,
+                                      # as fast as gantry.max_speed and gantry.max_accel (per axis, counts) allow.
+  > gantry.move( 10,20,30, predict=True ) # only returns the predicted move time (s), nothing moves
   > gantry.move_rel( 1000 )           # move the gantry in x by 1000 steps from the current position
   > gantry.move_rel( 0, 1000 )     # move the gantry in y by 1000 steps from the current position
   > gantry.move_rel( 0, 0, 1000 )     # move the gantry in z by 1000 steps from the current position
   > gantry.move_rel( 0, 0, 0,1000 )   # move the gantry in theta by 1000 steps from the current position
   > gantry.move_rel( 0, 0, 0,0,1000 ) # move the gantry in phi by 1000 steps from the current position
   > gantry.move_rel( 1, 2, 3,4,5,2,3,4,5,6 ) # move x axis 1 count with speed 2counts/s, axis y 2 counts with speed 2counts/s...
+  > gantry.move_rel( 1000, 500, predict=True ) # predicted time (s) of that relative move, nothing moves
   > gantry.move_rel_mm(0,0,1000)      # moves z axis 1000 mm from current position. Same format as gantry.move_rel but unit is mm.
+  > gantry.move_trajectory( [(1000,0,0,0,0),(2000,500,0,0,0)], dwell=0.5 ) # go through a list of points (counts) as one
+                                      # buffered motion, stopping 0.5 s at each. Returns the time each point is reached.
+  > gantry.move_trajectory_mm( [(10,0,0,0,0),(20,5,0,0,0)] ) # same as move_trajectory with points in mm
   > gantry.locate_home_xyz()          # jog the gantry to home (0,0,0)
+  > gantry.locate_home()              # home all five axes, fast approach then slow latch of the limit switches
+  > gantry.locate_home('DE',repeat=3) # home theta and phi, latching 3 more times to measure repeatability
+  > gantry.last_homing                # time, round trips, offset and repeatability of the last homing
+  > gantry.send('SP 500','PR 100','BG') # send several commands in one round trip
+  > gantry.round_trips                # GCommand round trips so far
+  > gantry.last_round_trips           # GCommand round trips used by the last move/homing
+  > gantry.read_status()              # galilstatus.gantrystatus: positions, velocities, limits, moving flags
+  > gantry.start_status_stream(0.05)  # keep the status updated from a data record every 0.05 s
+  > gantry.stop_status_stream()
+  > gantry.run_scan_program( points, settle=0.1, exposure=1. ) # the controller runs the whole scan (dmcprogram.py),
+                                      # pulsing output 1 to trigger the cameras at each point
+  > gantry.start_scan_program( points ) # same without waiting, then
+  > gantry.scan_progress()            # (photos triggered, done, running), or
+  > gantry.wait_scan_program( on_point ) # calls on_point(i) as each photo is triggered
+  > import galilsim                   # or use a simulated controller instead of the gantry:
+  > gantry = gl.gantrycontrol( galil=galilsim.galilsim() )
+  > gantry = gl.gantrycontrol( exit_on_error=False ) # raise GantryError on controller errors instead of exiting
+  > gantry = gl.gantrycontrol( 'stand2_last_position.txt', address='192.168.42.11 -s ALL', axes='BACDE' )
+                                      # a second stand: its own controller, position files and axis
+                                      # map (controller axes of x,y,z,theta,phi), see scancoordinator.py
+  > gantry.recover()                  # motors back on after a GantryError, to retry
   > del gantry                        # done using gantry, delete object (closes connections)
   """
 
-  def __init__(self, fname='galil_last_position.txt'):
-    self.g = gclib.py() #make an instance of the gclib python class
-    self.c = self.g.GCommand #alias the command callable
+  def __init__(self, fname='galil_last_position.txt', galil=None, journalname=None, calibrationfile=None, exit_on_error=True,
+               address=ADDRESS, axes=AXES):
+    '''
+    galil is the controller connection to use. None means make a gclib.py()
+    instance for the real controller, anything with the same interface
+    (e.g. galilsim.galilsim()) can be passed instead.
+    journalname is the position journal, fname with .journal instead of
+    its extension by default.
+    calibrationfile holds the mm to counts calibration (see calibration.py),
+    the built in scale factors are used if it is None.
+    exit_on_error: after a controller error the motors are stopped and turned
+    off, then the program exits, or GantryError is raised if this is False.
+    address is what the connection is opened with (GOpen).
+    axes are the controller axes of x, y, z, theta and phi, in that order:
+    e.g. 'BACDE' if x is wired to B and y to A. All positions, speeds and
+    statuses of gantrycontrol are in x,y,z,theta,phi order whatever the map.
+    '''
+    if len(axes) != len(AXES) or sorted(axes) != sorted(AXES):
+      raise ValueError('axes must be the controller axes '+AXES+' in the order of x,y,z,theta,phi, not '+axes)
+    if galil is None:
+      galil = gclib.py() #make an instance of the gclib python class
+    self.g = galil
+    self.c = self.command #alias the command callable
+    self.address = address
+    self.axes = axes          # controller axis of x,y,z,theta,phi
+    self.order = [ axes.index(ax) for ax in AXES ] # axis (x=0 ... phi=4) of each controller axis in AXES
+    self.exit_on_error = exit_on_error
     self.file_galilpos = fname
+    if journalname is None:
+      journalname = os.path.splitext(fname)[0]+'.journal'
+    self.journal = posjournal.posjournal(journalname)
+    if calibrationfile is None:
+      self.cal = calibration.calibration()
+    else:
+      self.cal = calibration.load(calibrationfile)
+    self.round_trips = 0      # GCommand calls made
+    self.last_round_trips = 0 # GCommand calls made by the last move, move_rel, trajectory or homing
+    self.state = {}           # last values sent for the CACHED_COMMANDS, code : [5 values]
+    self.pos = None           # last position read from the controller or reached by a move (counts)
+    self.stream = None        # galilstatus.statusstream when the data record is streamed
+    self.stream_stale = False # a command was sent since the latest streamed record
+    self.settle_tolerance = [5,5,5,5,5]      # position error (counts) accepted as settled, per axis
+    self.settle_velocity = [20,20,20,20,20]  # motor velocity (counts/s, TV) accepted as at rest, per axis
+    self.settle_samples = 3                  # consecutive status samples an axis must be settled for
+    self.settle_timeout = [2.,2.,2.,2.,2.]   # seconds to wait for each axis to settle
+    self.max_speed = [1000,1000,1000,1000,1000]                 # mechanical speed limit per axis (counts/s)
+    self.max_accel = [256000,256000,256000,256000,256000]       # mechanical acceleration limit per axis (counts/s^2)
+    self.home_speed = [1000,1000,1000,1000,1000]     # homing approach and back off speed (counts/s), at most max_speed
+    self.home_latch_speed = [500,500,500,250,250]    # speed the limit switch is latched with (counts/s), at most max_speed
+    self.home_backoff = [500,500,500,250,250]        # distance backed off the limit switch (counts)
+    self.last_homing = None   # report of the last locate_home
+    self.homed = ''           # controller axes homed since connecting
+    self.connect_position = None # controller motor positions before load_position, x..phi (counts)
+    self.saved_position = None   # position loaded by load_position, x..phi (counts)
 
     print('gclib version:', self.g.GVersion())
-    self.g.GOpen('192.168.42.10 -s ALL')
+    self.g.GOpen(self.address)
     print( self.g.GInfo() )
     self.load_position( ) # assume we are at last saved position
 
-    print('Enable motors')
-    self.c('SH') #Enable the motor
-
-    print('Set smoothing on theta,phi axes')
-    self.c('KS ,,,25,25')
+    print('Enable motors and set smoothing on theta,phi axes')
+    self.send( 'SH', self.axes_command('KS',(None,None,None,25,25)) )
 
     print(' done.')
 
 
+  def command(self,command):
+    '''
+    Send command to the controller (one round trip) and return its response.
+    Values set by the CACHED_COMMANDS are remembered once the command
+    succeeded, see axes_command. If it fails they are forgotten, as part of
+    the command may have run.
+    '''
+    self.round_trips += 1
+    self.stream_stale = True
+    sent = [] # (code, gantry axis index, value) set by the command
+    for cmd in command.split(';'):
+      cmd = cmd.strip()
+      code = cmd[:2].upper()
+      if code in CACHED_COMMANDS and '?' not in cmd:
+        for k,arg in enumerate( cmd[2:].split(',')[:len(AXES)] ):
+          if arg.strip() != '':
+            try:
+              sent.append( (code, self.order[k], float(arg)) )
+            except ValueError:
+              sent.append( (code, self.order[k], None) ) # set from a variable, value not known
+    try:
+      response = self.g.GCommand(command)
+    except:
+      for code,i,value in sent:
+        self.state.setdefault( code, [None]*len(AXES) )[i] = None
+      raise
+    for code,i,value in sent:
+      self.state.setdefault( code, [None]*len(AXES) )[i] = value
+    return response
+
+  def send(self,*commands):
+    '''
+    Send several commands joined by ';' in one round trip.
+    Empty commands are skipped, nothing is sent if all are empty.
+    '''
+    commands = [ cmd for cmd in commands if cmd ]
+    if len(commands) == 0:
+      return ''
+    return self.c( ';'.join(commands) )
+
+  def axes_command(self,code,values):
+    '''
+    Returns the command that sets values (one per axis, None to leave the axis
+    alone) with code, e.g. 'SP 1000,,500', leaving out axes that already have
+    that value. Returns '' if nothing has to change.
+    '''
+    known = self.state.get( code, [None]*len(AXES) )
+    return self.positional( code, [ None if value == old else value for value,old in zip(values,known) ] )
+
+  def positional(self,code,values,format='%g'):
+    '''
+    Returns command code with values given in x,y,z,theta,phi order (None to
+    leave an axis out) put in the order of the controller axes, e.g.
+    'PR 100,,5'. Returns '' if all values are None.
+    '''
+    args = [ '' if values[i] is None else format%values[i] for i in self.order ]
+    while len(args) > 0 and args[-1] == '':
+      args.pop()
+    if len(args) == 0:
+      return ''
+    return code+' '+','.join(args)
+
+  def forget_state(self):
+    '''
+    Forget the cached settings, they are all sent again next time.
+    '''
+    self.state = {}
+
+  def fail(self,message,stop='ST;MO'):
+    '''
+    Called from the except block of a failed motion: stops and turns off
+    the motors (with the stop command), prints the position error, then
+    exits or raises GantryError (see exit_on_error).
+    '''
+    error = sys.exc_info()[1]
+    print(message,':',error)
+    try:
+      self.c(stop)
+      print('position error:',self.c('TE'))
+    except Exception as ex:
+      print('could not stop the motors:',ex)
+    if self.exit_on_error:
+      exit()
+    if isinstance(error,KeyboardInterrupt):
+      raise
+    raise GantryError(message+': '+str(error))
+
+  def recover(self):
+    '''
+    Turn the motors back on after a fail and read the position again, so
+    a failed move can be retried.
+    '''
+    self.forget_state()
+    self.send( 'SH', self.axes_command('KS',(None,None,None,25,25)) )
+    return self.get_cur_pos()
+
+
   def __del__(self):
     '''
     Destructor saves position and closes connection
     '''
+    if not hasattr(self,'g'):
+      return # __init__ failed before connecting
+    if self.stream is not None:
+      self.stop_status_stream()
+    self.journal.close()
     self.g.GClose()
 
 
+  def read_status(self):
+    '''
+    Returns a galilstatus.gantrystatus with the state of all axes.
+    If the data record is streamed this is the latest record and costs no
+    round trip, otherwise one record is asked for (QR, or one MG line for
+    connections without GRecord).
+    '''
+    if self.stream is not None:
+      if self.stream_stale:
+        # wait for a record that includes the commands sent since the last one
+        self.stream_stale = False
+        return self.axes_status( self.stream.wait( lambda status : True ) )
+      return self.axes_status( self.stream.latest() )
+    if hasattr(self.g,'GRecord'):
+      self.round_trips += 1
+      return self.axes_status( galilstatus.decode_record( self.g.GRecord('QR') ) )
+    return self.axes_status( galilstatus.from_mg( self.c(galilstatus.MG_QUERY) ) )
+
+  def axes_status(self,status):
+    '''
+    status of the controller axes with its lists in x,y,z,theta,phi order
+    '''
+    if self.axes == AXES:
+      return status
+    return galilstatus.select( status, self.axes )
+
+  def start_status_stream(self,interval=0.05):
+    '''
+    Have the controller send its data record every interval seconds and keep
+    the latest one, see read_status. Needs a connection with GRecord.
+    '''
+    if not hasattr(self.g,'GRecord'):
+      print('controller connection has no GRecord, status stays polled')
+      return
+    samples = min( max( int(round(interval*trajectory.SAMPLE_RATE)), 2 ), 30000 )
+    self.c('DR %d'%samples)
+    self.stream = galilstatus.statusstream(self.g)
+
+  def stop_status_stream(self):
+    self.stream.stop()
+    self.stream = None
+    self.c('DR 0')
+
+  def motion_complete(self,axes=None):
+    '''
+    Wait until the controller axes have stopped (all of the gantry by default).
+    Uses the streamed data record if there is one, GMotionComplete otherwise.
+    '''
+    if axes is None:
+      axes = self.axes
+    if self.stream is None:
+      self.g.GMotionComplete(axes)
+      return
+    index = [ AXES.index(ax) for ax in axes ] # the streamed records are in controller order
+    self.stream.wait( lambda status : not any( status.moving[i] for i in index ) )
+
+  def wait_settled(self,axes=None,tolerance=None,timeout=None,poll=0.05):
+    '''
+    Wait until the motion of the controller axes is complete (all of the
+    gantry by default) and every axis has settled: position error within
+    tolerance counts and motor velocity within settle_velocity counts/s,
+    for settle_samples status samples in a row.
+    The status is sampled every poll seconds, or on every streamed record
+    if there is a status stream (no round trips).
+    tolerance and timeout (s, counted from the end of the motion) are per
+    axis lists, settle_tolerance and settle_timeout by default. An axis that
+    does not settle within its timeout is given up on.
+    Returns the axes that did not settle, '' if all did.
+    '''
+    if tolerance is None:
+      tolerance = self.settle_tolerance
+    if timeout is None:
+      timeout = self.settle_timeout
+    if axes is None:
+      axes = self.axes
+    self.motion_complete(axes)
+    start = time.time()
+    inside = dict( (self.axes.index(ax),0) for ax in axes ) # consecutive settled samples, per axis waited for
+    unsettled = ''
+    while len(inside) > 0:
+      if self.stream is not None:
+        self.stream_stale = False
+        status = self.axes_status( self.stream.wait( lambda status : True ) ) # next record
+      else:
+        status = self.read_status()
+      elapsed = time.time() - start
+      for i in list(inside):
+        if abs(status.err[i]) <= tolerance[i] and abs(status.vel[i]) <= self.settle_velocity[i] and not status.moving[i]:
+          inside[i] += 1
+          if inside[i] >= self.settle_samples:
+            del inside[i]
+          continue
+        inside[i] = 0
+        if elapsed > timeout[i]:
+          print('axis',self.axes[i],'not settled after',timeout[i],'s, position error',status.err[i])
+          unsettled += self.axes[i]
+          del inside[i]
+      if len(inside) > 0 and self.stream is None:
+        time.sleep(poll)
+    return unsettled
+
+
   def print_position(self,message='Positon: '):
     '''
       print position of gantry
     '''
-    print( message + self.c('PA ?,?,?,?,?') )
+    res = self.c('PA ?,?,?,?,?').split(',')
+    print( message + ', '.join( res[AXES.index(ax)].strip() for ax in self.axes ) )
 
-  def save_position(self):
+  def save_position(self,res=None):
     '''
-    Read the current position from the galil and save it to file.
+    Save the position to the position journal. res is a 'PA ?,?,?,?,?' style
+    string, the current position is read from the galil if not given.
+    The record is written to disk in the background, see posjournal.py.
     '''
-    res = self.c('PA ?,?,?,?,?')
-    print(self.file_galilpos)
-    f = open(self.file_galilpos,'w')
-    f.write(res)
-    f.close()
-    print('wrote (x,y,z,phi,theta) to galil_last_position.txt: ',res)
+    if res is None:
+      res = self.format_position( self.get_cur_pos() )
+    self.journal.append( [ float(v) for v in res.split(',') ] )
+    print('saved (x,y,z,theta,phi) to',self.journal.fname,': ',res)
 
   def load_position(self):
     '''
-    Load position from file
+    Load position from the journal, or from the old position file if the
+    journal has none. The controller position is left alone if neither has
+    a valid position. The position the controller counted before is kept
+    in connect_position, the one loaded in saved_position.
     '''
-    f = open(self.file_galilpos,'r')
-    res = f.readline()
-    command = 'DP '+res
+    self.connect_position = list( self.read_status().pos )
+    pos = self.journal.recover()
+    if pos is None and os.path.exists(self.file_galilpos):
+      f = open(self.file_galilpos,'r')
+      res = f.readline()
+      f.close()
+      try:
+        pos = [ float(v) for v in res.split(',') ]
+      except ValueError:
+        pos = None
+      if pos is not None and len(pos) != 5:
+        pos = None
+    if pos is None:
+      print('No saved position found, run locate_home_xyz() before trusting positions')
+      return
+    self.saved_position = list(pos)
+    command = self.positional( 'DP', pos, '%d' )
     print('Loading position with command =',command)
     self.c(command)
 
 
   def locate_home_xyz(self):
     '''
-      Jogs the gantry until it hits the limit switches.
-      Defines that as 0,0,0 in xyz
-      Writes the position to file
+      Homes the x, y and z axes, see locate_home.
+    '''
+    return self.locate_home(self.axes[:3])
+
+  def locate_home(self,axes=None,repeat=0):
+    '''
+      Jogs the controller axes (all of the gantry by default) to their
+      reverse limit switches and defines that as 0.
+      Each axis approaches the switch at home_speed, backs off home_backoff
+      counts and comes back at home_latch_speed (both limited to max_speed),
+      so the switch is always reached at the same low speed. Axes already on their switch skip the
+      fast approach. The limit switches of all axes are read in one query.
+      With repeat > 0 the back off and slow latch are done that many more
+      times, and the largest distance from 0 found is reported as the
+      repeatability of each axis.
+      Writes the position to the journal and returns a report dictionary
+      (also kept in last_homing): time (s), round trips, offset (position
+      before homing, counts, i.e. how far the saved position was off) and
+      repeatability (counts, None without repeat).
     '''
+    if axes is None:
+      axes = self.axes
     try:
+      n0 = self.round_trips
+      t0 = time.time()
+      index = [ self.axes.index(ax) for ax in axes ]
+      def values(per_axis): # per_axis values of the homed axes, None for the others
+        return [ per_axis[i] if i in index else None for i in range(len(AXES)) ]
+      speed = [ min(s,m) for s,m in zip(self.home_speed,self.max_speed) ]
+      latch_speed = [ min(s,m) for s,m in zip(self.home_latch_speed,self.max_speed) ]
       self.print_position('before homing: ')
-      '''
-      Checking limit switch status _LRA variable contains limit switch status of reverse limit switch in axis  A.
-      If the limit switch is already activated  that axis is already at home so we don't want to move it.
-      '''
 
-      RLA_status = float(self.c('MG _LRA'))==1.0 #1 means limit switch not activated
-      RLB_status = float(self.c('MG _LRB'))==1.0
-      RLC_status = float(self.c('MG _LRC'))==1.0
-      print('abc status = ',RLA_status,RLB_status , RLC_status )
-      x_speed = -1000 if RLA_status else 0
-      y_speed = -1000 if RLB_status else 0
-      z_speed = -1000 if RLC_status else 0
-      print('speed = ',x_speed, y_speed, z_speed)
-      command = 'JG %g,%g,%g,%g,%g'% (x_speed, y_speed, z_speed, 0, 0)
-      self.c(command)
-      axes = ''
-      axes = 'A' if RLA_status else axes
-      axes = axes+'B' if RLB_status else axes
-      axes = axes+'C' if RLC_status else axes
-      print('axes to stop = '+ axes)
-      if len(axes)>0:
-        command = 'BG'+axes
-        self.c(command) # only BG the axes that have speed otherwise the value of _BGX for X axis will stay 1.
+      # _LR is 1 when the reverse limit switch is not activated: those axes approach fast
+      status = self.read_status()
+      print('reverse limit switches (1 = not activated) = ',status.lr)
+      approach = ''.join( self.axes[i] for i in index if status.lr[i] == 1 )
+      if len(approach) > 0:
+        fast = self.axes_command( 'JG', [ -speed[i] if self.axes[i] in approach else None for i in range(len(AXES)) ] )
+        print('fast approach of',approach,':',fast)
+        # only BG the axes that have speed otherwise the value of _BGX for X axis will stay 1.
+        self.send( fast, 'BG'+approach )
+        self.motion_complete(approach)
+
+      latched = []
+      for k in range( repeat+1 ):
+        # back off the switch, then latch it again slowly
+        self.send( self.axes_command('SP',values(speed)), self.axes_command('PR',values(self.home_backoff)), 'BG'+axes )
+        self.motion_complete(axes)
+        status = self.read_status()
+        stuck = [ self.axes[i] for i in index if status.lr[i] == 0 ]
+        if len(stuck) > 0:
+          raise RuntimeError('reverse limit switch still active after backing off, axes '+''.join(stuck))
+        slow = [ -v if v is not None else None for v in values(latch_speed) ]
+        self.send( self.axes_command('JG',slow), 'BG'+axes )
+        self.wait_settled(axes)
+        status = self.read_status()
+        missed = [ self.axes[i] for i in index if status.lr[i] != 0 ]
+        if len(missed) > 0:
+          raise RuntimeError('reverse limit switch not reached, axes '+''.join(missed))
+        if k == 0:
+          offset = [ status.ref[i] for i in index ]
+          self.c( self.axes_command('DP',values([0]*len(AXES))) )
+        else:
+          latched.append( [ status.ref[i] for i in index ] )
 
-      self.g.GMotionComplete('ABCDE')
-      time.sleep(1)
-      self.c('DP 0,0,0')
       self.print_position('after homing: ')
       self.save_position()
+      self.journal.flush()
+      self.homed += ''.join( ax for ax in axes if ax not in self.homed )
+      self.last_round_trips = self.round_trips - n0
+      repeatability = None
+      if len(latched) > 0:
+        repeatability = [ max( abs(pos[j]) for pos in latched ) for j in range(len(index)) ]
+      self.last_homing = { 'axes' : axes, 'time' : time.time() - t0, 'round_trips' : self.last_round_trips,
+                           'offset' : offset, 'repeatability' : repeatability }
+      print('homing of %s took %.2f s, %d round trips, offset before homing %s, repeatability %s'%(
+        axes, self.last_homing['time'], self.last_round_trips, offset, repeatability))
+      return self.last_homing
     except:
-      print('Homing failed.  Disabling motor')
-      self.c('ST;MO')
-      self.c('TE')
-      exit()
+      self.fail('Homing failed.  Disabling motor')
 
-  #converts from mm to counts
+  #converts from mm to counts, see self.cal.to_counts for whole trajectories
   def convert(self,x,y,z,theta,phi):
-    x=round(x/0.01113)#round((x-0.195)/0.01113)
-    y=round(y/0.009382)#round((y-0.375)/0.009382)
-    z=round(z/0.009355)#round((z-0.126)/0.009355)
-    theta=round(theta/0.0226)#round((theta-0.44)/0.0226)
-    phi=round(phi/0.02259)#round((phi-0.5357)/0.02259)
+    x,y,z,theta,phi = self.cal.to_counts( (x,y,z,theta,phi) )[0].tolist()
     return x,y,z,theta,phi
 
-  # converts counts to mm
+  # converts counts to mm, see self.cal.to_mm for whole trajectories
   def unconvert(self,curx,cury,curz,curtheta,curphi):
-    x = 0.01113*curx
-    y = 0.009382*cury
-    z = 0.009355*curz
-    theta = 0.0226*curtheta
-    phi = 0.02259*curphi
+    x,y,z,theta,phi = self.cal.to_mm( (curx,cury,curz,curtheta,curphi) )[0].tolist()
     return x,y,z,theta,phi
 
   # returns current position in mm
@@ -167,16 +519,15 @@ class gantrycontrol:
     x,y,z,theta,phi = self.get_cur_pos_mm()
     print('current (x,y,z,theta,phi) (mm) =',x,y,z,theta,phi )
 
-  # returns current position in counts
+  # returns current position in counts, from the controller status
   def get_cur_pos(self):
-    res = self.c('PA ?,?,?,?,?')
-    curx,cury,curz,curtheta,curphi = res.split(',')
-    curx = float(curx)
-    cury = float(cury)
-    curz = float(curz)
-    curtheta = float(curtheta)
-    curphi = float(curphi)
-    return curx,cury,curz,curtheta,curphi
+    status = self.read_status()
+    self.pos = tuple( float(p) for p in status.ref )
+    return self.pos
+
+  # formats a position in counts like a 'PA ?,?,?,?,?' response
+  def format_position(self,pos):
+    return ', '.join( '%d'%p for p in pos )
 
   #Prints current position in counts
   def print_cur_pos(self):
@@ -205,42 +556,56 @@ class gantrycontrol:
   '''
 
 
-  def move(self,x=-1,y=-1,z=-1,theta=-1,phi=-1,spx=1000,spy=1000,spz=1000,sptheta=1000,spphi=1000):
+  def motion_settings(self,dist,speeds):
+    '''
+    Returns (commands, seconds): the SP/AC/DC commands for a move of dist
+    counts on each axis and its predicted duration.
+    If all speeds are None every moving axis gets the speed and acceleration
+    that make all axes arrive together, as fast as max_speed and max_accel
+    allow (see trajectory.axis_settings). Otherwise each moving axis runs on
+    its own at its speed (max_speed if None) with the acceleration it has.
+    Only values that changed are sent, see axes_command.
+    '''
+    if all( sp is None for sp in speeds ):
+      sp, ac, seconds = trajectory.axis_settings( dist, self.max_speed, self.max_accel )
+      return [ self.axes_command('SP',sp), self.axes_command('AC',ac), self.axes_command('DC',ac) ], seconds
+    sp = [ ( s if s is not None else m ) for s,m in zip(speeds,self.max_speed) ]
+    known = self.state.get( 'AC', [None]*len(AXES) )
+    ac = [ ( a if a is not None else m ) for a,m in zip(known,self.max_accel) ]
+    seconds = float( scanplan.move_times( [0]*len(AXES), dist, sp, ac ) )
+    return [ self.axes_command( 'SP', [ s if d != 0 else None for s,d in zip(sp,dist) ] ) ], seconds
+
+  def move(self,x=-1,y=-1,z=-1,theta=-1,phi=-1,spx=None,spy=None,spz=None,sptheta=None,spphi=None,predict=False):
     '''
     move to absolute position and angle
     x,y,z in mm
     theta,phi in degrees
     default value is set to -1. -1 means don't move that axis. Can't use zero because it would mean move to absolute position 0.
+    speeds in counts/s; if none is given the axes are synchronized, see motion_settings.
+    The speed, position and begin commands go in one round trip, speeds are only sent if they changed.
+    Returns the predicted move time in s. With predict=True nothing moves.
     '''
     try:
-      #check if we don't want to move some axis
-      curx,cury,curz,curtheta,curphi = self.get_cur_pos()
-      #-1 means don't move that axis.
-      if x==-1:
-        x=curx
-      if y==-1:
-        y=cury
-      if z==-1:
-        z=curz
-      if theta==-1:
-        theta=curtheta
-      if phi==-1:
-        phi=curphi
-
-      #setting up speed
-      command = 'SP %g,%g,%g,%g,%g'% (spx,spy,spz,sptheta,spphi)
-      print('SPEED COMMAND : ',command)
-      self.c( command )
-
-      print('current speed', self.c('SP ?,?,?,?,?'))
+      n0 = self.round_trips
+      #-1 means don't move that axis: it is left out of the PA and BG commands
+      target = [x,y,z,theta,phi]
+      moving = [ value != -1 for value in target ]
+      axes = ''.join( self.axes[i] for i in range(len(AXES)) if moving[i] )
 
       # converting mm to counts
-      x,y,z,theta,phi = self.convert(x,y,z,theta,phi)
-
-      #Sending absolute move command
-      command = 'PA %g,%g,%g,%g,%g'% (x,y,z,theta,phi)
+      counts = self.convert( *[ value if m else 0 for value,m in zip(target,moving) ] )
+
+      #setting up speed of the axes that move, from the last known position
+      cur = self.pos if self.pos is not None else self.get_cur_pos()
+      dist = [ counts[i] - cur[i] if moving[i] else 0 for i in range(len(AXES)) ]
+      settings, seconds = self.motion_settings( dist, [spx,spy,spz,sptheta,spphi] )
+      print('SPEED COMMAND : ',settings,' predicted move time %.2f s'%seconds)
+      if predict:
+        return seconds
+
+      #absolute move command
+      command = self.positional( 'PA', [ cnt if m else None for cnt,m in zip(counts,moving) ] )
       print('try running in move: ',command)
-      self.c( command )
 
       '''
       #checking if the motion is completed. 0 means completed and 1 means not completed.
@@ -261,50 +626,197 @@ class gantrycontrol:
       if len(axes)>0:
         self.c('BG'+axes) # Begin only if there is any axes to begin
       '''
-      self.c('BG')
-      self.g.GMotionComplete('ABCDE') # check if the motion has completed
+      if len(axes)>0:
+        self.send( *settings, command, 'BG'+axes )
+        self.wait_settled(axes) # wait for the motion to complete and the axes to settle
+        self.pos = tuple( float(counts[i]) if moving[i] else cur[i] for i in range(len(AXES)) )
+      self.last_round_trips = self.round_trips - n0
+      return seconds
 
     except:
-      print("error returned by the controller during move command")
-      #will implement code to print the error returned by controller in future
-      self.c('ST;MO')
-      self.c('TE')
-      exit()
+      self.fail("error returned by the controller during move command")
 
   #move x(counts) relative to current position
-  def move_rel(self,x=0,y=0,z=0,theta=0,phi=0,spx=1000,spy=1000,spz=1000,sptheta=1000,spphi=1000):
+  def move_rel(self,x=0,y=0,z=0,theta=0,phi=0,spx=None,spy=None,spz=None,sptheta=None,spphi=None,predict=False):
     '''
     move relative distance x,y,z,theta,phi from current location
     distances are in motor steps
+    speeds in counts/s; if none is given the axes are synchronized, see motion_settings.
     saves position to file after moving
+    The speed, distance and begin commands go in one round trip, speeds are only sent if they changed.
+    Returns the predicted move time in s. With predict=True nothing moves.
     '''
     try:
+      n0 = self.round_trips
+      dist = (x,y,z,theta,phi)
       #setting up speed
-      command = 'SP %g,%g,%g,%g,%g'% (spx,spy,spz,sptheta,spphi)
-      self.c( command )
-
-      self.print_cur_pos()
+      settings, seconds = self.motion_settings( dist, [spx,spy,spz,sptheta,spphi] )
+      if predict:
+        return seconds
 
-      command = 'PR %g,%g,%g,%g,%g'% (x,y,z,theta,phi)
-      print('try running: ',command)
-      self.c( command )
-      self.c('BG')
-      self.g.GMotionComplete('ABCDE')
-      time.sleep(1)
+      axes = ''.join( self.axes[i] for i in range(len(AXES)) if dist[i] != 0 )
+      command = self.positional( 'PR', dist )
+      print('try running: ',command,' predicted move time %.2f s'%seconds)
+      if len(axes)>0:
+        self.send( *settings, command, 'BG'+axes )
+        self.wait_settled(axes)
 
-      self.print_cur_pos()
-      self.save_position()
+      pos = self.get_cur_pos()
+      print('current (x,y,z,theta,phi) (counts)=',*pos)
+      self.save_position( self.format_position(pos) )
+      self.last_round_trips = self.round_trips - n0
+      return seconds
 
     except:
-      print("error returned by the controller during relative move command")
-      #will implement code to print the error returned by controller in future
-      self.c('ST;MO')
-      self.c('TE')
-      exit()
+      self.fail("error returned by the controller during relative move command")
 
   # move x(mm) relative to current position
-  def move_rel_mm(self,x=0,y=0,z=0,theta=0,phi=0,spx=1000,spy=1000,spz=1000,sptheta=1000,spphi=1000):
-    self.print_cur_pos_mm()
+  def move_rel_mm(self,x=0,y=0,z=0,theta=0,phi=0,spx=None,spy=None,spz=None,sptheta=None,spphi=None,predict=False):
     x,y,z,theta,phi = self.convert(x,y,z,theta,phi)
-    self.move_rel(x,y,z,theta,phi,spx,spy,spz,sptheta,spphi)
-    self.print_cur_pos_mm()
+    seconds = self.move_rel(x,y,z,theta,phi,spx,spy,spz,sptheta,spphi,predict)
+    if not predict:
+      print('current (x,y,z,theta,phi) (mm) =',*self.unconvert(*self.pos) )
+    return seconds
+
+  # stream a list of absolute points (counts) to the controller as PVT segments
+  def move_trajectory(self,points,dwell=0.,speed=(1000,1000,1000,1000,1000),accel=(256000,256000,256000,256000,256000)):
+    '''
+    move through the list of absolute positions (x,y,z,theta,phi), in counts,
+    as one buffered PVT motion of the controller instead of one move per point.
+    All axes move in a straight line from point to point and stop at each
+    point for dwell seconds.
+    speed and accel are the per axis limits in counts/s and counts/s^2.
+    Returns the times (s from the start of the motion) the points are reached.
+    saves position to file after moving
+    '''
+    try:
+      n0 = self.round_trips
+      start = self.get_cur_pos()
+      segments, arrivals = trajectory.pvt_segments( start, points, speed, accel, dwell )
+      print('trajectory of',len(points),'points in',len(segments),'segments, %.1f s'%(arrivals[-1]+dwell if arrivals else 0.))
+      self.stream_pvt( segments )
+      self.wait_settled()
+      pos = self.get_cur_pos()
+      print('current (x,y,z,theta,phi) (counts)=',*pos)
+      self.save_position( self.format_position(pos) )
+      self.last_round_trips = self.round_trips - n0
+      return arrivals
+
+    except:
+      self.fail("error returned by the controller during trajectory move")
+
+  # same as move_trajectory but points are in mm and degrees
+  def move_trajectory_mm(self,points,dwell=0.,speed=(1000,1000,1000,1000,1000),accel=(256000,256000,256000,256000,256000)):
+    points = self.cal.to_counts(points).tolist()
+    return self.move_trajectory(points,dwell,speed,accel)
+
+  def stream_pvt(self,segments,poll=0.1):
+    '''
+    Send (dp,v,n) PVT segments for axes x,y,z,theta,phi to the controller,
+    one command line per segment.  The buffer is filled before BT starts the
+    motion, then topped up whenever the controller reports free space
+    (_PVx), checking every poll seconds.  Ends with the t=0 segment.
+    '''
+    axes = self.axes
+    if len(segments) == 0:
+      return
+    sent = 0
+    free = PVT_BUFFER - 1 # keep one place for the end segment
+    started = False
+    while sent < len(segments):
+      for dp,v,n in segments[sent:sent+free]:
+        self.c( ';'.join( 'PV%s=%d,%d,%d'%(axes[i],dp[i],v[i],n) for i in range(len(axes)) ) )
+        sent += 1
+      if not started:
+        self.c('BT'+axes)
+        started = True
+      if sent < len(segments):
+        time.sleep(poll)
+        res = self.c('MG '+','.join('_PV'+ax for ax in axes))
+        free = int( min( float(f) for f in res.split() ) ) - 1
+    self.c( ';'.join( 'PV%s=0,0,0'%ax for ax in axes ) )
+
+
+  def download_array(self,name,values):
+    '''
+    Write values into the controller array name, dimensioned to fit.
+    Uses GArrayDownload when the connection has it, assignments otherwise.
+    '''
+    self.send( 'DA '+name+'[]', 'DM %s[%d]'%(name,len(values)) )
+    if hasattr(self.g,'GArrayDownload'):
+      self.g.GArrayDownload( name, 0, len(values)-1, ','.join( '%g'%v for v in values ) )
+      self.round_trips += 1
+      return
+    for first in range(0,len(values),20):
+      self.send( *[ '%s[%d]=%g'%(name,first+i,v) for i,v in enumerate(values[first:first+20]) ] )
+
+  def start_scan_program(self,points,settle=0.1,exposure=1.,pulse=0.05,output=1):
+    '''
+    Run a whole scan on the controller (see dmcprogram.py): download the
+    absolute points (x,y,z,theta,phi), in counts, with synchronized speeds
+    within max_speed and max_accel, download the program and start it.
+    At each point the program pulses output bit 'output' for 'pulse' s,
+    settle s after the move, and waits 'exposure' s before moving on.
+    Returns the predicted scan time in s. Follow it with scan_progress or
+    wait_scan_program. Raises ValueError if there are more points than the
+    controller arrays hold, see dmcprogram.max_points.
+    '''
+    dmcprogram.check_points( len(points) )
+    start = self.get_cur_pos()
+    arrays, seconds = dmcprogram.scan_arrays( start, points, self.max_speed, self.max_accel )
+    seconds += len(points)*( settle + max(exposure,pulse) )
+    self.g.GProgramDownload( dmcprogram.scan_program( settle, exposure, pulse, output, self.axes ), '' )
+    self.round_trips += 1
+    for name,values in arrays.items():
+      self.download_array( name, values )
+    self.send( '%s=%d'%(dmcprogram.POINTS,len(points)), 'XQ #'+dmcprogram.LABEL )
+    self.forget_state() # the program sets SP, AC and DC
+    print('scan program of',len(points),'points started, predicted time %.1f s'%seconds)
+    return seconds
+
+  def scan_progress(self):
+    '''
+    Returns (triggered, done, running): photos triggered so far by the scan
+    program, whether it got to the end and whether it is still running.
+    One round trip.
+    '''
+    triggered, done, line = [ float(v) for v in self.c(dmcprogram.PROGRESS_QUERY).split() ]
+    return int(triggered), done == 1, line >= 0
+
+  def wait_scan_program(self,on_point=None,poll=0.1):
+    '''
+    Wait for the scan program to finish, calling on_point(i) once the
+    photo of point i has been triggered. Saves the position at the end.
+    '''
+    seen = 0
+    while True:
+      triggered, done, running = self.scan_progress()
+      while seen < triggered:
+        if on_point is not None:
+          on_point(seen)
+        seen += 1
+      if done:
+        break
+      if not running:
+        raise RuntimeError('scan program stopped after %d points: %s'%(triggered,self.c('TC 1')))
+      time.sleep(poll)
+    pos = self.get_cur_pos()
+    print('scan program done, current (x,y,z,theta,phi) (counts)=',*pos)
+    self.save_position( self.format_position(pos) )
+
+  def run_scan_program(self,points,settle=0.1,exposure=1.,pulse=0.05,output=1,on_point=None,poll=0.1):
+    '''
+    start_scan_program and wait_scan_program in one call.
+    Returns the scan time in s.
+    '''
+    dmcprogram.check_points( len(points) ) # before anything moves
+    try:
+      n0 = self.round_trips
+      t0 = time.time()
+      self.start_scan_program(points,settle,exposure,pulse,output)
+      self.wait_scan_program(on_point,poll)
+      self.last_round_trips = self.round_trips - n0
+      return time.time() - t0
+
+    except:
+      self.fail("error returned by the controller during the scan program",'HX;ST;MO')
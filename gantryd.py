@@ -0,0 +1,200 @@
+'''
+
+gantryd.py
+
+Resident gantry and camera service: one process owns the gantrycontrol
+object and the pgcamera sessions, and scan scripts or interactive users
+talk to it through a Unix socket.  The controller is opened, the position
+loaded and the cameras detected once, when the service starts, instead of
+in every script.
+
+Requests are JSON lines
+
+  {"call": "move_rel", "args": [1000, 0, 0], "kwargs": {}}
+
+answered by one JSON line, {"result": ...} or {"error": "message"}.
+Gantry calls are run one at a time, and so are camera calls, whatever
+the number of connected clients.
+
+Start the service:
+
+  python gantryd.py                         # real controller and cameras
+  python gantryd.py --sim --nocamera        # galilsim controller, no cameras
+  python gantryd.py --socket /tmp/other.sock --address '192.168.42.11 -s ALL'   # a second stand
+
+Use it:
+
+  > import gantryd
+  > gantry = gantryd.gantryclient()          # connects to the running service
+  > gantry.move_rel( 1000, 0, 0 )
+  > gantry.get_cur_pos()
+  > gantry.new_scan()                       # camera settings read again for this scan
+  > gantry.capture_image( '.', 'z0_y0_x0' )
+  > gantry.calls()                           # list of the calls available
+  > gantry.close()
+'''
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import threading
+import gantrycontrol
+
+SOCKET = '/tmp/gantryd.sock'
+GANTRY_CALLS = ( 'move', 'move_rel', 'move_rel_mm', 'move_trajectory', 'move_trajectory_mm',
+                 'get_cur_pos', 'get_cur_pos_mm', 'locate_home', 'locate_home_xyz',
+                 'read_status', 'start_scan_program', 'scan_progress', 'recover' )
+CAMERA_CALLS = ( 'capture_image', 'capture_all', 'set_camera', 'get_camera_serno', 'new_scan' )
+SERVICE_CALLS = ( 'ping', 'calls', 'shutdown' )
+
+
+def _jsonable( value ):
+    '''
+    value with tuples, numpy arrays and status objects turned into JSON types
+    '''
+    if value is None or isinstance( value, (bool, int, float, str) ):
+        return value
+    if isinstance( value, dict ):
+        return dict( ( str(k), _jsonable(v) ) for k, v in value.items() )
+    if isinstance( value, (list, tuple) ):
+        return [ _jsonable(v) for v in value ]
+    if hasattr( value, 'tolist' ):
+        return value.tolist()
+    if hasattr( value, '__dict__' ):
+        return _jsonable( vars(value) )
+    return str( value )
+
+
+class gantryd:
+
+    def __init__( self, socketname=SOCKET, gantry=None, camera=None ):
+        '''
+        socketname : path of the Unix socket to listen on
+        gantry     : gantrycontrol object to serve
+        camera     : pgcamera object to serve, None for no camera calls
+        '''
+        self.socketname = socketname
+        self.gantry = gantry
+        self.camera = camera
+        self.gantry_lock = threading.Lock()
+        self.camera_lock = threading.Lock()
+        self.server = None
+
+    def handle( self, request ):
+        '''
+        Run one request dictionary, returns the response dictionary.
+        '''
+        name = request.get( 'call' )
+        args = request.get( 'args', [] )
+        kwargs = request.get( 'kwargs', {} )
+        try:
+            if name in GANTRY_CALLS:
+                with self.gantry_lock:
+                    result = getattr( self.gantry, name )( *args, **kwargs )
+            elif name in CAMERA_CALLS:
+                if self.camera is None:
+                    return { 'error' : 'no camera in this service' }
+                with self.camera_lock:
+                    result = getattr( self.camera, name )( *args, **kwargs )
+            elif name == 'ping':
+                result = 'pong'
+            elif name == 'calls':
+                result = list( GANTRY_CALLS ) + ( list( CAMERA_CALLS ) if self.camera is not None else [] ) + list( SERVICE_CALLS )
+            elif name == 'shutdown':
+                threading.Thread( target=self.server.shutdown ).start()
+                result = None
+            else:
+                return { 'error' : 'unknown call '+str(name) }
+        except SystemExit:
+            # a gantrycontrol made with exit_on_error=True exits on controller errors
+            return { 'error' : name+': controller error, motors turned off' }
+        except Exception as ex:
+            return { 'error' : name+': '+str(ex) }
+        return { 'result' : _jsonable( result ) }
+
+    def serve( self ):
+        '''
+        Serve requests until a shutdown call.
+        '''
+        service = self
+        class handler( socketserver.StreamRequestHandler ):
+            def handle( self ):
+                for line in self.rfile:
+                    try:
+                        request = json.loads( line )
+                    except ValueError as ex:
+                        response = { 'error' : 'bad request: '+str(ex) }
+                    else:
+                        response = service.handle( request )
+                    self.wfile.write( ( json.dumps( response ) + '\n' ).encode() )
+                    self.wfile.flush()
+
+        if os.path.exists( self.socketname ):
+            os.remove( self.socketname )
+        self.server = socketserver.ThreadingUnixStreamServer( self.socketname, handler )
+        self.server.daemon_threads = True
+        print('gantryd listening on',self.socketname)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.remove( self.socketname )
+
+
+class gantryclient:
+    '''
+    Connection to a running gantryd.  Every call of the service is a method,
+    e.g. client.move_rel( 1000 ); errors of the service raise RuntimeError.
+    '''
+
+    def __init__( self, socketname=SOCKET ):
+        self.sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        self.sock.connect( socketname )
+        self.f = self.sock.makefile( 'rw' )
+
+    def call( self, name, *args, **kwargs ):
+        self.f.write( json.dumps( { 'call' : name, 'args' : args, 'kwargs' : kwargs } ) + '\n' )
+        self.f.flush()
+        line = self.f.readline()
+        if line == '':
+            raise RuntimeError('gantryd closed the connection')
+        response = json.loads( line )
+        if 'error' in response:
+            raise RuntimeError( response['error'] )
+        return response['result']
+
+    def __getattr__( self, name ):
+        if name.startswith('_'):
+            raise AttributeError( name )
+        return lambda *args, **kwargs : self.call( name, *args, **kwargs )
+
+    def close( self ):
+        self.f.close()
+        self.sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description='gantry and camera service on a Unix socket' )
+    parser.add_argument( '--socket', default=SOCKET, help='socket path, '+SOCKET+' by default' )
+    parser.add_argument( '--sim', action='store_true', help='use the galilsim simulated controller' )
+    parser.add_argument( '--nocamera', action='store_true', help='serve the gantry only' )
+    parser.add_argument( '--camerafile', default='pgcamera_cameras.txt', help='camera list for pgcamera' )
+    parser.add_argument( '--address', default=gantrycontrol.ADDRESS, help='controller address, '+gantrycontrol.ADDRESS+' by default' )
+    parser.add_argument( '--axes', default=gantrycontrol.AXES, help='controller axes of x,y,z,theta,phi, '+gantrycontrol.AXES+' by default' )
+    options = parser.parse_args()
+
+    galil = None
+    if options.sim:
+        import galilsim
+        galil = galilsim.galilsim()
+    gantry = gantrycontrol.gantrycontrol( galil=galil, exit_on_error=False, address=options.address, axes=options.axes )
+    camera = None
+    if not options.nocamera:
+        import pgcamera # needs gphoto2
+        camera = pgcamera.pgcamera( options.camerafile )
+    gantryd( options.socket, gantry, camera ).serve()
+    if camera is not None:
+        camera.close_sessions()
+    del gantry
@@ -0,0 +1,307 @@
+'''
+
+gphotosim.py
+
+gphotosim class: simulated cameras behind a stand-in for the gphoto2
+module, so pgcamera, scanengine and the scan scripts can be run and
+timed without cameras (see dryrun.py).
+
+Usage:
+
+  > import sys, gphotosim
+  > sim = gphotosim.gphotosim( ncameras=2 )
+  > sys.modules['gphoto2'] = sim.module()    # before pgcamera is imported
+  > import pgcamera
+  > sim.write_camera_file( 'pgcamera_cameras.txt' )
+  > pgc = pgcamera.pgcamera()
+  > pgc.capture_image( '.', 'test' )
+  > sim.ncaptures                            # photos taken so far
+  > sim.connect_trigger( galil, output=1 )   # photos on the rising edges of a
+  >                                          # galilsim output (remote release)
+
+Only the parts of gphoto2 pgcamera uses are there: Camera (port and
+abilities, init, exit, get_summary, get_config/set_config of the
+capturetarget, capture, wait_for_event, file_get, file_delete),
+CameraFile (save, get_data_and_size), PortInfoList, CameraAbilitiesList,
+GPhoto2Error and the constants.
+
+Timing model:
+  - each camera call takes the time in times (seconds), see DEFAULT_TIMES.
+  - file_get takes image_size/usb_rate seconds more, the image data
+    itself is a short placeholder, so nothing big is written to disk.
+  - time is read and slept through 'clock' (default: the time module),
+    as in galilsim.
+'''
+
+import time
+import types
+
+GP_CAPTURE_IMAGE = 0
+GP_FILE_TYPE_NORMAL = 1
+GP_EVENT_UNKNOWN = 0
+GP_EVENT_TIMEOUT = 1
+GP_EVENT_FILE_ADDED = 2
+GP_ERROR = -1
+GP_ERROR_TIMEOUT = -10
+GP_ERROR_MODEL_NOT_FOUND = -105
+
+DEFAULT_MODEL = 'Canon EOS 2000D'
+DEFAULT_TIMES = { 'init' : 0.6, 'exit' : 0.05, 'summary' : 0.25, 'get_config' : 0.15, 'set_config' : 0.1,
+                  'capture' : 1.2, 'file_get' : 0.05, 'file_delete' : 0.05 }
+IMAGE_SIZE = 6.e6  # bytes of a photo
+USB_RATE = 25.e6   # bytes/s from camera to host
+EVENT_POLL = 0.01  # wait_for_event checks for a trigger this often (s)
+SETTINGS = ( ( 'ISO Speed', 'd01b', '100' ), ( 'Shutter Speed', 'd01c', '1/60' ), ( 'Aperture', 'd01d', '8' ),
+             ( 'White Balance', 'd013', 'Daylight' ), ( 'Image Format', 'd120', 'Large Fine JPEG' ) )
+
+
+class GPhoto2Error( Exception ):
+    def __init__( self, code ):
+        self.code = code
+        super().__init__( '[%d] simulated gphoto2 error' % code )
+
+
+class simcamera:
+    '''
+    State of one simulated camera.
+    '''
+
+    def __init__( self, addr, model, serno ):
+        self.addr = addr
+        self.model = model
+        self.serno = serno
+        self.config = { 'capturetarget' : 'Memory card' }
+        self.files = {}      # name in the camera : size
+        self.nphotos = 0
+        self.triggers = 0    # rising edges of the trigger output already turned into photos
+
+    def summary( self ):
+        lines = [ 'Manufacturer: Canon Inc.', 'Model: '+self.model, '  Version: 3-1.0.0',
+                  '  Serial Number: '+self.serno, 'Vendor Extension ID: 0xb (2.0)' ]
+        lines += [ 'Capture Formats: JPEG' ] + [ '' ]*11
+        lines += [ '%s(0x%s):(readwrite) (type=0x4) %s' % setting for setting in SETTINGS ]
+        return '\n'.join( lines ) + '\n'
+
+    def new_photo( self, size ):
+        self.nphotos += 1
+        name = 'IMG_%04d.JPG' % self.nphotos
+        self.files[ name ] = size
+        return name
+
+
+class gphotosim:
+    '''
+    Simulated cameras, used through the module returned by module().
+    '''
+
+    def __init__( self, ncameras=1, model=DEFAULT_MODEL, times=None, image_size=IMAGE_SIZE, usb_rate=USB_RATE,
+                  clock=time ):
+        '''
+        ncameras   : number of cameras on the bus
+        model      : model name of the cameras
+        times      : seconds per camera call, DEFAULT_TIMES for the ones left out
+        image_size : bytes of a photo, sets the file_get time
+        usb_rate   : bytes/s from camera to host
+        clock      : object with time() and sleep(), the time module by default
+        '''
+        self.cameras = [ simcamera( 'usb:001,%03d' % (i+2), model, 'SIM%06d' % (i+1) ) for i in range( ncameras ) ]
+        self.times = dict( DEFAULT_TIMES )
+        self.times.update( times or {} )
+        self.image_size = image_size
+        self.usb_rate = usb_rate
+        self.clock = clock
+        self.ncaptures = 0
+        self.trigger = None  # ( galilsim, output bit ) releasing the cameras
+
+    def camera( self, addr ):
+        for cam in self.cameras:
+            if cam.addr == addr:
+                return cam
+        raise GPhoto2Error( GP_ERROR_MODEL_NOT_FOUND )
+
+    def write_camera_file( self, fname='pgcamera_cameras.txt' ):
+        '''
+        Camera list for pgcamera, camera numbers in order of serial number.
+        '''
+        with open( fname, 'w' ) as f:
+            for i, cam in enumerate( self.cameras ):
+                f.write( str(i)+' '+cam.serno+'\n' )
+
+    def connect_trigger( self, galil, output=1 ):
+        '''
+        Take a photo with every camera on each rising edge of output bit
+        output of galilsim galil, as with a remote release cable.
+        '''
+        self.trigger = ( galil, output )
+
+    def _triggered( self, cam ):
+        '''
+        times of the rising edges of the trigger output not yet taken by cam
+        '''
+        if self.trigger is None:
+            return []
+        galil, output = self.trigger
+        galil.status( self.clock.time() ) # run the program up to now
+        edges = [ t for t, bit, value in galil.output_log if bit == output and value == 1 ]
+        return edges[ cam.triggers: ]
+
+    def _take( self, cam ):
+        self.ncaptures += 1
+        return cam.new_photo( self.image_size )
+
+    def module( self ):
+        '''
+        module object to use as gphoto2
+        '''
+        sim = self
+
+        class CameraFilePath:
+            def __init__( self, folder, name ):
+                self.folder = folder
+                self.name = name
+
+        class CameraFile:
+            def __init__( self, name ):
+                self.name = name
+                self.data = ( '\xff\xd8 gphotosim '+name+' \xff\xd9' ).encode( 'latin-1' )
+
+            def save( self, fname ):
+                with open( fname, 'wb' ) as f:
+                    f.write( self.data )
+
+            def get_data_and_size( self ):
+                return memoryview( self.data )
+
+        class CameraWidget:
+            def __init__( self, config, name ):
+                self.config = config
+                self.name = name
+
+            def get_value( self ):
+                return self.config[ self.name ]
+
+            def set_value( self, value ):
+                self.config[ self.name ] = value
+
+        class CameraConfig:
+            def __init__( self, config ):
+                self.config = dict( config )
+
+            def get_child_by_name( self, name ):
+                if name not in self.config:
+                    raise GPhoto2Error( GP_ERROR )
+                return CameraWidget( self.config, name )
+
+        class CameraText:
+            def __init__( self, text ):
+                self.text = text
+
+        class Camera:
+            def __init__( self ):
+                self.addr = None
+                self.cam = None
+
+            def set_port_info( self, addr ):
+                self.addr = addr
+
+            def set_abilities( self, model ):
+                pass
+
+            def _open( self ):
+                if self.cam is None:
+                    if self.addr is None:
+                        raise GPhoto2Error( GP_ERROR_MODEL_NOT_FOUND )
+                    sim.clock.sleep( sim.times['init'] )
+                    self.cam = sim.camera( self.addr )
+                return self.cam
+
+            def init( self ):
+                self._open()
+
+            def exit( self ):
+                if self.cam is not None:
+                    sim.clock.sleep( sim.times['exit'] )
+                self.cam = None
+
+            def get_summary( self ):
+                cam = self._open()
+                sim.clock.sleep( sim.times['summary'] )
+                return CameraText( cam.summary() )
+
+            def get_config( self ):
+                cam = self._open()
+                sim.clock.sleep( sim.times['get_config'] )
+                return CameraConfig( cam.config )
+
+            def set_config( self, cfg ):
+                cam = self._open()
+                sim.clock.sleep( sim.times['set_config'] )
+                cam.config.update( cfg.config )
+
+            def capture( self, kind ):
+                cam = self._open()
+                sim.clock.sleep( sim.times['capture'] )
+                return CameraFilePath( '/', sim._take( cam ) )
+
+            def wait_for_event( self, timeout ):
+                cam = self._open()
+                deadline = sim.clock.time() + timeout/1000.
+                while True:
+                    edges = sim._triggered( cam )
+                    if len(edges) > 0:
+                        ready = edges[0] + sim.times['capture']
+                        if ready <= sim.clock.time():
+                            cam.triggers += 1
+                            return GP_EVENT_FILE_ADDED, CameraFilePath( '/', sim._take( cam ) )
+                    remaining = deadline - sim.clock.time()
+                    if remaining <= 0:
+                        return GP_EVENT_TIMEOUT, None
+                    sim.clock.sleep( min( EVENT_POLL, remaining ) )
+
+            def file_get( self, folder, name, kind ):
+                cam = self._open()
+                if name not in cam.files:
+                    raise GPhoto2Error( GP_ERROR )
+                sim.clock.sleep( sim.times['file_get'] + cam.files[name]/sim.usb_rate )
+                return CameraFile( name )
+
+            def file_delete( self, folder, name ):
+                cam = self._open()
+                sim.clock.sleep( sim.times['file_delete'] )
+                cam.files.pop( name, None )
+
+        class PortInfoList:
+            def load( self ):
+                self.addrs = [ cam.addr for cam in sim.cameras ]
+
+            def lookup_path( self, addr ):
+                return self.addrs.index( addr )
+
+            def __getitem__( self, i ):
+                return self.addrs[ i ]
+
+        class CameraAbilitiesList:
+            def load( self ):
+                self.models = sorted( set( cam.model for cam in sim.cameras ) )
+
+            def detect( self, port_info_list ):
+                return [ ( cam.model, cam.addr ) for cam in sim.cameras ]
+
+            def lookup_model( self, model ):
+                return self.models.index( model )
+
+            def __getitem__( self, i ):
+                return self.models[ i ]
+
+        gp = types.ModuleType( 'gphoto2' )
+        gp.__doc__ = 'gphotosim stand-in for gphoto2'
+        for name, value in globals().items():
+            if name.startswith( 'GP_' ):
+                setattr( gp, name, value )
+        gp.GPhoto2Error = GPhoto2Error
+        gp.Camera = Camera
+        gp.CameraFile = CameraFile
+        gp.CameraFilePath = CameraFilePath
+        gp.PortInfoList = PortInfoList
+        gp.CameraAbilitiesList = CameraAbilitiesList
+        return gp
@@ -0,0 +1,183 @@
+'''
+
+imagewriter.py
+
+imagewriter class: writes the photos read into memory (pgcamera
+capture_data, fetch_image) to disk in a background thread, so the scan
+never waits for the disk while a photo is written.
+
+Each image is handed over as it is, e.g. the bytes read from the camera
+by fetch_image, and is not copied again.  The writer thread computes its sha256, optionally
+compresses it, writes it to a temporary name and renames it, so a file
+under the image name is always complete (fsync=True also syncs it to
+disk first).  The settings text of the camera goes to the settings log
+given with the image (camsettings.py).  With a dataset
+(scandataset.scanwriter) the images are added to it instead of being
+written as files.
+
+The queue is bounded: once maxsize images wait to be written, put blocks
+until one is done.  A slow disk then holds up the next download, and the
+scan at its next point (see scanengine), instead of filling the memory or
+the camera.  blocked_s is the time put spent waiting.
+
+Usage:
+
+  > import imagewriter
+  > writer = imagewriter.imagewriter( maxsize=8, compress='gzip' )
+  > data, settings = pgc.capture_data()                      # photo in memory
+  > writer.put( data, 'scan/c0_z0_y0_x0.jpg', settings, 0, settingslog=pgc.settings_log( 'scan' ) )
+  >                                                         # returns 'scan/c0_z0_y0_x0.jpg.gz'
+  > pgc.capture_image( 'scan', 'z0_y0_x0', writer=writer )   # same through capture_image
+  > writer.put( data, on_done=lambda record : print( record['imgname'], record['sha256'] ) )
+  > writer.flush()                                           # wait until all is written
+  > writer.records                                           # imgname, sha256, size, stored, seconds, error
+  > writer.close()
+  > writer = imagewriter.imagewriter( dataset=scandataset.scanwriter( 'scan_data' ) )
+  > writer.put( data, settings=settings, camno=0, point=(0,0,0,0,0), label='z0_y0_x0' ) # 'scan_data#row'
+'''
+
+import gzip
+import hashlib
+import lzma
+import os
+import queue
+import threading
+import time
+
+# compress : ( file name suffix, compressed file writing to an open file )
+COMPRESSIONS = { 'gzip' : ( '.gz', lambda f, level : gzip.GzipFile( fileobj=f, mode='wb', compresslevel=6 if level is None else level ) ),
+                 'xz' : ( '.xz', lambda f, level : lzma.LZMAFile( f, 'wb', preset=level ) ) }
+
+
+class imagewriter:
+
+    def __init__( self, maxsize=8, compress=None, level=None, dataset=None, fsync=False ):
+        '''
+        maxsize  : images waiting to be written before put blocks
+        compress : None, 'gzip' or 'xz': the files are compressed, with .gz
+                   or .xz added to their name.  Not for datasets, their
+                   images are read in place.
+        level    : compression level, the default of compress if None
+        dataset  : optional scandataset.scanwriter the images are added to
+        fsync    : sync each file to disk before it is renamed
+        '''
+        if compress is not None and compress not in COMPRESSIONS:
+            raise ValueError('compress must be None or one of '+', '.join( COMPRESSIONS ))
+        if compress is not None and dataset is not None:
+            raise ValueError('the images of a dataset are not compressed')
+        self.compress = compress
+        self.level = level
+        self.dataset = dataset
+        self.fsync = fsync
+        self.queue = queue.Queue( maxsize )
+        self.records = []   # one dictionary per image written, see _write
+        self.errors = []    # records of the images that could not be written
+        self.bytes = 0      # image bytes written
+        self.stored = 0     # bytes on disk, after compression
+        self.blocked_s = 0. # seconds put waited for room in the queue
+        self.thread = threading.Thread( target=self._run, name='imagewriter', daemon=True )
+        self.thread.start()
+
+    def put( self, data, fname=None, settings=None, camno=0, point=None, label=None, settingslog=None, on_done=None ):
+        '''
+        Queue image data (bytes or any buffer, kept until written, not copied).
+        fname       : file to write it to, not used with a dataset
+        settings    : camera settings text, recorded for camera camno in
+                      settingslog, or in the dataset
+        point,label : position and label of the image in the dataset
+        on_done     : called in the writer thread with the record of the image
+        Blocks while the queue is full.  Returns the name the file will
+        have, None with a dataset (the reference is in the record).
+        '''
+        if self.dataset is None and fname is None:
+            raise ValueError('fname is needed to write an image file')
+        if self.dataset is None and self.compress is not None:
+            fname += COMPRESSIONS[ self.compress ][0]
+        item = ( data, fname, settings, camno, point, label, settingslog, on_done )
+        try:
+            self.queue.put_nowait( item )
+        except queue.Full:
+            t0 = time.perf_counter()
+            self.queue.put( item )
+            self.blocked_s += time.perf_counter() - t0
+        return fname
+
+    def _run( self ):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                record = self._write( *item[:-1] )
+                if item[-1] is not None:
+                    try:
+                        item[-1]( record )
+                    except Exception as ex:
+                        print('imagewriter on_done error:',ex)
+            finally:
+                item = None # let go of the image buffer
+                self.queue.task_done()
+
+    def _write( self, data, fname, settings, camno, point, label, settingslog ):
+        '''
+        Write one image, returns its record: imgname (file name or dataset
+        reference), sha256, size (image bytes), stored (bytes on disk),
+        seconds (spent writing) and error (None, or the message).
+        '''
+        t0 = time.perf_counter()
+        record = { 'imgname' : fname, 'sha256' : None, 'size' : memoryview( data ).nbytes,
+                   'stored' : 0, 'seconds' : 0., 'error' : None }
+        try:
+            record['sha256'] = hashlib.sha256( data ).hexdigest()
+            if self.dataset is not None:
+                record['imgname'] = self.dataset.add( data, settings, point if point is not None else (0,0,0,0,0),
+                                                      camno, label, record['sha256'] )
+                record['stored'] = record['size']
+            else:
+                tmpname = fname + '.part'
+                with open( tmpname, 'wb' ) as f:
+                    if self.compress is None:
+                        f.write( data )
+                    else:
+                        with COMPRESSIONS[ self.compress ][1]( f, self.level ) as compressed:
+                            compressed.write( data )
+                    if self.fsync:
+                        f.flush()
+                        os.fsync( f.fileno() )
+                os.replace( tmpname, fname )
+                record['stored'] = os.path.getsize( fname )
+                if settingslog is not None and settings is not None:
+                    settingslog.record( int(camno), settings, fname )
+            self.bytes += record['size']
+            self.stored += record['stored']
+        except Exception as ex:
+            record['error'] = str(ex)
+            self.errors.append( record )
+            print('imagewriter error writing',fname,':',ex)
+        record['seconds'] = time.perf_counter() - t0
+        self.records.append( record )
+        return record
+
+    def waiting( self ):
+        '''
+        images queued and not written yet
+        '''
+        return self.queue.unfinished_tasks
+
+    def flush( self ):
+        '''
+        Wait until all the images queued are written.
+        '''
+        self.queue.join()
+
+    def close( self ):
+        '''
+        Write what is queued and stop the writer thread.  The dataset, if
+        any, is left open.  Returns the records of the images that could
+        not be written.
+        '''
+        if self.thread is not None:
+            self.queue.put( None )
+            self.thread.join()
+            self.thread = None
+        return self.errors
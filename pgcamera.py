@@ -14,12 +14,23 @@ Oct. 2022
 import gphoto2 as gp
 import time
 import os
-import subprocess
 import sys
+import camsettings
+from concurrent.futures import ThreadPoolExecutor
+
+# Serial numbers of cameras already probed, shared by all pgcamera objects
+# in this process and saved in the discovery file:
+#   ( usb port, model ) : [ serno, camno ]
+# The usb port includes the device number, which changes every time a
+# camera is plugged in, so an entry stays valid while that camera stays
+# plugged in.  Entries are dropped when their port disappears or the
+# camera gives an error.
+discovered = {}
 
 class pgcamera:
 
-    def __init__( self, camerafile='pgcamera_cameras.txt', buildcamerafile=False, setcamno=-1 ):
+    def __init__( self, camerafile='pgcamera_cameras.txt', buildcamerafile=False, setcamno=-1,
+                  discoveryfile='pgcamera_discovery.txt' ):
         """
         Setup camera control object to keep track of all
         cameras available, or just use ones in a list in a textfile.
@@ -31,9 +42,21 @@ class pgcamera:
         cameras in the file.
 
         setcamno is the camera number to use from startup
+
+        discoveryfile caches the serial number of each camera by usb port
+        and model, so cameras that stay plugged in are not queried again.
         """
         try:
             self.camera = gp.Camera()
+            self.camno = None
+            self.sessions = {}  # camera_no : open gp.Camera, kept for the life of the object
+            self.saved_capturetarget = {} # camera_no : capturetarget to restore on close
+            self.pool = None # threads for capture_all, one per camera
+            self.pool_size = 0 # threads in pool
+            self.settings = {} # camera_no : settings text, read once per session and per scan
+            self.settings_shots = {} # camera_no : photos since the settings were read
+            self.settings_every = 0 # read the settings again every that many photos, 0 for once per session
+            self.settingslogs = {} # dir : camsettings.settingslog of the photos saved there
             self.cameras_dict = {}  # ser_no : camera_no
             self.sernos_dict = {} # camera_no : ser_no
             self.camvitals = []        # Build list of lists holding camera vitals
@@ -48,17 +71,13 @@ class pgcamera:
             if buildcamerafile == False:
                 self.read_list_of_cameras( camerafile )
 
+            self.discoveryfile = discoveryfile
+            self.read_discovery( [ (cam[1], cam[0]) for cam in self.camera_list ] )
+
             for i,cam in enumerate( self.camera_list ):
                 print(i,cam)
                 addr = cam[1]
-                iport  = self.port_info_list.lookup_path( addr )
-                self.camera.set_port_info( self.port_info_list[ iport ] )
-                time.sleep(0.5)
-                iab    = self.abilities_list.lookup_model( cam[0] )
-                self.camera.set_abilities( self.abilities_list[ iab ] )
-                time.sleep(0.5)
-                settings_list = self.camera.get_summary().text.split( '\n' )
-                ser_no = settings_list[3].strip().split(' ')[2]
+                ser_no = self.probe_serno( addr, cam[0] )
 
                 # we have camno, and serno (all stored as strings
                 # print(buildcamerafile)
@@ -82,12 +101,17 @@ class pgcamera:
                 f.close()
 
             self.print_camera_list()
+            for vital in self.camvitals:
+                discovered[ (vital[2], vital[3]) ] = [ vital[0], vital[1] ]
+            self.write_discovery()
+
+            # done probing, free the port for the sessions
+            self.camera.exit()
 
             # set camera to first one
             if setcamno == -1:
                 setcamno = self.camvitals[0][1]
             self.set_camera( setcamno )
-            self.camera.init()
             print('Connected to camera',setcamno)
 
         except :
@@ -98,7 +122,42 @@ class pgcamera:
 
     def __del__(self):
         print('Disconnecting from camera')
-        self.camera.exit()
+        self.close_sessions()
+
+    def close_sessions(self):
+        '''
+        Restores the capture target and closes the connection of every
+        camera opened by set_camera.
+        '''
+        for camno in list( self.sessions ):
+            self.close_session( camno )
+        self.saved_capturetarget = {}
+        for log in self.settingslogs.values():
+            log.close()
+        self.settingslogs = {}
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def close_session(self, camera_no):
+        '''
+        Restores the capture target and closes the connection of camera
+        camera_no, e.g. after an error.  The next call reconnects.
+        '''
+        camno = int(camera_no)
+        camera = self.sessions.pop( camno, None )
+        saved = self.saved_capturetarget.pop( camno, None )
+        self.settings.pop( camno, None ) # read again after reconnecting
+        if camera is None:
+            return
+        try:
+            if saved is not None:
+                cfg = camera.get_config()
+                cfg.get_child_by_name('capturetarget').set_value( saved )
+                camera.set_config(cfg)
+            camera.exit()
+        except gp.GPhoto2Error as ex:
+            print('close_session camera',camno,'error:',str(ex))
 
     def print_camera_list(self):
         for vital in self.camvitals:
@@ -149,11 +208,83 @@ class pgcamera:
 
 
 
+    def read_discovery( self, detected ):
+        '''
+        Loads the discovery file into discovered, if that is not done
+        yet in this process.  detected is the list of (port, model) found
+        now, cached cameras not in it were unplugged and are dropped.
+        '''
+        if len( discovered ) == 0 and os.path.exists( self.discoveryfile ):
+            try:
+                f = open( self.discoveryfile, 'r' )
+                for line in f.readlines():
+                    addr, model, serno, camno = line.rstrip('\n').split('\t')
+                    discovered[ (addr, model) ] = [ serno, camno ]
+                f.close()
+            except:
+                print('read_discovery failed, probing all cameras')
+                discovered.clear()
+        for key in list( discovered ):
+            if key not in detected:
+                del discovered[ key ]
+
+
+    def write_discovery( self ):
+        '''
+        Stores the discovery cache in the discovery file.
+        '''
+        try:
+            f = open( self.discoveryfile, 'w' )
+            for (addr, model), (serno, camno) in discovered.items():
+                f.write( addr+'\t'+model+'\t'+serno+'\t'+str(camno)+'\n' )
+            f.close()
+        except:
+            print('write_discovery failed')
+
+
+    def forget_camera( self, camera_no ):
+        '''
+        Drops camera camera_no from the discovery cache, so it is probed
+        again next time.  Called when the camera gives an error.
+        '''
+        if camera_no is None:
+            return
+        for vital in self.camvitals:
+            if int( vital[1] ) == int( camera_no ):
+                discovered.pop( (vital[2], vital[3]), None )
+        self.write_discovery()
+
+
+    def probe_serno( self, addr, model ):
+        '''
+        Returns the serial number of the camera of type model at usb port
+        addr, from the discovery cache if it is there, otherwise by
+        reading the camera summary.
+        '''
+        if (addr, model) in discovered:
+            return discovered[ (addr, model) ][0]
+        iport  = self.port_info_list.lookup_path( addr )
+        self.camera.set_port_info( self.port_info_list[ iport ] )
+        time.sleep(0.5)
+        iab    = self.abilities_list.lookup_model( model )
+        self.camera.set_abilities( self.abilities_list[ iab ] )
+        time.sleep(0.5)
+        settings_list = self.camera.get_summary().text.split( '\n' )
+        ser_no = settings_list[3].strip().split(' ')[2]
+        discovered[ (addr, model) ] = [ ser_no, '-1' ]
+        return ser_no
+
+
     def get_camera_serno( self ):
         '''
            Returns the camera serial number for the camera being referred to
-           by the camera object.
+           by the camera object.  Known cameras are looked up in camvitals,
+           only unknown ones are asked for their summary.
         '''
+        if self.camno is not None:
+            for vital in self.camvitals:
+                if int( vital[1] ) == self.camno:
+                    return vital[0]
         settings_list = self.camera.get_summary().text.split( '\n' )
         ser_no = settings_list[3].strip().split(' ')[2]
         return ser_no
@@ -185,7 +316,8 @@ class pgcamera:
     def set_camera( self, camera_no ):
         '''
         Sets the camera object to be referring to the camera with
-        camera number.
+        camera number.  The first time a camera is set its connection
+        is opened, after that the open connection is reused.
         Returns True if it succeeds and False if it fails.
         '''
         try:
@@ -197,15 +329,8 @@ class pgcamera:
             #resetport = self.camvitals[idx][2][4:].replace(',','/')
             #print('>usbreset',resetport)
 
-            addr = self.camvitals[ idx ][2]
-            iport  = self.port_info_list.lookup_path(addr)
-            print(self.camvitals[idx])
-            self.camera.set_port_info( self.port_info_list[ iport ] )
-            #time.sleep(0.5) # sleep 1/2 second
-            iab    = self.abilities_list.lookup_model( self.camvitals[ idx ][3] )
-            #time.sleep(0.5) # sleep 1/2 second
-            self.camera.set_abilities( self.abilities_list[ iab ] )
-            #time.sleep(0.5) # sleep 1/2 second
+            self.camera = self.open_session( camera_no )
+            self.camno = camera_no
             print('Camera set to number:',camera_no)
 
             return True
@@ -216,68 +341,285 @@ class pgcamera:
             return False
 
 
+    def open_session( self, camera_no ):
+        '''
+        Returns the open gp.Camera of camera number camera_no, connecting
+        to it the first time.  The connection is kept until close_sessions.
+        '''
+        camera_no = int(camera_no)
+        if camera_no not in self.sessions:
+            idx = self.get_camvital_idx( camera_no )
+            camera = gp.Camera()
+            addr = self.camvitals[ idx ][2]
+            iport  = self.port_info_list.lookup_path(addr)
+            print(self.camvitals[idx])
+            camera.set_port_info( self.port_info_list[ iport ] )
+            iab    = self.abilities_list.lookup_model( self.camvitals[ idx ][3] )
+            camera.set_abilities( self.abilities_list[ iab ] )
+            camera.init()
+            self.sessions[ camera_no ] = camera
+        return self.sessions[ camera_no ]
+
+
+    def open_all( self ):
+        '''
+        Opens a connection to every camera in camvitals.
+        '''
+        for vital in self.camvitals:
+            self.open_session( vital[1] )
+
+
     def print_abilities( self ):
         '''
         Prints the camera settings, aka abilities of currently set
         camera.  Ignore generic unamed properties.
         '''
         try:
-            settings_list = self.camera.get_summary().text.split( '\n' )
-            for settings in settings_list[:5]:
-                print(settings)
-            for settings in settings_list[17:]:
-                setlist = settings.split('(')
-                setname = setlist[0].strip(': ()')
-                setlist = settings.split(' ')
-                setvalue = setlist[-1].strip(' ()')
-                # skip generic unamed properties
-                if setname.split(' ')[0] != 'Property' and setname != '':
-                    print(setname+', value: '+setvalue)
+            print( self.settings_text(), end='' )
 
         except:
             print('print_abilities error!')
             print( sys.exc_info()[0] )
             return False
 
-    def capture_abilities( self, outfilename ):
+    def settings_text( self, camera=None ):
+        '''
+        camera: gp.Camera to read, default the currently set camera.
+
+        Returns the camera settings, aka abilities, as written by
+        capture_abilities (see camsettings.parse_summary).
+        '''
+        if camera is None:
+            camera = self.camera
+        return camsettings.parse_summary( camera.get_summary().text )
+
+    def new_scan( self, camera_no=None ):
+        '''
+        A scan starts with camera camera_no (all cameras if None): its
+        settings are read again at its first photo, so the settings log of
+        the scan does not carry over those of an earlier scan.
+        '''
+        cams = list( self.settings ) if camera_no is None else [ int(camera_no) ]
+        for camno in cams:
+            self.settings.pop( camno, None )
+            self.settings_shots.pop( camno, None )
+
+    def current_settings( self, camera_no ):
+        '''
+        Settings text of camera camera_no for the photo just taken.  The
+        camera is only asked once per session and per scan (see new_scan),
+        and every settings_every photos if that is not 0; settings are not
+        expected to change during a scan.
+        '''
+        camno = int(camera_no)
+        shots = self.settings_shots.get( camno, 0 ) + 1
+        if camno not in self.settings or ( self.settings_every > 0 and shots > self.settings_every ):
+            self.settings[ camno ] = self.settings_text( self.open_session( camno ) )
+            shots = 1
+        self.settings_shots[ camno ] = shots
+        return self.settings[ camno ]
+
+    def capture_abilities( self, outfilename, camera=None ):
         '''
         outfilename: textfile name into which the
         settings will be stored.
+        camera: gp.Camera to read, default the currently set camera.
 
         Saves the camera settings, aka abilities into outfilename.
         Ignore generic unamed properties.
         '''
         try:
+            text = self.settings_text( camera )
             f = open(outfilename,'w')
-
-            settings_list = self.camera.get_summary().text.split( '\n' )
-            #time.sleep(0.5) # sleep 1/2 second
-
-            # print first few lines as is
-            for settings in settings_list[:5]:
-                f.write(settings+'\n')
-            for settings in settings_list[17:]:
-                setlist = settings.split('(')
-                setname = setlist[0].strip(': ()')
-                setlist = settings.split(' ')
-                setvalue = setlist[-1].strip(' ()')
-                # skip generic unamed properties
-                if setname.split(' ')[0] != 'Property' and setname != '':
-                    f.write(setname+', value: '+setvalue+'\n')
-
+            f.write(text)
             f.close()
         except:
             print('capture_abilities error file:',outfilename,' not complete.')
             print( sys.exc_info()[0] )
 
 
-    def capture_image( self , dir='', label='img', append_date=True ):
+    def image_name( self, camno, dir='', label='img', append_date=True ):
+        '''
+        Returns 'dir/c<num>_'+label[+date] without extension
+        '''
+        imgname = dir+'/'
+        if dir == '':
+            imgname = '';
+        imgname = imgname + 'c' + str(camno) + '_' + label
+        if append_date:
+            imgname = imgname + time.strftime('%Y%m%d-%H:%M:%S%Z')
+        return imgname
+
+
+    def trigger_image( self, camera_no=None ):
+        '''
+        Takes a photo with the currently selected camera, or camera number
+        camera_no, and leaves it in the camera RAM.  The shutter has closed
+        when this returns.
+
+        Returns the camera file path, to be passed to download_image.
+        '''
+        camno = self.camno if camera_no is None else int(camera_no)
+        camera = self.capture_to_ram( camno )
+        return camera.capture( gp.GP_CAPTURE_IMAGE )
+
+
+    def capture_to_ram( self, camera_no=None ):
+        '''
+        Opens the session of camera camera_no (the selected one by default)
+        and has it keep new photos in its RAM.  Returns the gp.Camera.
+        '''
+        camno = self.camno if camera_no is None else int(camera_no)
+        camera = self.open_session( camno )
+        if camno not in self.saved_capturetarget:
+            # once per session, put back by close_sessions
+            cfg = camera.get_config()
+            capturetarget_cfg = cfg.get_child_by_name('capturetarget')
+            self.saved_capturetarget[ camno ] = capturetarget_cfg.get_value()
+            capturetarget_cfg.set_value('Internal RAM')
+            camera.set_config(cfg)
+        return camera
+
+
+    def wait_for_image( self, camera_no=None, timeout=10. ):
+        '''
+        Waits for a photo triggered outside the host, e.g. by the controller
+        output wired to the remote release (gantrycontrol.start_scan_program).
+        Call capture_to_ram before the first trigger.
+
+        Returns the camera file path, to be passed to download_image.
+        '''
+        camno = self.camno if camera_no is None else int(camera_no)
+        camera = self.capture_to_ram( camno )
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise gp.GPhoto2Error( gp.GP_ERROR_TIMEOUT )
+            event_type, event_data = camera.wait_for_event( int( remaining*1000 ) )
+            if event_type == gp.GP_EVENT_FILE_ADDED:
+                return event_data
+
+
+    def download_image( self, file_path, camno, dir='', label='img', append_date=True ):
+        '''
+        Copies the photo taken by trigger_image from the camera to
+        'dir/c<num>_'+label[+date].jpg' and deletes it from the camera.
+        The camera settings go to 'dir/settings.jsonl' when they differ
+        from those of the previous photo of that camera (see camsettings.py).
+
+        Returns the image file name.
+        '''
+        camera = self.open_session( camno )
+        imgname = self.image_name( camno, dir, label, append_date ) + '.jpg'
+        camera_file = camera.file_get( file_path.folder, file_path.name, gp.GP_FILE_TYPE_NORMAL )
+        camera_file.save( imgname )
+        camera.file_delete( file_path.folder, file_path.name )
+        self.settings_log( dir ).record( int(camno), self.current_settings( camno ), imgname )
+        return imgname
+
+
+    def settings_log( self, dir='' ):
+        '''
+        camsettings.settingslog of the photos saved in dir
+        '''
+        if dir not in self.settingslogs:
+            self.settingslogs[ dir ] = camsettings.settingslog( os.path.join( dir, 'settings.jsonl' ) )
+        return self.settingslogs[ dir ]
+
+
+    def fetch_image( self, file_path, camno ):
+        '''
+        Reads the photo taken by trigger_image from the camera into memory
+        and deletes it from the camera, without writing any file (see
+        scandataset.py and imagewriter.py).
+
+        Returns (image data, camera settings text, see current_settings).
+        The image data is bytes, copied once out of the camera file buffer,
+        which is freed with the camera file when this returns.
+        '''
+        camera = self.open_session( camno )
+        camera_file = camera.file_get( file_path.folder, file_path.name, gp.GP_FILE_TYPE_NORMAL )
+        data = bytes( camera_file.get_data_and_size() )
+        camera.file_delete( file_path.folder, file_path.name )
+        return data, self.current_settings( camno )
+
+
+    def capture_data( self, camera_no=None ):
+        '''
+        Takes a photo with the currently selected camera, or camera number
+        camera_no, and reads it into memory through the open session.
+
+        Returns (image data, camera settings text), see fetch_image.
+        '''
+        camno = self.camno if camera_no is None else int(camera_no)
+        return self.fetch_image( self.trigger_image( camno ), camno )
+
+
+    def write_image( self, writer, camno, dir='', label='img', append_date=True ):
+        '''
+        capture_data, with the photo handed to imagewriter writer to be saved
+        as 'dir/c<num>_'+label[+date].jpg' and its settings logged as
+        download_image does.  Returns the image file name, the file is
+        written in the background.
+        '''
+        data, settings = self.capture_data( camno )
+        imgname = self.image_name( camno, dir, label, append_date ) + '.jpg'
+        return writer.put( data, imgname, settings, camno, settingslog=self.settings_log( dir ) )
+
+
+    def capture_all( self, dir='', label='img', append_date=True, writer=None ):
+        '''
+        Takes a photo with every camera at the same time, one thread per
+        camera, and saves them as 'dir/c<num>_'+label[+date].jpg' with the
+        settings in 'dir/settings.jsonl' as capture_image does, through
+        imagewriter writer if one is given.
+
+        Returns a dictionary camera_no : [imgname, error].  error is None if
+        that camera worked, otherwise imgname is None and error the message.
+        '''
+        self.open_all()
+        self.settings_log( dir ) # one log for all the threads
+        size = max( len(self.sessions), 1 )
+        if self.pool is not None and self.pool_size != size: # cameras came or went
+            self.pool.shutdown() # idle, the previous capture_all waited for its photos
+            self.pool = None
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor( max_workers=size )
+            self.pool_size = size
+        futures = {}
+        for camno in sorted( self.sessions ):
+            futures[ camno ] = self.pool.submit( self._capture_one, camno, dir, label, append_date, writer )
+        results = {}
+        for camno, future in futures.items():
+            try:
+                results[ camno ] = [ future.result(), None ]
+            except Exception as ex:
+                print('capture_all camera',camno,'error:',str(ex))
+                self.forget_camera( camno )
+                results[ camno ] = [ None, str(ex) ]
+        return results
+
+
+    def _capture_one( self, camno, dir, label, append_date, writer=None ):
+        if writer is not None:
+            return self.write_image( writer, camno, dir, label, append_date )
+        file_path = self.trigger_image( camno )
+        return self.download_image( file_path, camno, dir, label, append_date )
+
+
+    def capture_image( self , dir='', label='img', append_date=True, writer=None ):
         '''
         Takes a photo from the currently selected camera and saves it as filename:
         'dir/c<num>_'+label[+date].jpg'
+        With an imagewriter writer the photo is read into memory and written
+        in the background, see write_image.
 
-        Stores the camera settings in:
-        'dir/c<unm>_'+label[+date].txt'
+        Stores the camera settings in 'dir/settings.jsonl' when they
+        changed since the last photo of this camera (see camsettings.py).
+
+        Capture and download go through the open camera connection, no
+        gphoto2 process is started and the camera is not reconnected.
         '''
         try:
             serno = self.get_camera_serno(  )
@@ -287,50 +629,17 @@ class pgcamera:
             if int(camno) < 0:
                 print('capture_image error, unknown camera nubmer')
                 return
-            imgname = dir+'/'
-            if dir == '':
-                imgname = '';
-            imgname = imgname + 'c' + str(camno) + '_' + label
-            if append_date:
-                imgname = imgname + time.strftime('%Y%m%d-%H:%M:%S%Z')
-            metaname = imgname + '.txt'
-            imgname = imgname + '.jpg'
-            cfg = self.camera.get_config()
-            capturetarget_cfg = cfg.get_child_by_name('capturetarget')
-            capturetarget = capturetarget_cfg.get_value()
-            capturetarget_cfg.set_value('Internal RAM')
-            self.camera.set_config(cfg)
-            time.sleep(1)
             print('Capture image!')
-            #evtype, evdata = self.camera.wait_for_event( 10000 )#########*****
-            #self.camera.wait_for_event( 10000 )
-            port = self.get_camera_port( camno )
-            command = ['gphoto2',
-                       '--wait-event=7s',
-                       '--capture-image-and-download',
-                       '--port='+port,
-                       '--filename='+imgname ]
-            print(command)
-            self.camera.exit()
-            subprocess.run( command )
-            print('Done collecting image')
-            self.camera = gp.Camera()
-
-            #file_path = self.camera.capture( gp.GP_CAPTURE_IMAGE )
-            #file_path = self.camera.capture( gp.GP_OPERATION_CAPTURE_PREVIEW )
-            #time.sleep(1) # sleep 1 second
-            #print('Copying image to',imgname)
-            #camera_file = self.camera.file_get( file_path.folder, file_path.name, gp.GP_FILE_TYPE_NORMAL)
-            #time.sleep(0.5) # sleep 1/2 second
-            #camera_file.save( imgname )
-            #self.camera.file_delete( file_path.folder, file_path.name )
-            print('Copying done.')
-            self.capture_abilities( metaname )
-            print('Metadata saved to: ',metaname)
-            capturetarget_cfg.set_value(capturetarget)
-            self.camera.set_config(cfg)
+            if writer is not None:
+                imgname = self.write_image( writer, camno, dir, label, append_date )
+                print('Image queued to be saved to: ',imgname)
+                return imgname
+            file_path = self.trigger_image()
+            imgname = self.download_image( file_path, camno, dir, label, append_date )
+            print('Image and metadata saved to: ',imgname)
+            return imgname
 
         except gp.GPhoto2Error as ex:
             print('capture_image error!')
             print(str(ex))
-
+            self.forget_camera( self.camno )
@@ -0,0 +1,174 @@
+'''
+
+posjournal.py
+
+posjournal class: append-only, checksummed log of gantry positions that
+replaces rewriting galil_last_position.txt after every move.
+
+Each record is one text line
+
+  <seq> <unix time> <x> <y> <z> <theta> <phi> <crc32>
+
+with the positions in counts and the crc32 (hex) taken over the rest of
+the line.  A record cut short by a crash or power loss fails its crc and
+is skipped, so recover() always returns the last complete position.
+
+append() only queues the record; a writer thread writes it and calls
+fsync at most once every sync_interval seconds, so the motion loop never
+waits for the disk.  flush() waits until everything queued is on disk.
+When opened, the journal is compacted to its last valid record.
+
+Usage:
+
+  > journal = posjournal('galil_last_position.journal')
+  > journal.recover()                       # last saved (x,y,z,theta,phi) or None
+  > journal.append( (1000,2000,0,0,0) )
+  > journal.close()
+'''
+
+import os
+import threading
+import time
+import zlib
+
+
+def _crc( text ):
+    return '%08x' % ( zlib.crc32( text.encode() ) & 0xffffffff )
+
+
+def parse_record( line ):
+    '''
+    Returns (seq, time, position) of a journal line, or None if the line
+    is incomplete or its checksum does not match.
+    '''
+    fields = line.rstrip('\n').split(' ')
+    if not line.endswith('\n') or len(fields) != 8:
+        return None
+    text = ' '.join( fields[:7] )
+    if _crc( text ) != fields[7]:
+        return None
+    try:
+        return int(fields[0]), float(fields[1]), tuple( float(v) for v in fields[2:7] )
+    except ValueError:
+        return None
+
+
+class posjournal:
+
+    def __init__( self, fname='galil_last_position.journal', sync_interval=0.5 ):
+        '''
+        fname         : journal file, created if it doesn't exist
+        sync_interval : longest time (s) a written record may wait for fsync
+        '''
+        self.fname = fname
+        self.sync_interval = sync_interval
+        self.last = self._compact()
+        self.seq = self.last[0] if self.last is not None else 0
+        self.synced = self.seq
+        self.pending = []
+        self.sync_requested = False
+        self.closing = False
+        self.cond = threading.Condition()
+        self.f = open( self.fname, 'a' )
+        self.thread = threading.Thread( target=self._run, daemon=True )
+        self.thread.start()
+
+    def _read( self ):
+        '''
+        last valid record in the file, or None
+        '''
+        last = None
+        if not os.path.exists( self.fname ):
+            return None
+        with open( self.fname, 'r', errors='replace' ) as f:
+            for line in f:
+                record = parse_record( line )
+                if record is not None:
+                    last = record
+        return last
+
+    def _compact( self ):
+        '''
+        Rewrite the journal with only its last valid record, through a
+        temporary file so a crash leaves either the old or the new file.
+        '''
+        last = self._read()
+        if last is None:
+            return None
+        tmpname = self.fname + '.tmp'
+        with open( tmpname, 'w' ) as f:
+            f.write( self._format( *last ) )
+            f.flush()
+            os.fsync( f.fileno() )
+        os.replace( tmpname, self.fname )
+        return last
+
+    def _format( self, seq, t, pos ):
+        text = '%d %.3f %s' % ( seq, t, ' '.join( '%d' % round(p) for p in pos ) )
+        return text + ' ' + _crc( text ) + '\n'
+
+    def recover( self ):
+        '''
+        Returns the last position (x,y,z,theta,phi) recorded, None if the
+        journal has no valid record.
+        '''
+        with self.cond:
+            return self.last[2] if self.last is not None else None
+
+    def append( self, pos ):
+        '''
+        Queue position (x,y,z,theta,phi) in counts, returns without waiting
+        for the disk.
+        '''
+        with self.cond:
+            self.seq += 1
+            self.last = ( self.seq, time.time(), tuple(pos) )
+            self.pending.append( self._format( *self.last ) )
+            self.cond.notify_all()
+
+    def flush( self ):
+        '''
+        Wait until every queued record is written and synced to disk.
+        '''
+        with self.cond:
+            self.sync_requested = True
+            self.cond.notify_all()
+            while self.synced < self.seq and self.thread.is_alive():
+                self.cond.wait()
+
+    def close( self ):
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.f.close()
+
+    def _run( self ):
+        unsynced = False
+        last_sync = time.time()
+        while True:
+            with self.cond:
+                if not self.pending and not self.closing and not self.sync_requested:
+                    timeout = None
+                    if unsynced:
+                        timeout = max( self.sync_interval - ( time.time() - last_sync ), 0. )
+                    self.cond.wait( timeout )
+                records, self.pending = self.pending, []
+                seq = self.seq
+                closing = self.closing
+                sync_now = self.sync_requested or closing
+                self.sync_requested = False
+            if records:
+                self.f.write( ''.join( records ) )
+                self.f.flush()
+                unsynced = True
+            if unsynced and ( sync_now or time.time() - last_sync >= self.sync_interval ):
+                os.fsync( self.f.fileno() )
+                last_sync = time.time()
+                unsynced = False
+            if not unsynced:
+                with self.cond:
+                    self.synced = seq
+                    self.cond.notify_all()
+            if closing:
+                return
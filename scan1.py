@@ -1,6 +1,5 @@
 import pgcamera as pg
 import gantrycontrol as gc
-import time
 
 gantry = gc.gantrycontrol()
 pgc = pg.pgcamera()
@@ -18,7 +17,6 @@ zstep = int(zmax/nz)
 
 # zero the gantry
 gantry.locate_home_xyz()
-time.sleep(1)
 # move to the xfix position
 gantry.move( 100, 0, 0,0,0) # move to 100 mm
 #gantry.move_rel( xfix, 0, 0 )
@@ -34,11 +32,9 @@ for i in range( nz ):
         print(label)
         #pgc.capture_image( '', label, False )
         gantry.move_rel( 0, ystep, 0 )
-        time.sleep(1)
     gantry.move_rel( 0, 0, zstep )
     # flip sign of y step to step back!
     ystep = -ystep
-    time.sleep(1)
 '''
 print('Done scan')
 del gantry
@@ -1,8 +1,13 @@
+import os
+import time
 import pgcamera as pg
 import gantrycontrol as gc
-import time
+import scanplan
+import scanengine
+import scancheckpoint
 
-gantry = gc.gantrycontrol()
+gantry = gc.gantrycontrol( exit_on_error=False ) # controller errors raise, so moves can be retried
+pgc = pg.pgcamera() # one camera connection for the whole scan
 
 # scan in a plane
 x_top = 0
@@ -17,40 +22,31 @@ z_bot = 67000
 nxy  = 20 # step x and y together
 nz   = 20
 
-xstep = int( (x_bot - x_top)/nxy)
-ystep = int( (y_bot - y_top)/nxy)
-zstep = int(z_bot/nz)
-
-# zero the gantry
-gantry.locate_home_xyz()
-print('done locating home')
-# move to the top position
-gantry.move_rel( x_top, y_top, z_top )
-time.sleep(1) # seconds
-print('done moving relative')
-
-curx = x_top
-cury = y_top
-# scan in z
-for i in range( nz ):
-    curz = zstep*i
-    # scan in xy
-    for j in range( nxy ):
-        pgc = pg.pgcamera()
-        curx += xstep
-        cury += ystep
-        label = 'scan2_z'+str(curz)+'_y'+str(cury)+'_x'+str(curx)
-        print(label)
-        pgc.capture_image( '.', label, True )
-        gantry.move_rel( xstep, ystep, 0 )
-        time.sleep(1)
-        del pgc
-    gantry.move_rel( 0, 0, zstep )
-    # flip sign of the x and y step to step back!
-    xstep = -xstep
-    ystep = -ystep
-    time.sleep(1)
-
-print('Done scan')
+# same points as stepping x and y together in each z plane, back and forth;
+# theta and phi are not scanned, they stay where they are
+angles = gantry.get_cur_pos()[3:]
+points = scanplan.diagonal( (x_top,y_top,z_top), (x_bot,y_bot,z_bot), nxy, nz, base=(0,0,0)+tuple(angles) ).tolist()
+labels = [ 'scan2_z'+str(int(p[2]))+'_y'+str(int(p[1]))+'_x'+str(int(p[0])) for p in points ]
+
+# points done so far: after a fault run the script again to finish the scan
+checkpoint_name = 'scan2.checkpoint'
+checkpoint = scancheckpoint.scancheckpoint( checkpoint_name )
+
+if len( checkpoint.completed() ) == 0:
+    # zero the gantry
+    gantry.locate_home_xyz()
+    print('done locating home')
+
+engine = scanengine.scanengine( gantry, pgc, dir='.', append_date=True )
+results = engine.run( points, labels, checkpoint )
+checkpoint.close()
+
+failed = [ r[0] for r in results if r[2] is None ]
+if len(failed) == 0:
+    # keep the record, a new scan starts from scratch
+    os.replace( checkpoint_name, checkpoint_name+time.strftime('.%Y%m%d-%H%M%S') )
+    print('Done scan')
+else:
+    print('Scan finished without images for',len(failed),'points, run again to retake them:',failed)
 del gantry
-
+del pgc
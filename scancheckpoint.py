@@ -0,0 +1,102 @@
+'''
+
+scancheckpoint.py
+
+scancheckpoint class: record of the points of a scan that are done, so an
+interrupted scan can be restarted where it stopped (see scanengine.run).
+
+The checkpoint file has one JSON line per completed point
+
+  {"label": ..., "point": [x,y,z,theta,phi], "imgname": ..., "sha256": ..., "time": ...}
+
+written and synced as soon as the image of that point is saved.  A line
+cut short by a crash is ignored when the file is read.  A point only
+counts as done if its image is still there with the same sha256.
+imgname is a file name, or a 'dataset#row' reference for images stored
+in a scandataset.
+
+Usage:
+
+  > import scancheckpoint
+  > checkpoint = scancheckpoint.scancheckpoint( 'scan2.checkpoint' )
+  > checkpoint.completed()          # label : record of the points done
+  > checkpoint.add( 'z0_y0_x0', (0,0,0,0,0), 'c1_z0_y0_x0.jpg' )
+  > checkpoint.close()
+'''
+
+import hashlib
+import json
+import os
+import time
+import scandataset
+
+
+def file_hash( fname ):
+    '''
+    sha256 (hex) of the contents of file fname
+    '''
+    h = hashlib.sha256()
+    with open( fname, 'rb' ) as f:
+        for block in iter( lambda : f.read( 1 << 20 ), b'' ):
+            h.update( block )
+    return h.hexdigest()
+
+
+class scancheckpoint:
+
+    def __init__( self, fname ):
+        '''
+        fname : checkpoint file, created if it doesn't exist
+        '''
+        self.fname = fname
+        self.records = {}
+        if os.path.exists( fname ):
+            with open( fname, 'r' ) as f:
+                for line in f:
+                    try:
+                        record = json.loads( line )
+                    except ValueError:
+                        continue # incomplete last line
+                    self.records[ record['label'] ] = record
+        self.f = open( fname, 'a' )
+
+    def completed( self, verify=True ):
+        '''
+        Returns label : record of the points done.  With verify, points whose
+        image is missing or changed are left out, so they are taken again.
+        '''
+        done = {}
+        readers = {}
+        for label, record in self.records.items():
+            if verify:
+                ref = scandataset.parse_ref( record['imgname'] )
+                if ref is not None:
+                    if ref[0] not in readers:
+                        readers[ ref[0] ] = scandataset.scanreader( ref[0] )
+                    reader = readers[ ref[0] ]
+                    try:
+                        intact = ref[1] < len(reader) and reader.sha256( ref[1] ) == record['sha256']
+                    except ( OSError, ValueError ):
+                        intact = False # chunk file missing or empty
+                else:
+                    intact = os.path.exists( record['imgname'] ) and file_hash( record['imgname'] ) == record['sha256']
+                if not intact:
+                    print('checkpoint: image of',label,'missing or changed, point will be redone')
+                    continue
+            done[ label ] = record
+        return done
+
+    def add( self, label, point, imgname, sha256=None ):
+        '''
+        Record point label as done, with its image imgname, on disk before returning.
+        sha256 : hash of the image if already known, read from imgname otherwise
+        '''
+        record = { 'label' : label, 'point' : [ float(p) for p in point ], 'imgname' : imgname,
+                   'sha256' : sha256 if sha256 is not None else file_hash( imgname ), 'time' : time.time() }
+        self.f.write( json.dumps( record ) + '\n' )
+        self.f.flush()
+        os.fsync( self.f.fileno() )
+        self.records[ label ] = record
+
+    def close( self ):
+        self.f.close()
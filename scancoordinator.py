@@ -0,0 +1,235 @@
+'''
+
+scancoordinator.py
+
+scancoordinator class: keeps several gantries (test stands, each on its
+own controller, see the address and axes of gantrycontrol) busy from one
+process.  Every stand runs in a thread of its own and takes the next scan
+from a common queue, running it with scanengine.  The stands share the
+pgcamera and one camera lock, so the camera connections are used by one
+thread at a time while the moves of the stands overlap.
+
+A scan is for any stand, or for a named one.  A stand stops taking scans
+once a scan fails on it (a GantryError after the retries, the motors are
+off): its scans are failed, scans for any stand go to the others, or are
+failed once no stand is left.  Make the gantries with exit_on_error=False,
+so a fault ends the scan rather than the thread.  Scans still queued when
+the coordinator is closed are failed too, so scan.wait() always returns.
+
+Usage:
+
+  > import gantrycontrol, pgcamera, scancoordinator
+  > pgc = pgcamera.pgcamera()
+  > coordinator = scancoordinator.scancoordinator( pgc )
+  > coordinator.add_stand( 'stand1', gantrycontrol.gantrycontrol( 'stand1_position.txt', exit_on_error=False ),
+  >                        camno=0 )
+  > coordinator.add_stand( 'stand2', gantrycontrol.gantrycontrol( 'stand2_position.txt', exit_on_error=False,
+  >                        address='192.168.42.11 -s ALL' ), camno=1, settle=0.2 ) # scanengine options
+  > coordinator.start()
+  > scan = coordinator.submit( points, dir='run1' )              # on the first stand free
+  > coordinator.submit( points2, dir='run2', stand='stand2' )    # on stand2 only
+  > results = scan.wait()                 # as scanengine.run, scan.stand is where it ran, scan.error
+  > coordinator.join()                    # until all scans are done
+  > coordinator.close()                   # stop the stand threads
+'''
+
+import threading
+import scanengine
+
+
+class scanjob:
+    '''
+    A scan in the queue of a scancoordinator, see scancoordinator.submit.
+    '''
+
+    def __init__( self, points, labels=None, dir='.', stand=None, checkpoint=None, dataset=None ):
+        self.points = points
+        self.labels = labels
+        self.dir = dir
+        self.stand = stand         # stand name, None for any until it runs
+        self.checkpoint = checkpoint
+        self.dataset = dataset
+        self.results = None        # list of scanengine.run
+        self.error = None          # message if the scan failed
+        self.done = threading.Event()
+
+    def wait( self, timeout=None ):
+        '''
+        Waits until the scan is over, returns its results (None if it failed
+        or on timeout).
+        '''
+        self.done.wait( timeout )
+        return self.results
+
+
+class scanstand:
+    '''
+    A gantry of a scancoordinator with its camera and scanengine options.
+    '''
+
+    def __init__( self, name, gantry, camno=None, options=None ):
+        self.name = name
+        self.gantry = gantry
+        self.camno = camno
+        self.options = options or {}
+        self.job = None            # scanjob running
+        self.scans = 0             # scans done
+        self.error = None          # why the stand stopped
+        self.thread = None
+
+
+class scancoordinator:
+
+    def __init__( self, camera, tracer=None ):
+        '''
+        camera : pgcamera object shared by the stands
+        tracer : optional scantrace.scantrace, the phases of all the scans
+                 are recorded in, one thread per stand
+        '''
+        self.camera = camera
+        self.tracer = tracer
+        self.camera_lock = threading.Lock()  # held while any stand uses the camera
+        self.stands = {}                     # name : scanstand
+        self.queue = []                      # scanjobs not started yet, oldest first
+        self.cond = threading.Condition()
+        self.running = False
+        self.closed = False                  # close was called, scans submitted are failed
+
+    def add_stand( self, name, gantry, camno=None, **options ):
+        '''
+        Add gantrycontrol gantry as stand name, taking its photos with
+        camera number camno.  options go to its scanengine (settle, speed,
+        retries, append_date).
+        '''
+        with self.cond:
+            if name in self.stands:
+                raise ValueError('there is already a stand '+name)
+            stand = scanstand( name, gantry, camno, options )
+            self.stands[ name ] = stand
+            if self.running:
+                self._start( stand )
+        return stand
+
+    def submit( self, points, labels=None, dir='.', stand=None, checkpoint=None, dataset=None ):
+        '''
+        Queue the scan of points (absolute positions in counts), on stand
+        stand or on any.  labels, checkpoint and dataset are as in
+        scanengine, dir is where the images go.  Returns the scanjob.
+        '''
+        job = scanjob( points, labels, dir, stand, checkpoint, dataset )
+        with self.cond:
+            if self.closed:
+                self._fail( job, 'coordinator closed' )
+                return job
+            if stand is not None:
+                if stand not in self.stands:
+                    raise ValueError('no stand '+str(stand))
+                if self.stands[ stand ].error is not None:
+                    self._fail( job, 'stand '+stand+' stopped: '+self.stands[ stand ].error )
+                    return job
+            self.queue.append( job )
+            self._fail_orphans() # every stand may have stopped already
+            self.cond.notify_all()
+        return job
+
+    def start( self ):
+        '''
+        Start the stand threads, they run the queued scans.
+        '''
+        with self.cond:
+            self.running = True
+            self.closed = False
+            for stand in self.stands.values():
+                if stand.thread is None and stand.error is None:
+                    self._start( stand )
+
+    def _start( self, stand ):
+        stand.thread = threading.Thread( target=self._run, args=(stand,), name=stand.name, daemon=True )
+        stand.thread.start()
+
+    def _next( self, stand ):
+        '''
+        Next scan stand can run, None once the coordinator is closed.
+        '''
+        with self.cond:
+            while self.running:
+                for job in self.queue:
+                    if job.stand is None or job.stand == stand.name:
+                        self.queue.remove( job )
+                        job.stand = stand.name
+                        stand.job = job
+                        return job
+                self.cond.wait()
+            return None
+
+    def _run( self, stand ):
+        while True:
+            job = self._next( stand )
+            if job is None:
+                return
+            try:
+                engine = scanengine.scanengine( stand.gantry, self.camera, dir=job.dir, dataset=job.dataset,
+                                                tracer=self.tracer, camno=stand.camno, camera_lock=self.camera_lock,
+                                                **stand.options )
+                job.results = engine.run( job.points, job.labels, job.checkpoint )
+            except ( Exception, SystemExit ) as ex: # SystemExit: gantrycontrol made with exit_on_error
+                print('stand',stand.name,'stopped, scan failed:',ex)
+                with self.cond:
+                    stand.job = None
+                    stand.error = str(ex) or type(ex).__name__
+                    self._fail( job, stand.error )
+                    self._fail_orphans()
+                    self.cond.notify_all()
+                return
+            with self.cond:
+                stand.job = None
+                stand.scans += 1
+                job.done.set()
+                self.cond.notify_all()
+
+    def _fail( self, job, error ):
+        job.error = error
+        job.done.set()
+
+    def _fail_orphans( self ):
+        '''
+        Fail the queued scans no stand left can run (called with cond held).
+        Scans for any stand wait while no stand was added yet.
+        '''
+        alive = [ name for name, stand in self.stands.items() if stand.error is None ]
+        for job in list( self.queue ):
+            if ( job.stand is None and len(alive) == 0 and len(self.stands) > 0 ) or ( job.stand is not None and job.stand not in alive ):
+                self.queue.remove( job )
+                self._fail( job, 'no stand left to run the scan' if job.stand is None else
+                                 'stand '+job.stand+' stopped: '+self.stands[ job.stand ].error )
+
+    def busy( self ):
+        '''
+        number of scans queued or running
+        '''
+        with self.cond:
+            return len(self.queue) + sum( 1 for stand in self.stands.values() if stand.job is not None )
+
+    def join( self, timeout=None ):
+        '''
+        Wait until all the scans submitted are over, returns False on timeout.
+        '''
+        with self.cond:
+            return self.cond.wait_for( lambda : self.busy() == 0, timeout )
+
+    def close( self ):
+        '''
+        Stop the stand threads once their running scans are over.  Scans
+        still queued, and scans submitted afterwards, are failed.
+        '''
+        with self.cond:
+            self.running = False
+            self.closed = True
+            for job in self.queue:
+                self._fail( job, 'coordinator closed' )
+            self.queue = []
+            self.cond.notify_all()
+        for stand in self.stands.values():
+            if stand.thread is not None:
+                stand.thread.join()
+                stand.thread = None
@@ -0,0 +1,234 @@
+'''
+
+scandataset.py
+
+Scan output as a few large files instead of one .jpg and one .txt per
+point.  A dataset is a directory with
+
+  chunk_00000.bin, chunk_00001.bin ...  images, back to back
+  index.jsonl                           one line per image, written as it is added
+  index.npz                             the same index as columns, written by close()
+  settings.jsonl                        camera settings, when they change (camsettings.py)
+
+The index holds for every image: label, x, y, z, theta, phi (counts),
+camera number, time, chunk, byte offset and length of the image, the
+sha256 of the image and the sha256 of the camera settings it was taken
+with.
+
+scanwriter streams images into the chunks; a new chunk is started when
+the current one would pass chunk_size bytes.  Bytes are written before
+their index line, so a crash never leaves an index line without its
+image.  Opening an existing dataset appends to it.
+
+scanreader loads the index as NumPy columns and reads images through
+memory maps of the chunks, so selecting by position and reading a few
+images doesn't touch the rest of the data.
+
+Usage:
+
+  > import scandataset
+  > ds = scandataset.scanwriter( 'scan2_data' )
+  > ref = ds.add( jpeg_bytes, settings_text, (1000,62000,0,0,0), camno=1, label='z0_y62000_x1000' )
+  > ds.close()
+  > rd = scandataset.scanreader( 'scan2_data' )
+  > rows = rd.select( z=0, x=(0,50000) )     # rows with z == 0 and 0 <= x <= 50000
+  > jpeg = rd.image( rows[0] )               # uint8 array mapped from the chunk file
+  > rd.save_image( rows[0], 'one.jpg' )
+  > rd.index['x'][rows]                      # index columns
+'''
+
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import camsettings
+
+CHUNK = 'chunk_%05d.bin'
+INDEX_LOG = 'index.jsonl'
+INDEX = 'index.npz'
+SETTINGS = 'settings.jsonl'
+COORDINATES = ( 'x', 'y', 'z', 'theta', 'phi' )
+COLUMNS = { 'label' : str, 'x' : np.float64, 'y' : np.float64, 'z' : np.float64, 'theta' : np.float64,
+            'phi' : np.float64, 'camno' : np.int32, 'time' : np.float64, 'chunk' : np.int32,
+            'offset' : np.int64, 'length' : np.int64, 'sha256' : str, 'settings' : str }
+
+
+def _read_log( dirname ):
+    rows = []
+    fname = os.path.join( dirname, INDEX_LOG )
+    if not os.path.exists( fname ):
+        return rows
+    with open( fname, 'r' ) as f:
+        for line in f:
+            try:
+                rows.append( json.loads( line ) )
+            except ValueError:
+                pass # incomplete last line
+    return rows
+
+
+def _columns( rows ):
+    index = {}
+    for name, dtype in COLUMNS.items():
+        values = [ row[name] for row in rows ]
+        index[ name ] = np.array( values, dtype=dtype ) if dtype is not str else np.array( values, dtype='U' )
+    return index
+
+
+def parse_ref( ref ):
+    '''
+    (dataset directory, row) of a reference returned by scanwriter.add, None
+    if ref is a plain file name
+    '''
+    dirname, sep, row = ref.rpartition('#')
+    if sep == '' or not row.isdigit() or not os.path.isdir( dirname ):
+        return None
+    return dirname, int(row)
+
+
+class scanwriter:
+
+    def __init__( self, dirname, chunk_size=1 << 30 ):
+        '''
+        dirname    : dataset directory, created or appended to
+        chunk_size : bytes after which a new chunk file is started
+        '''
+        self.dirname = dirname
+        self.chunk_size = chunk_size
+        os.makedirs( dirname, exist_ok=True )
+        self.rows = _read_log( dirname )
+        self.chunk = max( [ row['chunk'] for row in self.rows ], default=-1 ) + 1 # never append to an old chunk
+        self.f = None
+        self.log = open( os.path.join( dirname, INDEX_LOG ), 'a' )
+        self.settings = camsettings.settingslog( os.path.join( dirname, SETTINGS ) )
+
+    def _chunk_file( self, size ):
+        if self.f is not None and self.f.tell() + size > self.chunk_size and self.f.tell() > 0:
+            self.f.close()
+            self.f = None
+            self.chunk += 1
+        if self.f is None:
+            self.f = open( os.path.join( self.dirname, CHUNK % self.chunk ), 'ab' )
+        return self.f
+
+    def add( self, data, settings, point, camno, label, sha256=None ):
+        '''
+        data     : image bytes
+        settings : settings text of the camera, None for none.  Stored once
+                   per camera until it changes.
+        point    : gantry position (x,y,z,theta,phi) in counts
+        Returns the reference 'dirname#row' of the image.
+        '''
+        ref = self.dirname + '#' + str( len(self.rows) )
+        f = self._chunk_file( len(data) )
+        offset = f.tell()
+        f.write( data )
+        f.flush()
+        row = { 'label' : label, 'camno' : int(camno), 'time' : time.time(), 'chunk' : self.chunk,
+                'offset' : offset, 'length' : len(data),
+                'sha256' : sha256 if sha256 is not None else hashlib.sha256( data ).hexdigest(),
+                'settings' : self.settings.record( int(camno), settings, ref ) if settings is not None else '' }
+        for name, value in zip( COORDINATES, point ):
+            row[ name ] = float( value )
+        self.log.write( json.dumps( row ) + '\n' )
+        self.log.flush()
+        self.rows.append( row )
+        return ref
+
+    def add_file( self, imgname, point, camno, label, metaname=None ):
+        '''
+        Add an existing image file, and its settings file, e.g. to pack
+        the output of pgcamera.capture_image.
+        '''
+        with open( imgname, 'rb' ) as f:
+            data = f.read()
+        settings = None
+        if metaname is not None and os.path.exists( metaname ):
+            with open( metaname, 'r' ) as f:
+                settings = f.read()
+        return self.add( data, settings, point, camno, label )
+
+    def close( self ):
+        '''
+        Sync everything to disk and write the columnar index.
+        '''
+        for f in ( self.f, self.log ):
+            if f is not None:
+                f.flush()
+                os.fsync( f.fileno() )
+                f.close()
+        self.f = None
+        self.settings.close()
+        tmpname = os.path.join( self.dirname, 'index.tmp.npz' )
+        np.savez( tmpname, **_columns( self.rows ) )
+        os.replace( tmpname, os.path.join( self.dirname, INDEX ) )
+
+
+class scanreader:
+
+    def __init__( self, dirname ):
+        '''
+        Load the index of the dataset in dirname.  The columnar index is used
+        if it is up to date, the index log otherwise (dataset still being
+        written, or not closed).
+        '''
+        self.dirname = dirname
+        npz = os.path.join( dirname, INDEX )
+        log = os.path.join( dirname, INDEX_LOG )
+        if os.path.exists( npz ) and ( not os.path.exists( log ) or os.path.getmtime( npz ) >= os.path.getmtime( log ) ):
+            with np.load( npz ) as data:
+                self.index = dict( ( name, data[name] ) for name in data.files )
+        else:
+            self.index = _columns( _read_log( dirname ) )
+        self.settings = camsettings.settingslog( os.path.join( dirname, SETTINGS ), readonly=True )
+        self.maps = {}
+
+    def __len__( self ):
+        return len( self.index['label'] )
+
+    def select( self, **conditions ):
+        '''
+        Rows matching all conditions, column=value or column=(low,high)
+        (inclusive), e.g. select( z=0, x=(0,50000), camno=1 ).
+        '''
+        mask = np.ones( len(self), dtype=bool )
+        for name, condition in conditions.items():
+            column = self.index[ name ]
+            if isinstance( condition, tuple ):
+                mask &= ( column >= condition[0] ) & ( column <= condition[1] )
+            else:
+                mask &= column == condition
+        return np.nonzero( mask )[0]
+
+    def _map( self, chunk ):
+        if chunk not in self.maps:
+            self.maps[ chunk ] = np.memmap( os.path.join( self.dirname, CHUNK % chunk ), dtype=np.uint8, mode='r' )
+        return self.maps[ chunk ]
+
+    def image( self, row ):
+        '''
+        image bytes of row, as a uint8 array mapped from its chunk (no copy)
+        '''
+        offset = int( self.index['offset'][row] )
+        return self._map( int( self.index['chunk'][row] ) )[ offset : offset + int( self.index['length'][row] ) ]
+
+    def metadata( self, row ):
+        '''
+        camera settings text of row, '' if none were stored
+        '''
+        sha = str( self.index['settings'][row] )
+        return self.settings.text( sha ) if sha != '' else ''
+
+    def sha256( self, row ):
+        '''
+        sha256 of the image bytes as stored now
+        '''
+        return hashlib.sha256( self.image( row ) ).hexdigest()
+
+    def save_image( self, row, fname ):
+        with open( fname, 'wb' ) as f:
+            f.write( self.image( row ) )
+
+    def close( self ):
+        self.maps = {}
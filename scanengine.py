@@ -0,0 +1,345 @@
+'''
+
+scanengine.py
+
+scanengine class: runs a scan with a gantrycontrol and a pgcamera object,
+overlapping the image download of one point with the move to the next.
+
+At each point the gantry moves, the camera takes the photo (trigger_image
+returns once the shutter has closed) and the download of the photo plus
+its settings are handed to a worker thread.  The main thread then
+starts the next move right away.  The next photo is only taken after the
+worker is done with the camera, and the worker handles the photos in the
+order they were taken, so every image gets the label of its own point.
+
+Usage:
+
+  > import gantrycontrol as gc
+  > import pgcamera as pg
+  > import scanengine as se
+  > gantry = gc.gantrycontrol()
+  > pgc = pg.pgcamera()
+  > engine = se.scanengine( gantry, pgc, dir='.' )
+  > results = engine.run( [ (1000,62000,0,0,0), (7500,60900,0,0,0) ] )
+  > for label, point, imgname, error in results: print( label, imgname )
+  > import scancheckpoint
+  > checkpoint = scancheckpoint.scancheckpoint( 'scan.checkpoint' )
+  > results = engine.run( points, checkpoint=checkpoint )  # run again after a fault: the points
+  >                                                      # already done are skipped
+  > results = engine.run_program( points, exposure=1. )   # controller runs the scan and
+  >                                                      # triggers the camera (dmcprogram.py)
+  > import scandataset
+  > engine = se.scanengine( gantry, pgc, dataset=scandataset.scanwriter( 'scan_data' ) )
+  > results = engine.run( points )                       # images go to the dataset, imgname
+  > engine.dataset.close()                               # is 'scan_data#row'
+  > import scantrace
+  > engine = se.scanengine( gantry, pgc, tracer=scantrace.scantrace() )
+  > results = engine.run( points )                       # move, settle, capture, download and
+  > engine.tracer.export( 'scan.trace.json' )            # metadata timed per point (scantrace.py)
+  > import imagewriter
+  > engine = se.scanengine( gantry, pgc, writer=imagewriter.imagewriter( maxsize=8 ) )
+  > results = engine.run( points )                       # photos read into memory, written by the
+                                                         # writer thread (imagewriter.py)
+
+'''
+
+import hashlib
+import queue
+import threading
+import time
+import gantrycontrol
+import scantrace
+
+
+class scanengine:
+
+    def __init__( self, gantry, camera, dir='.', append_date=True, settle=0., speed=None, retries=2, dataset=None,
+                  tracer=None, camno=None, camera_lock=None, writer=None, pending=8 ):
+        '''
+        gantry      : gantrycontrol object
+        camera      : pgcamera object, set to the camera to use
+        dir         : directory the images and settings files are written to
+        append_date : append the date to the image names, as capture_image does
+        settle      : seconds to wait after each move before taking the photo
+        speed       : speed of each axis in counts/s for the moves, None for
+                      synchronized axes (see gantrycontrol.motion_settings)
+        retries     : times a failed move, photo or download is tried again
+                      before the scan stops (moves) or the point is given up
+                      (photos).  Moves are only retried if the gantrycontrol
+                      was made with exit_on_error=False.
+        dataset     : optional scandataset.scanwriter the images and settings
+                      are written to, instead of one .jpg per point
+                      in dir
+        tracer      : optional scantrace.scantrace the phases of every point
+                      are recorded in
+        camno       : camera number to take the photos with, by default the
+                      one the pgcamera is set to
+        camera_lock : lock held while the camera is in use, to share camera
+                      with other scans running at the same time (see
+                      scancoordinator.py); a lock of its own by default
+        writer      : optional imagewriter.imagewriter: the photos are read
+                      into memory and handed to it to be written (to files
+                      in dir, or to its dataset), instead of being written
+                      by the download thread
+        pending     : photos taken and not downloaded yet before run waits
+                      to move on, so a slow download or a full writer
+                      holds the scan at a point instead of filling the
+                      camera memory
+        '''
+        self.gantry = gantry
+        self.camera = camera
+        self.dir = dir
+        self.append_date = append_date
+        self.settle = settle
+        self.speed = speed
+        self.retries = retries
+        self.dataset = dataset
+        self.tracer = tracer
+        self.camno = camno
+        self.camera_lock = camera_lock if camera_lock is not None else threading.Lock()  # held while the camera is in use
+        self.writer = writer
+        self.pending = pending
+
+
+    def label( self, point ):
+        '''
+        default label of a point, same form as in scan2.py
+        '''
+        return 'z'+str(int(point[2]))+'_y'+str(int(point[1]))+'_x'+str(int(point[0]))
+
+
+    def camera_no( self ):
+        '''
+        number of the camera the photos are taken with
+        '''
+        if self.camno is not None:
+            return self.camno
+        with self.camera_lock:
+            return self.camera.get_camera_no( self.camera.get_camera_serno() )
+
+
+    def _download_worker( self, todo, results, checkpoint=None ):
+        '''
+        Downloads the photos in todo until it gets None.  A failed download
+        is tried again on a new camera session; saving it (dataset,
+        checkpoint, writer) is done once, after the download worked.
+        '''
+        while True:
+            item = todo.get()
+            if item is None:
+                return
+            i, file_path, camno = item
+            label, point = results[i][0], results[i][1]
+            imgname, data, settings = None, None, None
+            for attempt in range( self.retries + 1 ):
+                try:
+                    with self.camera_lock, scantrace.span( self.tracer, 'download', point=i ):
+                        if attempt > 0:
+                            self.camera.close_session( camno ) # reconnects at the download
+                        if self.dataset is None and self.writer is None:
+                            imgname = self.camera.download_image( file_path, camno, self.dir, label, self.append_date )
+                        else:
+                            data, settings = self.camera.fetch_image( file_path, camno )
+                    break
+                except Exception as ex:
+                    results[i][3] = str(ex)
+                    print('Point',i,'download error:',ex)
+            else:
+                continue # no image
+            try:
+                if self.writer is not None:
+                    with scantrace.span( self.tracer, 'write queue', point=i ):
+                        self._write( data, settings, i, camno, results, checkpoint )
+                    print('Point',i,'queued to be written')
+                    continue
+                sha256 = None
+                with scantrace.span( self.tracer, 'metadata', point=i ):
+                    if self.dataset is not None:
+                        sha256 = hashlib.sha256( data ).hexdigest()
+                        imgname = self.dataset.add( data, settings, point, camno, label, sha256 )
+                    if checkpoint is not None:
+                        checkpoint.add( label, point, imgname, sha256 )
+                results[i][2] = imgname
+                results[i][3] = None
+                print('Point',i,'saved to',imgname)
+            except Exception as ex:
+                results[i][3] = str(ex)
+                print('Point',i,'save error:',ex)
+
+
+    def _write( self, data, settings, i, camno, results, checkpoint ):
+        '''
+        Hand the photo of point i to the writer, results and checkpoint are
+        updated once it is written.
+        '''
+        label, point = results[i][0], results[i][1]
+        def written( record ):
+            results[i][2] = record['imgname'] if record['error'] is None else None
+            results[i][3] = record['error']
+            if record['error'] is None and checkpoint is not None:
+                # a compressed file is hashed again as it is on disk
+                checkpoint.add( label, point, record['imgname'], record['sha256'] if self.writer.compress is None else None )
+        fname, settingslog = None, None
+        if self.writer.dataset is None:
+            fname = self.camera.image_name( camno, self.dir, label, self.append_date ) + '.jpg'
+            settingslog = self.camera.settings_log( self.dir )
+        self.writer.put( data, fname, settings, camno, point, label, settingslog, written )
+
+
+    def _move( self, point ):
+        '''
+        Move to absolute point (counts), trying again after a GantryError.
+        '''
+        for attempt in range( self.retries + 1 ):
+            try:
+                cur = self.gantry.pos if self.gantry.pos is not None else self.gantry.get_cur_pos()
+                step = [ point[k] - cur[k] for k in range( len(point) ) ]
+                if any( s != 0 for s in step ):
+                    self.gantry.move_rel( *( list(step) + list(self.speed or ()) ) )
+                return
+            except gantrycontrol.GantryError as ex:
+                if attempt == self.retries:
+                    raise
+                print('move failed (',ex,'), trying again')
+                self.gantry.recover()
+
+
+    def _trigger( self, camno ):
+        '''
+        Take the photo, reconnecting the camera and trying again on errors.
+        '''
+        for attempt in range( self.retries + 1 ):
+            try:
+                with self.camera_lock: # waits for the previous download
+                    return self.camera.trigger_image( camno )
+            except Exception as ex:
+                if attempt == self.retries:
+                    raise
+                print('capture failed (',ex,'), trying again')
+                with self.camera_lock:
+                    self.camera.close_session( camno )
+
+
+    def verify_position( self ):
+        '''
+        Before resuming a scan: the gantry position must be known from more
+        than the saved position.  Every axis has to be homed since the gantry
+        was connected, or the position the controller counted when connected
+        (before load_position overwrote it) must agree with the saved one.
+        Otherwise the gantry may have been moved, or the controller reset,
+        while the scan was stopped, and it has to be homed first.
+        '''
+        gantry = self.gantry
+        counted, saved = gantry.connect_position, gantry.saved_position
+        tolerance = gantry.settle_tolerance
+        unknown = []
+        for i, ax in enumerate( gantry.axes ):
+            if ax in gantry.homed:
+                continue
+            if counted is None or saved is None or abs( counted[i] - saved[i] ) > tolerance[i]:
+                unknown.append( i )
+        if len(unknown) > 0:
+            raise RuntimeError('controller and saved positions differ on axes '+''.join( gantry.axes[i] for i in unknown )
+                               +' ( '+str(counted)+' vs '+str(saved)+' ), home the gantry before resuming')
+        print('position verified: homed axes',repr(gantry.homed),', controller position',counted,'saved',saved)
+
+
+    def run( self, points, labels=None, checkpoint=None ):
+        '''
+        points     : list of absolute positions (x,y,z,theta,phi) in counts
+        labels     : optional list of labels, one per point
+        checkpoint : optional scancheckpoint.scancheckpoint.  Points already
+                     in it (with their image intact) are skipped after
+                     checking the position, the others are added as their
+                     images are saved.
+
+        Returns a list with [label, point, imgname, error] for every point,
+        in the order of points.  imgname is None and error holds the message
+        if the photo of that point could not be taken or saved.
+        '''
+        if labels is None:
+            labels = [ self.label( point ) for point in points ]
+        results = [ [labels[i], points[i], None, None] for i in range( len(points) ) ]
+        done = checkpoint.completed() if checkpoint is not None else {}
+        for result in results:
+            if result[0] in done:
+                result[2] = done[ result[0] ]['imgname']
+        if len(done) > 0:
+            print('resuming scan,',sum( 1 for r in results if r[0] in done ),'of',len(points),'points already done')
+            self.verify_position()
+        camno = self.camera_no()
+        with self.camera_lock:
+            self.camera.new_scan( camno ) # settings baseline of this scan
+
+        todo = queue.Queue( self.pending )
+        worker = threading.Thread( target=self._download_worker, args=(todo, results, checkpoint) )
+        worker.start()
+        try:
+            for i, point in enumerate( points ):
+                if labels[i] in done:
+                    continue
+                with scantrace.span( self.tracer, 'move', point=i ):
+                    self._move( point )
+                if self.settle > 0:
+                    with scantrace.span( self.tracer, 'settle', point=i ):
+                        time.sleep( self.settle )
+                try:
+                    with scantrace.span( self.tracer, 'capture', point=i ):
+                        file_path = self._trigger( camno )
+                except Exception as ex:
+                    results[i][3] = str(ex)
+                    print('Point',i,'capture error:',ex)
+                    continue
+                try:
+                    todo.put_nowait( (i, file_path, camno) )
+                except queue.Full:
+                    with scantrace.span( self.tracer, 'wait download', point=i ): # downloads or writes behind
+                        todo.put( (i, file_path, camno) )
+        finally:
+            todo.put( None )
+            worker.join()
+            if self.writer is not None:
+                self.writer.flush()
+        return results
+
+
+    def run_program( self, points, labels=None, exposure=1., pulse=0.05, output=1, timeout=10. ):
+        '''
+        Same as run, but the controller runs the scan by itself and triggers
+        the camera through output bit output (see gantrycontrol.start_scan_program);
+        the host only downloads the photos as they appear.  settle is the
+        wait after each move, exposure the time left to the camera per point.
+        timeout is how long to wait for each photo to show up on the camera.
+        The controller sets the pace here, pending does not hold it up.
+
+        Returns the same list as run.
+        '''
+        if labels is None:
+            labels = [ self.label( point ) for point in points ]
+        results = [ [labels[i], points[i], None, None] for i in range( len(points) ) ]
+        camno = self.camera_no()
+        with self.camera_lock:
+            self.camera.new_scan( camno ) # settings baseline of this scan
+            self.camera.capture_to_ram( camno )
+
+        def on_point( i ):
+            try:
+                with self.camera_lock, scantrace.span( self.tracer, 'capture', point=i ): # waits for the previous download
+                    file_path = self.camera.wait_for_image( camno, timeout )
+            except Exception as ex:
+                results[i][3] = str(ex)
+                print('Point',i,'capture error:',ex)
+                return
+            todo.put( (i, file_path, camno) )
+
+        todo = queue.Queue()
+        worker = threading.Thread( target=self._download_worker, args=(todo, results) )
+        worker.start()
+        try:
+            self.gantry.run_scan_program( points, self.settle, exposure, pulse, output, on_point )
+        finally:
+            todo.put( None )
+            worker.join()
+            if self.writer is not None:
+                self.writer.flush()
+        return results
@@ -0,0 +1,225 @@
+'''
+
+scanplan.py
+
+Scan planning: build the list of gantry points of a scan from a short
+description, put them in an order that keeps the total move time low,
+and estimate how long the scan will take before anything moves.
+
+All points are N x 5 NumPy arrays of (x,y,z,theta,phi) in counts.
+
+Usage:
+
+  > import scanplan
+  > points = scanplan.plan( { 'type' : 'diagonal', 'top' : (0,62000,0), 'bottom' : (130000,40000,67000),
+  >                           'nxy' : 20, 'nz' : 20 } )           # the scan2.py plane
+  > points = scanplan.order( points, start=(0,0,0,0,0) )          # shortest move time order
+  > print( scanplan.estimate( points, start=(0,0,0,0,0), overhead=2. ) )
+
+Scan descriptions ('type' and the arguments of the function of that name):
+
+  raster      : grid over some axes, every row in the same direction
+  serpentine  : grid over some axes, every other row reversed (scan1.py)
+  diagonal    : x and y stepped together, in z planes (scan2.py)
+  cloud       : an arbitrary list of points
+  sweep       : theta and phi angles at one (x,y,z) position
+
+Move times use the same model as a gantrycontrol.move: every axis moves
+on its own with a trapezoidal profile at its speed (SP) and acceleration
+(AC/DC), and the move lasts as long as its slowest axis.
+'''
+
+import numpy as np
+
+NAXES = 5
+AXIS_INDEX = { 'x' : 0, 'y' : 1, 'z' : 2, 'theta' : 3, 'phi' : 4 }
+DEFAULT_SPEED = ( 1000, 1000, 1000, 1000, 1000 )             # counts/s, gantrycontrol.move default
+DEFAULT_ACCEL = ( 256000, 256000, 256000, 256000, 256000 )   # counts/s^2, controller default AC/DC
+
+
+def _point( base ):
+    point = np.zeros( NAXES )
+    point[ :len(base) ] = base
+    return point
+
+
+def _grid( axes, start, stop, n, base, snake ):
+    axes  = [ AXIS_INDEX[ax] for ax in axes ]
+    steps = [ np.linspace( start[k], stop[k], n[k] ) for k in range( len(axes) ) ]
+    points = []
+    passes = [ 0 ]*len(axes)   # times each axis was run through, odd ones go backwards
+    def fill( level, point ):
+        values = steps[level]
+        if snake and passes[level] % 2 == 1:
+            values = values[::-1]
+        passes[level] += 1
+        for value in values:
+            point = point.copy()
+            point[ axes[level] ] = value
+            if level == len(axes) - 1:
+                points.append( point )
+            else:
+                fill( level + 1, point )
+    # the first axis is the slowest changing one
+    fill( 0, _point( base ) )
+    return np.rint( np.array( points ) )
+
+
+def raster( axes, start, stop, n, base=(0,0,0,0,0) ):
+    '''
+    Grid over axes (e.g. ('z','y')), from start to stop with n points on each,
+    other axes at base.  The first axis changes slowest.
+    '''
+    return _grid( axes, start, stop, n, base, False )
+
+
+def serpentine( axes, start, stop, n, base=(0,0,0,0,0) ):
+    '''
+    Same points as raster, with every other row run backwards.
+    '''
+    return _grid( axes, start, stop, n, base, True )
+
+
+def diagonal( top, bottom, nxy, nz, base=(0,0,0,0,0) ):
+    '''
+    The scan2.py pattern: from top (x,y,z) x and y step together towards
+    bottom in nxy steps, in nz planes of z from top z towards bottom z,
+    going back and forth.
+    '''
+    xstep = int( ( bottom[0] - top[0] )/nxy )
+    ystep = int( ( bottom[1] - top[1] )/nxy )
+    zstep = int( ( bottom[2] - top[2] )/nz )
+    points = []
+    curx, cury = top[0], top[1]
+    for i in range( nz ):
+        curz = top[2] + zstep*i
+        for j in range( nxy ):
+            curx += xstep
+            cury += ystep
+            point = _point( base )
+            point[:3] = ( curx, cury, curz )
+            points.append( point )
+        xstep, ystep = -xstep, -ystep
+    return np.array( points )
+
+
+def cloud( points ):
+    '''
+    Arbitrary points, rows of up to 5 values (missing axes are 0)
+    '''
+    return np.array( [ _point( p ) for p in points ] )
+
+
+def sweep( thetas, phis, base=(0,0,0,0,0) ):
+    '''
+    Every (theta, phi) pair at the (x,y,z) of base, angles in counts
+    '''
+    points = []
+    for theta in thetas:
+        for phi in phis:
+            point = _point( base )
+            point[3], point[4] = theta, phi
+            points.append( point )
+    return np.array( points )
+
+
+PATTERNS = { 'raster' : raster, 'serpentine' : serpentine, 'diagonal' : diagonal, 'cloud' : cloud, 'sweep' : sweep }
+
+
+def plan( description ):
+    '''
+    Points of a scan description: a dictionary with 'type' (one of PATTERNS)
+    and the arguments of that pattern function.
+    '''
+    description = dict( description )
+    kind = description.pop( 'type' )
+    if kind not in PATTERNS:
+        raise ValueError('unknown scan type '+str(kind)+', use one of '+', '.join( PATTERNS ))
+    return PATTERNS[ kind ]( **description )
+
+
+def move_times( a, b, speed=DEFAULT_SPEED, accel=DEFAULT_ACCEL ):
+    '''
+    Time (s) of the moves from points a to points b (arrays broadcasting to
+    ... x 5), each axis with a trapezoidal profile, the slowest axis counts.
+    '''
+    d = np.abs( np.asarray( b, dtype=float ) - np.asarray( a, dtype=float ) )
+    v = np.asarray( speed, dtype=float )
+    acc = np.asarray( accel, dtype=float )
+    trapezoid = d/v + v/acc
+    triangle = 2*np.sqrt( d/acc )
+    t = np.where( d > v*v/acc, trapezoid, triangle )
+    return t.max( axis=-1 )
+
+
+def path_time( points, start=None, speed=DEFAULT_SPEED, accel=DEFAULT_ACCEL ):
+    '''
+    total move time (s) to visit points in order, from start if given
+    '''
+    points = np.asarray( points, dtype=float )
+    total = move_times( points[:-1], points[1:], speed, accel ).sum() if len(points) > 1 else 0.
+    if start is not None and len(points) > 0:
+        total += move_times( _point( start ), points[0], speed, accel )
+    return float( total )
+
+
+def order( points, start=None, speed=DEFAULT_SPEED, accel=DEFAULT_ACCEL, max_two_opt=1000, passes=5 ):
+    '''
+    Reorder points to keep the total move time low: nearest neighbour by
+    move time from start (or the first point), then 2-opt segment reversals
+    for scans of up to max_two_opt points.  The given order is kept if it
+    is already faster.
+    '''
+    points = np.asarray( points, dtype=float )
+    n = len(points)
+    if n < 3:
+        return points
+    current = _point( start ) if start is not None else points[0]
+    left = np.ones( n, dtype=bool )
+    route = []
+    for k in range( n ):
+        t = move_times( current, points, speed, accel )
+        t[ ~left ] = np.inf
+        i = int( np.argmin( t ) )
+        route.append( i )
+        left[i] = False
+        current = points[i]
+    route = np.array( route )
+
+    if n <= max_two_opt:
+        for p in range( passes ):
+            improved = False
+            for i in range( n - 2 ):
+                # reverse route[i+1 .. i+2+j] when that shortens the path
+                ra, rb = points[ route[i] ], points[ route[i+1] ]
+                rc, rd = points[ route[i+2:] ], points[ np.append( route[i+3:], -1 ) ]
+                old = move_times( ra, rb, speed, accel ) + move_times( rc, rd, speed, accel )
+                new = move_times( ra, rc, speed, accel ) + move_times( rb, rd, speed, accel )
+                # the last point has no successor
+                old[-1] = move_times( ra, rb, speed, accel )
+                new[-1] = move_times( ra, rc[-1], speed, accel )
+                gain = old - new
+                j = int( np.argmax( gain ) )
+                if gain[j] > 1e-9:
+                    route[ i+1 : i+3+j ] = route[ i+1 : i+3+j ][::-1]
+                    improved = True
+            if not improved:
+                break
+
+    ordered = points[ route ]
+    if path_time( ordered, start, speed, accel ) < path_time( points, start, speed, accel ):
+        return ordered
+    return points
+
+
+def estimate( points, start=None, speed=DEFAULT_SPEED, accel=DEFAULT_ACCEL, dwell=0., overhead=0. ):
+    '''
+    Estimated duration of a scan, in seconds: the move time, dwell seconds
+    at every point and overhead seconds per point (settling, capture,
+    download...).  Returns a dictionary with the parts and the total.
+    '''
+    moves = path_time( points, start, speed, accel )
+    n = len(points)
+    result = { 'points' : n, 'moves' : moves, 'dwell' : dwell*n, 'overhead' : overhead*n }
+    result['total'] = moves + result['dwell'] + result['overhead']
+    return result
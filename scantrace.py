@@ -0,0 +1,242 @@
+'''
+
+scantrace.py
+
+Opt-in timing of a scan: where the time goes, per operation and per
+point.
+
+A scantrace object records spans (name, start, duration, thread, args).
+instrument() puts timing proxies in front of the controller connection
+(GCommand, GMotionComplete, GRecord ...), the camera sessions (summary,
+config, capture, file get/delete/save), the position journal and the
+scan output writers; scanengine adds the per point phases (move,
+settle, capture, download, metadata) when given the tracer.  This
+works the same with gclib and with galilsim, and with or without
+cameras.
+
+The spans give latency statistics and histograms per operation, and
+are exported as a Chrome trace (open in chrome://tracing or
+https://ui.perfetto.dev), one row per thread.
+
+Usage:
+
+  > import scantrace
+  > tracer = scantrace.scantrace()
+  > scantrace.instrument( tracer, gantry=gantry, camera=pgc )   # gantrycontrol, pgcamera
+  > engine = scanengine.scanengine( gantry, pgc, tracer=tracer )
+  > engine.run( points )
+  > tracer.print_summary()                    # count, mean, p50, p90, p99, max per operation
+  > counts, edges = tracer.histogram( 'galil.GCommand' )
+  > tracer.export( 'scan.trace.json' )
+  > with tracer.span( 'my step', 'user', point=3 ): do_something()
+'''
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import numpy as np
+
+GALIL_CALLS = ( 'GCommand', 'GMotionComplete', 'GRecord', 'GProgramDownload', 'GArrayDownload' )
+CAMERA_CALLS = { 'get_summary' : None, 'get_config' : None, 'set_config' : None, 'capture' : None,
+                 'wait_for_event' : None, 'file_delete' : None,
+                 'file_get' : { 'save' : None, 'get_data_and_size' : None } } # calls of the returned gp.CameraFile
+JOURNAL_CALLS = ( 'append', 'flush' )
+WRITER_CALLS = ( 'add', 'record', 'close' )
+HISTOGRAM_BINS = np.logspace( -5, 2, 36 ) # seconds, 10 us to 100 s
+
+
+class scantrace:
+
+    def __init__( self ):
+        self.events = []   # ( name, category, start, duration, thread id, args )
+        self.t0 = time.perf_counter()
+        self.threads = {}  # thread id : thread name
+        self.enabled = True
+
+    def record( self, name, category, start, duration, args=None ):
+        '''
+        Add a span that started at time.perf_counter() start and lasted duration seconds.
+        '''
+        if not self.enabled:
+            return
+        tid = threading.get_ident()
+        if tid not in self.threads:
+            self.threads[ tid ] = threading.current_thread().name
+        self.events.append( ( name, category, start, duration, tid, args ) )
+
+    @contextlib.contextmanager
+    def span( self, name, category='scan', **args ):
+        '''
+        Times the with block as span name, args are kept with it (e.g. point=3).
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record( name, category, start, time.perf_counter() - start, args or None )
+
+    def timed( self, function, name, category ):
+        '''
+        function wrapped so every call is recorded as span name
+        '''
+        @functools.wraps( function )
+        def wrapper( *args, **kwargs ):
+            start = time.perf_counter()
+            try:
+                return function( *args, **kwargs )
+            finally:
+                self.record( name, category, start, time.perf_counter() - start )
+        return wrapper
+
+    def durations( self, name ):
+        return np.array( [ e[3] for e in self.events if e[0] == name ] )
+
+    def names( self ):
+        return sorted( set( e[0] for e in self.events ) )
+
+    def histogram( self, name, bins=HISTOGRAM_BINS ):
+        '''
+        (counts, bin edges in seconds) of the durations of span name
+        '''
+        return np.histogram( self.durations( name ), bins )
+
+    def summary( self ):
+        '''
+        name : { count, total, mean, p50, p90, p99, max } in seconds, per span name
+        '''
+        stats = {}
+        for name in self.names():
+            d = self.durations( name )
+            p50, p90, p99 = np.percentile( d, [50, 90, 99] )
+            stats[ name ] = { 'count' : len(d), 'total' : float( d.sum() ), 'mean' : float( d.mean() ),
+                              'p50' : float(p50), 'p90' : float(p90), 'p99' : float(p99), 'max' : float( d.max() ) }
+        return stats
+
+    def print_summary( self ):
+        print( '%-32s %7s %10s %10s %10s %10s %10s' % ( 'operation', 'count', 'total s', 'mean ms', 'p50 ms', 'p99 ms', 'max ms' ) )
+        for name, s in sorted( self.summary().items(), key=lambda item : -item[1]['total'] ):
+            print( '%-32s %7d %10.3f %10.3f %10.3f %10.3f %10.3f' % ( name, s['count'], s['total'], s['mean']*1e3,
+                                                                     s['p50']*1e3, s['p99']*1e3, s['max']*1e3 ) )
+
+    def timeline( self ):
+        '''
+        point : list of ( name, start, duration ) of the spans with a point
+        argument, start in seconds from the creation of the tracer
+        '''
+        points = {}
+        for name, category, start, duration, tid, args in self.events:
+            if args is not None and 'point' in args:
+                points.setdefault( args['point'], [] ).append( ( name, start - self.t0, duration ) )
+        return points
+
+    def export( self, fname ):
+        '''
+        Write the spans as a Chrome trace (JSON object format), with the
+        summary and histograms under otherData.
+        '''
+        tids = dict( ( tid, i ) for i, tid in enumerate( self.threads ) )
+        pid = os.getpid()
+        events = [ { 'name' : 'thread_name', 'ph' : 'M', 'pid' : pid, 'tid' : tids[tid], 'args' : { 'name' : name } }
+                   for tid, name in self.threads.items() ]
+        for name, category, start, duration, tid, args in self.events:
+            event = { 'name' : name, 'cat' : category, 'ph' : 'X', 'pid' : pid, 'tid' : tids[tid],
+                      'ts' : ( start - self.t0 )*1e6, 'dur' : duration*1e6 }
+            if args is not None:
+                event['args'] = args
+            events.append( event )
+        histograms = {}
+        for name in self.names():
+            counts, edges = self.histogram( name )
+            histograms[ name ] = { 'counts' : counts.tolist(), 'edges' : edges.tolist() }
+        with open( fname, 'w' ) as f:
+            json.dump( { 'traceEvents' : events, 'displayTimeUnit' : 'ms',
+                         'otherData' : { 'summary' : self.summary(), 'histograms' : histograms } }, f )
+
+
+class traced:
+    '''
+    Proxy of obj that times the calls listed in calls (names, or a dictionary
+    name : calls to time on the returned object) as spans category.name.
+    Everything else goes straight to obj.
+    '''
+
+    def __init__( self, obj, tracer, category, calls ):
+        self._obj = obj
+        if not isinstance( calls, dict ):
+            calls = dict( ( name, None ) for name in calls )
+        for name, returned in calls.items():
+            function = getattr( obj, name, None )
+            if function is None:
+                continue
+            if returned is not None:
+                function = self._wrap_result( function, tracer, category, returned )
+            setattr( self, name, tracer.timed( function, category+'.'+name, category ) )
+
+    @staticmethod
+    def _wrap_result( function, tracer, category, calls ):
+        @functools.wraps( function )
+        def wrapper( *args, **kwargs ):
+            return traced( function( *args, **kwargs ), tracer, category, calls )
+        return wrapper
+
+    def __getattr__( self, name ):
+        return getattr( self._obj, name )
+
+
+def instrument( tracer, gantry=None, camera=None, writers=() ):
+    '''
+    Time the controller calls of gantrycontrol gantry, the camera calls of
+    pgcamera camera, and the add/record/close calls of writers (e.g. a
+    scandataset.scanwriter, a scancheckpoint).  Undo with uninstrument.
+    '''
+    if gantry is not None:
+        gantry.g = traced( gantry.g, tracer, 'galil', GALIL_CALLS )
+        gantry.journal = traced( gantry.journal, tracer, 'journal', JOURNAL_CALLS )
+    if camera is not None:
+        open_session = camera.open_session
+        def traced_session( camera_no ):
+            return traced( open_session( camera_no ), tracer, 'camera', CAMERA_CALLS )
+        camera.open_session = traced_session
+        camera.settings_text = tracer.timed( camera.settings_text, 'camera.settings_text', 'camera' )
+        settings_log = camera.settings_log
+        def traced_settings_log( dir='' ):
+            log = settings_log( dir )
+            if 'record' not in vars( log ):
+                log.record = tracer.timed( log.record, 'write.settings', 'write' )
+            return log
+        camera.settings_log = traced_settings_log
+    for writer in writers:
+        for name in WRITER_CALLS:
+            if hasattr( writer, name ):
+                setattr( writer, name, tracer.timed( getattr( writer, name ), 'write.'+type(writer).__name__+'.'+name, 'write' ) )
+
+
+def uninstrument( gantry=None, camera=None, writers=() ):
+    '''
+    Remove the proxies and wrappers put in place by instrument.
+    '''
+    if gantry is not None:
+        if isinstance( gantry.g, traced ):
+            gantry.g = gantry.g._obj
+        if isinstance( gantry.journal, traced ):
+            gantry.journal = gantry.journal._obj
+    if camera is not None:
+        for name in ( 'open_session', 'settings_text', 'settings_log' ):
+            camera.__dict__.pop( name, None )
+        for log in camera.settingslogs.values():
+            log.__dict__.pop( 'record', None )
+    for writer in writers:
+        for name in WRITER_CALLS:
+            writer.__dict__.pop( name, None )
+
+
+def span( tracer, name, category='scan', **args ):
+    '''
+    tracer.span(...) or, if tracer is None, a with block that does nothing
+    '''
+    if tracer is None:
+        return contextlib.nullcontext()
+    return tracer.span( name, category, **args )
@@ -0,0 +1,167 @@
+'''
+
+trajectory.py
+
+Turns a list of gantry points into PVT (position, velocity, time) segments
+for the buffered PVT mode of the Galil controller, see
+gantrycontrol.move_trajectory.
+
+Each point to point move is a straight line in (x,y,z,theta,phi) counts
+space: all axes follow the same trapezoidal profile scaled by their
+distance, so they start and arrive together.  The profile is as fast as
+the slowest axis allows with its speed and acceleration limit.  Every
+phase of the profile (accelerate, cruise, decelerate) has a constant
+acceleration, so the cubic PVT interpolation of the controller follows
+it exactly between the knots.
+
+Units: positions in counts, velocities in counts/s, segment times in
+servo samples (1024 samples/s at the default TM 1000).
+'''
+
+import math
+
+SAMPLE_RATE = 1024.   # servo samples per second at TM 1000
+MAX_SEGMENT = 2048    # longest PVT segment the controller accepts, in samples
+
+
+def to_samples( t ):
+    '''
+    seconds to a whole, even number of servo samples (rounded up)
+    '''
+    return int( math.ceil( t*SAMPLE_RATE/2. - 1e-9 ) )*2
+
+
+def split_samples( n ):
+    '''
+    split n (even) samples into pieces of at most MAX_SEGMENT even samples
+    '''
+    if n <= 0:
+        return []
+    k = int( math.ceil( n/float(MAX_SEGMENT) ) )
+    base = ( n//k )//2*2
+    pieces = [ base ]*k
+    extra = n - base*k
+    i = 0
+    while extra > 0:
+        pieces[i] += 2
+        extra -= 2
+        i += 1
+    return pieces
+
+
+def move_profile( dist, speed, accel ):
+    '''
+    Synchronized profile for a straight move of dist[i] counts on each axis,
+    with at most speed[i] counts/s and accel[i] counts/s^2 on axis i.
+
+    The move is described by the fraction s of it done so far, which goes
+    from 0 to 1 with a trapezoidal velocity.  Returns (n_acc, n_cruise, v):
+    the samples spent accelerating (and again decelerating), the samples
+    spent at full speed, and the full speed in fractions of the move per
+    second.  A move of zero length returns (0, 0, 0.).
+    '''
+    vs, acs = None, None
+    for d, sp, ac in zip( dist, speed, accel ):
+        if d == 0:
+            continue
+        vs  = sp/abs(d) if vs is None else min( vs, sp/abs(d) )
+        acs = ac/abs(d) if acs is None else min( acs, ac/abs(d) )
+    if vs is None:
+        return 0, 0, 0.
+    t_acc = vs/acs
+    if vs*t_acc > 1.:
+        # triangular profile, full speed never reached
+        t_acc = math.sqrt( 1./acs )
+        t_cru = 0.
+    else:
+        t_cru = ( 1. - vs*t_acc )/vs
+    n_acc = max( to_samples( t_acc ), 2 )
+    n_cru = to_samples( t_cru )
+    # stretch the full speed so the rounded times still cover the whole move
+    v = SAMPLE_RATE/( n_acc + n_cru )
+    return n_acc, n_cru, v
+
+
+def move_time( dist, speed, accel ):
+    '''
+    duration in seconds of the synchronized move from move_profile
+    '''
+    n_acc, n_cru, v = move_profile( dist, speed, accel )
+    return ( 2*n_acc + n_cru )/SAMPLE_RATE
+
+
+def _path( n, n_acc, n_cru, v ):
+    '''
+    fraction of the move done and its rate (1/s) after n samples
+    '''
+    t, t_acc, t_cru = n/SAMPLE_RATE, n_acc/SAMPLE_RATE, n_cru/SAMPLE_RATE
+    a = v/t_acc
+    if t <= t_acc:
+        return 0.5*a*t*t, a*t
+    if t <= t_acc + t_cru:
+        return 0.5*v*t_acc + v*( t - t_acc ), v
+    tr = 2*t_acc + t_cru - t
+    return 1. - 0.5*a*tr*tr, a*tr
+
+
+def pvt_segments( start, points, speed, accel, dwell=0. ):
+    '''
+    start  : current position (x,y,z,theta,phi) in counts
+    points : list of absolute positions (x,y,z,theta,phi) in counts
+    speed, accel : per axis limits in counts/s and counts/s^2
+    dwell  : seconds to stay still at each point
+
+    Returns (segments, arrivals).  segments is a list of (dp, v, n) with dp
+    the relative move and v the final velocity of each axis for a segment of
+    n samples.  arrivals holds the time in seconds, counted from the start
+    of the motion, at which each point is reached.
+    '''
+    segments = []
+    arrivals = []
+    cur = [ int(round(p)) for p in start ]
+    n_total = 0
+    for point in points:
+        target = [ int(round(p)) for p in point ]
+        dist = [ target[i] - cur[i] for i in range( len(cur) ) ]
+        n_acc, n_cru, v = move_profile( dist, speed, accel )
+        knots = []
+        n = 0
+        for phase in ( n_acc, n_cru, n_acc ):
+            for piece in split_samples( phase ):
+                n += piece
+                knots.append( (n, piece) )
+        prev = list( cur )
+        for n, piece in knots:
+            s, sdot = _path( n, n_acc, n_cru, v )
+            if n == knots[-1][0]:
+                s, sdot = 1., 0.
+            pos = [ cur[i] + int(round( dist[i]*s )) for i in range( len(cur) ) ]
+            vel = [ int(round( dist[i]*sdot )) for i in range( len(cur) ) ]
+            segments.append( ( [ pos[i] - prev[i] for i in range( len(cur) ) ], vel, piece ) )
+            prev = pos
+        n_total += 2*n_acc + n_cru
+        arrivals.append( n_total/SAMPLE_RATE )
+        for piece in split_samples( to_samples( dwell ) ):
+            segments.append( ( [0]*len(cur), [0]*len(cur), piece ) )
+            n_total += piece
+        cur = target
+    return segments, arrivals
+
+
+def axis_settings( dist, speed, accel ):
+    '''
+    Per axis speed (SP) and acceleration (AC, also used for DC) that make
+    independent trapezoidal moves of dist[i] counts start and arrive
+    together, as fast as the speed and accel limits allow: the profile of
+    move_profile, scaled by the distance of each axis.
+
+    Returns (sp, ac, seconds), with None for the axes that don't move.
+    AC is rounded down to the 1024 counts/s^2 resolution of the controller.
+    '''
+    n_acc, n_cru, v = move_profile( dist, speed, accel )
+    if v == 0.:
+        return [ None ]*len(dist), [ None ]*len(dist), 0.
+    t_acc = n_acc/SAMPLE_RATE
+    sp = [ max( int(round( abs(d)*v )), 1 ) if d != 0 else None for d in dist ]
+    ac = [ max( int( abs(d)*v/t_acc/1024. )*1024, 1024 ) if d != 0 else None for d in dist ]
+    return sp, ac, ( 2*n_acc + n_cru )/SAMPLE_RATE